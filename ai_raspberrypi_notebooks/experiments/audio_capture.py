@@ -0,0 +1,237 @@
+# Streaming audio capture with energy-based voice activity detection (VAD).
+#
+# Instead of recording a fixed window with `sd.rec`, `record_utterance` reads blocks from an
+# input stream, stops shortly after the speech ends and trims the leading/trailing silence.
+# `WavInputStream` stands in for `sounddevice.InputStream` to replay WAV files offline.
+
+import time
+import queue
+import threading
+import wave
+import numpy as np
+
+
+DEFAULT_SAMPLERATE = 44100
+BLOCK_SECS = 0.03
+
+
+class RingBuffer:
+    """ Fixed-size circular buffer of audio frames; the oldest frames are overwritten when full """
+
+    def __init__(self, capacity, channels=1, dtype=np.float32):
+        self.data = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        self.written = 0  # total number of frames written so far
+
+    def write(self, frames):
+        n = len(frames)
+        if n >= self.capacity:
+            frames = frames[-self.capacity:]
+            start = (self.written + n - self.capacity) % self.capacity
+            n_tail = self.capacity - start
+            self.data[start:] = frames[:n_tail]
+            self.data[:start] = frames[n_tail:]
+        else:
+            start = self.written % self.capacity
+            n_tail = min(n, self.capacity - start)
+            self.data[start:start + n_tail] = frames[:n_tail]
+            self.data[:n - n_tail] = frames[n_tail:]
+        self.written += n
+
+    def read(self, start, end):
+        """ Returns a copy of frames [start, end) in terms of the total frame count written """
+        start = max(start, self.written - self.capacity, 0)
+        end = min(end, self.written)
+        if end <= start:
+            return self.data[:0].copy()
+        i, j = start % self.capacity, end % self.capacity
+        if i < j:
+            return self.data[i:j].copy()
+        return np.concatenate([self.data[i:], self.data[:j]])
+
+
+def block_db(block):
+    """ RMS level of a block of frames in dBFS """
+    rms = np.sqrt(np.mean(np.square(block, dtype=np.float64)))
+    return 20 * np.log10(max(rms, 1e-10))
+
+
+class EnergyVAD:
+    """ Endpointing on block energy relative to an adaptive noise floor
+
+    Args:
+        :param margin_db: float
+            Blocks louder than the noise floor by this much are speech
+        :param min_speech_db: float
+            Blocks quieter than this are never speech, whatever the noise floor
+        :param min_speech_secs: float
+            Speech must last this long to start an utterance (ignores clicks)
+        :param silence_secs: float
+            The utterance ends after this much silence following speech
+    """
+
+    def __init__(self, block_secs=BLOCK_SECS, margin_db=12.0, min_speech_db=-50.0,
+                 min_speech_secs=0.09, silence_secs=0.6, noise_floor_db=-60.0):
+        self.block_secs = block_secs
+        self.margin_db = margin_db
+        self.min_speech_db = min_speech_db
+        self.min_speech_blocks = max(1, int(round(min_speech_secs / block_secs)))
+        self.silence_blocks = max(1, int(round(silence_secs / block_secs)))
+        self.noise_floor_db = noise_floor_db
+        self.speech_run = 0
+        self.silence_run = 0
+        self.started = False
+        self.ended = False
+
+    def is_speech(self, db):
+        return db > max(self.noise_floor_db + self.margin_db, self.min_speech_db)
+
+    def update(self, db):
+        """ Updates the state with the level of the next block; returns True if it is speech """
+        speech = self.is_speech(db)
+        if not speech:
+            # track the noise floor slowly upwards and quickly downwards
+            rate = 0.05 if db > self.noise_floor_db else 0.5
+            self.noise_floor_db += rate * (db - self.noise_floor_db)
+        if not self.started:
+            self.speech_run = self.speech_run + 1 if speech else 0
+            if self.speech_run >= self.min_speech_blocks:
+                self.started = True
+        elif not self.ended:
+            self.silence_run = 0 if speech else self.silence_run + 1
+            if self.silence_run >= self.silence_blocks:
+                self.ended = True
+        return speech
+
+
+def record_utterance(samplerate=DEFAULT_SAMPLERATE, channels=1, max_duration=10.0, start_timeout=5.0,
+                     pad_secs=0.15, vad=None, stream_factory=None):
+    """ Records from the input stream until the speech ends; returns float32 frames (n, channels)
+
+    Args:
+        :param max_duration: float
+            Hard limit on the recording in secs (also the size of the ring buffer)
+        :param start_timeout: float
+            Give up if no speech starts within this many secs; an empty array is returned
+        :param pad_secs: float
+            Silence kept before the speech onset and after the speech end
+        :param vad: EnergyVAD
+            Endpointing state; a default `EnergyVAD` is used if not given
+        :param stream_factory: callable
+            Creates the stream with the same arguments as `sounddevice.InputStream`
+    """
+    if stream_factory is None:
+        import sounddevice as sd
+        stream_factory = sd.InputStream
+    vad = vad or EnergyVAD()
+    blocksize = max(1, int(samplerate * vad.block_secs))
+    buffer = RingBuffer(int(samplerate * max_duration) + blocksize, channels=channels)
+    blocks = queue.Queue()
+    pad = int(samplerate * pad_secs)
+
+    def callback(indata, frames, time_info, status):
+        if status:
+            print(status)
+        blocks.put(indata.copy())
+
+    speech_start = speech_end = None
+    start = time.perf_counter()
+    with stream_factory(samplerate=samplerate, channels=channels, blocksize=blocksize,
+                        dtype="float32", callback=callback):
+        print("Start recording...")
+        while True:
+            try:
+                block = blocks.get(timeout=1.0)
+            except queue.Empty:
+                break  # the stream has stopped delivering audio
+            offset = buffer.written
+            buffer.write(block)
+            speech = vad.update(block_db(block))
+            if vad.started and speech_start is None:
+                speech_start = offset - (vad.speech_run - 1) * blocksize
+            if speech and vad.started:
+                speech_end = buffer.written
+            if vad.ended or buffer.written >= samplerate * max_duration:
+                break
+            if not vad.started and buffer.written >= samplerate * start_timeout:
+                break
+    print("End recording...")
+    secs = time.perf_counter() - start
+    if speech_start is None:
+        print(f"No speech detected in {secs:.2f} secs")
+        return np.zeros((0, channels), dtype=np.float32)
+    recording = buffer.read(speech_start - pad, speech_end + pad)
+    print(f"Recorded {len(recording) / samplerate:.2f} secs of speech in {secs:.2f} secs")
+    return recording
+
+
+def read_wav(path):
+    """ Returns (float32 frames (n, channels), samplerate) of a 16-bit PCM WAV file """
+    with wave.open(path, "rb") as f:
+        samplerate = f.getframerate()
+        channels = f.getnchannels()
+        if f.getsampwidth() != 2:
+            raise ValueError(f"only 16-bit WAV files are supported: {path}")
+        frames = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2")
+    return frames.reshape(-1, channels).astype(np.float32) / 32768.0, samplerate
+
+
+class WavInputStream:
+    """ Fake `sounddevice.InputStream` that feeds the frames of a WAV file to the callback
+
+    Use with `functools.partial(WavInputStream, path)` as the `stream_factory` of
+    `record_utterance`. With `realtime=False` blocks are delivered as fast as they are consumed.
+    """
+
+    def __init__(self, path, samplerate=None, channels=1, blocksize=1024, dtype="float32",
+                 callback=None, realtime=True, tail_secs=2.0):
+        frames, wav_rate = read_wav(path)
+        if samplerate and samplerate != wav_rate:
+            n = int(round(len(frames) * samplerate / wav_rate))
+            x = np.linspace(0, len(frames) - 1, n)
+            frames = np.stack([np.interp(x, np.arange(len(frames)), frames[:, c])
+                               for c in range(frames.shape[1])], axis=1).astype(np.float32)
+        frames = frames[:, :channels] if frames.shape[1] >= channels else np.repeat(frames[:, :1], channels, axis=1)
+        # trailing silence, as a live microphone would keep delivering after the file ends
+        tail = np.zeros((int((samplerate or wav_rate) * tail_secs), channels), dtype=np.float32)
+        self.frames = np.concatenate([frames, tail]).astype(dtype)
+        self.samplerate = samplerate or wav_rate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.callback = callback
+        self.realtime = realtime
+        self.active = False
+        self._thread = None
+
+    def _run(self):
+        block_secs = self.blocksize / self.samplerate
+        next_time = time.perf_counter()
+        for i in range(0, len(self.frames), self.blocksize):
+            if not self.active:
+                break
+            block = self.frames[i:i + self.blocksize]
+            self.callback(block, len(block), None, None)
+            if self.realtime:
+                next_time += block_secs
+                time.sleep(max(0.0, next_time - time.perf_counter()))
+        self.active = False
+
+    def start(self):
+        self.active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.active = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,35 +1,79 @@
 import os
 import json
-import sounddevice as sd
-from scipy.io.wavfile import write
-import wavio as wv
+import threading
 from io import BytesIO, FileIO
-from openai import OpenAI
 import datetime
-from pydub import AudioSegment
-from pydub.playback import play
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from experiments.audio_capture import record_utterance
+from experiments.audio_encoding import encode_audio
+from experiments.tts_cache import pcm_to_wav_bytes
+from experiments.metrics import registry
 
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=openai_api_key)
+# Created on first use by `get_client`. sounddevice, wavio and pydub are also imported where
+# they are used: together with openai they take seconds to import on a Raspberry Pi.
+client = None
+_client_lock = threading.Lock()
+# Speech-to-text backend of `transcribe`, set by `transcription.configure_transcriber`; if None,
+# recordings are transcribed with the OpenAI API
+transcriber = None
 
+# The `pcm` response format of the speech API: 24 kHz, 16-bit signed little-endian, mono
+TTS_PCM_SAMPLERATE = 24000
 
-def get_audio_instruction(duration=5):
+TTS_MODEL = "gpt-4o-mini-tts"
+TTS_VOICE = "coral"
+TTS_INSTRUCTIONS = "Speak as an assistant in a sincere tone."
+
+
+def get_client():
+    """ Returns the OpenAI client, creating it on first use """
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                from openai import OpenAI
+                client = OpenAI(api_key=openai_api_key)
+    return client
+
+
+def get_audio_instruction(duration=5, vad=False, stream_factory=None, encoding=None):
+    """ Returns the recorded instruction as an audio file in a `BytesIO`, or None if the voice
+    activity detector heard no speech """
     # Sampling frequency
     freq = 44100
     
     # Recording duration
     # duration = 5
     
-    # Start recorder with the given values 
-    # of duration and sample frequency
-    recording = sd.rec(int(duration * freq), samplerate=freq, channels=1)
-    
-    print("Start recording...")
-    # Record audio for the given number of seconds
-    sd.wait()
-    print("End recording...")
-    
+    if vad:
+        # Record until the speaker stops, for at most `duration` secs
+        recording = record_utterance(samplerate=freq, channels=1, max_duration=duration,
+                                     stream_factory=stream_factory)
+    else:
+        import sounddevice as sd
+        # Start recorder with the given values 
+        # of duration and sample frequency
+        recording = sd.rec(int(duration * freq), samplerate=freq, channels=1)
+        
+        print("Start recording...")
+        # Record audio for the given number of seconds
+        sd.wait()
+        print("End recording...")
+
+    if len(recording) == 0:
+        return None
+
+    if encoding:
+        # Downsample to 16 kHz and compress before upload (see `audio_encoding.ENCODINGS`)
+        byte_stream, stats = encode_audio(recording, freq, fmt=encoding)
+        print(f"Encoded audio as {stats['format']} at {stats['samplerate']} Hz: {stats['bytes']} bytes "
+              f"(raw {stats['raw_bytes']} bytes) in {stats['encode_secs']} secs")
+        return byte_stream
+
+    import wavio as wv
     byte_stream = BytesIO()
     wv.write(byte_stream, recording, freq, sampwidth=2)
 
@@ -37,23 +81,35 @@ def get_audio_instruction(duration=5):
 
 
 def transcribe(byte_stream):
+    """ Returns the text of the recording in `byte_stream`, from `transcriber` if it is set """
+    if transcriber is not None:
+        return transcriber.transcribe(byte_stream)
+    return transcribe_cloud(byte_stream)
+
+
+def transcribe_cloud(byte_stream):
     start = datetime.datetime.now()
     byte_stream.seek(0)
-    audio_file = ("audio.wav", byte_stream, "audio/wav")  # ("audio.wav", buffer, "audio/wav")
+    filename = getattr(byte_stream, "name", "audio.wav")
+    content_type = getattr(byte_stream, "content_type", "audio/wav")
+    audio_file = (filename, byte_stream, content_type)  # ("audio.wav", buffer, "audio/wav")
+    upload_bytes = byte_stream.getbuffer().nbytes
     
     # prompt = "This audio is that of an employee contacting the service agent Barista for assistance. Please transcribe the audio and translate it into english."
     # prompt = "This audio is that of an employee contacting the service agent Barista for assistance. Please transcribe the audio."
     prompt = "The audio is an instruction to a device. Transcribe the audio and translate it into english."
     
     start = datetime.datetime.now()
-    transcription = client.audio.transcriptions.create(
-        file=audio_file,
-        # model="whisper-1",
-        model="gpt-4o-mini-transcribe",
-        prompt=prompt,
-    )
+    registry.incr("transcribe_upload_bytes", upload_bytes)
+    with registry.span("transcribe", format=filename.rsplit(".", 1)[-1], backend="cloud"):
+        transcription = get_client().audio.transcriptions.create(
+            file=audio_file,
+            # model="whisper-1",
+            model="gpt-4o-mini-transcribe",
+            prompt=prompt,
+        )
     secs = (datetime.datetime.now() - start).total_seconds()
-    print(f"Time for transcription: {secs} secs")
+    print(f"Time for transcription: {secs} secs ({upload_bytes} bytes uploaded as {filename})")
     # print(transcription.words)
     # print(transcription.text)
     return transcription.text
@@ -69,12 +125,12 @@ def write_response_to_stream(response, byte_stream):
     
 
 def text_to_speech(
-    text, model="gpt-4o-mini-tts", voice="coral", 
-    instructions="Speak as an assistant in a sincere tone."
+    text, model=TTS_MODEL, voice=TTS_VOICE, 
+    instructions=TTS_INSTRUCTIONS
 ):
     byte_stream = BytesIO()
     start = datetime.datetime.now()
-    with client.audio.speech.with_streaming_response.create(
+    with registry.span("tts", stream=False), get_client().audio.speech.with_streaming_response.create(
         model=model, voice=voice, input=text, instructions=instructions
     ) as response:
         # response.stream_to_file(speech_file_path)
@@ -86,11 +142,134 @@ def text_to_speech(
 
 # Function to play audio from byte stream
 def play_audio_from_bytes(byte_stream, volume=40):
+    from pydub import AudioSegment
+    from pydub.playback import play
     audio = AudioSegment.from_file(byte_stream, format="mp3")
     play(audio + volume)
 
 
-def speak(text, volume=40):
+def apply_gain(samples, volume):
+    """ Applies `volume` dB of gain to int16 samples with clipping, like `AudioSegment + volume` """
+    out = samples.astype(np.float32)
+    np.multiply(out, 10 ** (volume / 20), out=out)
+    np.clip(out, -32768, 32767, out=out)
+    return out.astype(np.int16)
+
+
+def stream_speech(
+    text, volume=40, model=TTS_MODEL, voice=TTS_VOICE,
+    instructions=TTS_INSTRUCTIONS, chunk_size=4096, output_stream_factory=None
+):
+    """ Plays the speech for `text` while it is being synthesized
+
+    Raw PCM is requested instead of MP3 so that each chunk can be played as soon as it
+    arrives, without waiting for the whole clip to be synthesized and decoded.
+    Returns the raw PCM (24 kHz, int16, mono) in a byte stream.
+    """
+    if output_stream_factory is None:
+        import sounddevice as sd
+        output_stream_factory = sd.OutputStream
+    byte_stream = BytesIO()
+    start = datetime.datetime.now()
+    first_audio_secs = None
+    with registry.span("tts", stream=True), get_client().audio.speech.with_streaming_response.create(
+        model=model, voice=voice, input=text, instructions=instructions, response_format="pcm"
+    ) as response, output_stream_factory(
+        samplerate=TTS_PCM_SAMPLERATE, channels=1, dtype="int16", latency="low"
+    ) as out:
+        leftover = b""
+        for chunk in response.iter_bytes(chunk_size=chunk_size):
+            if not chunk:
+                continue
+            byte_stream.write(chunk)
+            data = leftover + chunk
+            n = len(data) - len(data) % 2  # a chunk may end in the middle of a sample
+            leftover = data[n:]
+            if n == 0:
+                continue
+            samples = np.frombuffer(data[:n], dtype="<i2")
+            if first_audio_secs is None:
+                first_audio_secs = (datetime.datetime.now() - start).total_seconds()
+                registry.observe("tts_first_audio_secs", first_audio_secs)
+                print(f"Time to first audio: {first_audio_secs} secs")
+            out.write(apply_gain(samples, volume).reshape(-1, 1))
+    secs = (datetime.datetime.now() - start).total_seconds()
+    print(f"Time for text-to-speech: {secs} secs (first audio after {first_audio_secs} secs)")
+    byte_stream.seek(0)
+    return byte_stream
+
+
+def prepare_speech(text, tts_cache=None, model=TTS_MODEL, voice=TTS_VOICE, instructions=TTS_INSTRUCTIONS):
+    """ Returns the decoded `AudioSegment` for `text` without playing it
+
+    The audio comes from `tts_cache` when present there; otherwise it is synthesized and,
+    if a cache is given, added to it.
+    """
+    key = (text, model, voice, instructions)
+    if tts_cache is not None and (segment := tts_cache.get(*key)) is not None:
+        return segment
+    from pydub import AudioSegment
+    data = text_to_speech(text, model=model, voice=voice, instructions=instructions).getvalue()
+    segment = AudioSegment.from_file(BytesIO(data), format="mp3")
+    if tts_cache is not None:
+        tts_cache.put(*key, data, fmt="mp3", segment=segment)
+    return segment
+
+
+def play_segment(segment, volume=40):
+    from pydub.playback import play
+    play(segment + volume)
+
+
+def speak_cached(text, tts_cache, volume=40, stream=False, model=TTS_MODEL, voice=TTS_VOICE,
+                 instructions=TTS_INSTRUCTIONS):
+    """ Plays `text` from `tts_cache` if present, else synthesizes it and adds it to the cache
+
+    Returns the `AudioSegment` that was played.
+    """
+    key = (text, model, voice, instructions)
+    segment = tts_cache.get(*key)
+    if segment is not None:
+        print("Playing cached speech...")
+        play_segment(segment, volume=volume)
+    elif stream:
+        pcm = stream_speech(text, volume=volume, model=model, voice=voice, instructions=instructions).getvalue()
+        from pydub import AudioSegment
+        pcm = pcm[:len(pcm) - len(pcm) % 2]
+        segment = AudioSegment(data=pcm, sample_width=2, frame_rate=TTS_PCM_SAMPLERATE, channels=1)
+        tts_cache.put(*key, pcm_to_wav_bytes(pcm, TTS_PCM_SAMPLERATE), fmt="wav", segment=segment)
+    else:
+        segment = prepare_speech(text, tts_cache=tts_cache, model=model, voice=voice, instructions=instructions)
+        play_segment(segment, volume=volume)
+    return segment
+
+
+def load_phrases(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def prewarm_tts_cache(tts_cache, phrases, max_workers=4):
+    """ Synthesizes the `phrases` that are not cached yet, without playing them """
+    def synthesize(text):
+        prepare_speech(text, tts_cache=tts_cache)
+
+    start = datetime.datetime.now()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for phrase, future in [(p, executor.submit(synthesize, p)) for p in phrases]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to pre-warm '{phrase}': {e}")
+    secs = (datetime.datetime.now() - start).total_seconds()
+    print(f"Time to pre-warm {len(phrases)} phrases: {secs} secs")
+
+
+def speak(text, volume=40, stream=False, tts_cache=None):
+    if tts_cache is not None:
+        return speak_cached(text, tts_cache, volume=volume, stream=stream)
+    if stream:
+        return stream_speech(text, volume=volume)
     byte_stream = text_to_speech(text)
     byte_stream.seek(0)
     play_audio_from_bytes(byte_stream, volume=volume)
@@ -0,0 +1,93 @@
+# Encoding stage between capture and `transcribe`: downsampling, int16 conversion and
+# optional compression, so less audio has to be uploaded from the Pi.
+
+import time
+import wave
+from io import BytesIO
+from math import gcd
+import numpy as np
+
+
+TRANSCRIBE_SAMPLERATE = 16000  # the speech-to-text models work at 16 kHz internally
+
+# format -> (file extension, mime type, pydub export arguments)
+ENCODINGS = {
+    "wav": ("wav", "audio/wav", None),
+    "flac": ("flac", "audio/flac", dict(format="flac")),
+    "mp3": ("mp3", "audio/mpeg", dict(format="mp3", bitrate="32k")),
+    "opus": ("ogg", "audio/ogg", dict(format="ogg", codec="libopus", bitrate="24k")),
+}
+
+
+def float_to_int16(x, out=None, inplace=False):
+    """ Converts float audio in [-1, 1] to int16 with NumPy ufuncs, without temporaries
+
+    Args:
+        :param out: np.ndarray
+            int16 array to write to; allocated if not given
+        :param inplace: bool
+            Allow `x` (float32) to be used as the scratch buffer; otherwise one float32 scratch
+            array is allocated
+    """
+    x = np.asarray(x, dtype=np.float32)
+    work = x if inplace else np.empty_like(x)
+    np.clip(x, -1.0, 1.0, out=work)
+    np.multiply(work, 32767.0, out=work)
+    np.rint(work, out=work)
+    if out is None:
+        out = np.empty(x.shape, dtype=np.int16)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def resample(x, from_rate, to_rate):
+    """ Polyphase resampling along the first axis, e.g. 44.1 kHz -> 16 kHz is up 160 / down 441 """
+    if from_rate == to_rate:
+        return x
+    from scipy.signal import resample_poly
+    g = gcd(int(from_rate), int(to_rate))
+    return resample_poly(x, int(to_rate) // g, int(from_rate) // g, axis=0).astype(np.float32, copy=False)
+
+
+def write_wav(byte_stream, pcm, samplerate):
+    """ Writes int16 frames (n, channels) as a WAV file """
+    channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+    with wave.open(byte_stream, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(np.ascontiguousarray(pcm, dtype="<i2").tobytes())
+
+
+def encode_audio(recording, samplerate, fmt="flac", target_rate=TRANSCRIBE_SAMPLERATE):
+    """ Encodes a float recording (n, channels) for upload
+
+    Returns (byte_stream, stats). The byte stream has a `name` (e.g. "audio.flac") and a
+    `content_type` that `transcribe` passes on with the upload. `stats` has the
+    `encode_secs`, the uploaded `bytes` and the `raw_bytes` of 16-bit PCM at the input rate.
+    """
+    if fmt not in ENCODINGS:
+        raise ValueError(f"invalid audio encoding {fmt}, must be one of {sorted(ENCODINGS)}")
+    start = time.perf_counter()
+    recording = np.asarray(recording, dtype=np.float32)
+    rate = target_rate or samplerate
+    if rate != samplerate:
+        # resampling returns a new array, which can then be the int16 conversion's scratch buffer
+        pcm = float_to_int16(resample(recording, samplerate, rate), inplace=True)
+    else:
+        pcm = float_to_int16(recording)
+    ext, content_type, export_args = ENCODINGS[fmt]
+    byte_stream = BytesIO()
+    if export_args is None:
+        write_wav(byte_stream, pcm, rate)
+    else:
+        from pydub import AudioSegment
+        channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+        segment = AudioSegment(data=pcm.tobytes(), sample_width=2, frame_rate=rate, channels=channels)
+        segment.export(byte_stream, **export_args)
+    byte_stream.name = f"audio.{ext}"
+    byte_stream.content_type = content_type
+    stats = dict(format=fmt, samplerate=rate, bytes=byte_stream.getbuffer().nbytes,
+                 raw_bytes=recording.size * 2, encode_secs=time.perf_counter() - start)
+    byte_stream.seek(0)
+    return byte_stream, stats
@@ -0,0 +1,131 @@
+# Offline planning of a library of tasks (routines, choreographies, test sequences) into a
+# compiled plan file that `control` can execute without calling the LLM:
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.batch routines.txt -o routines.plans.json --workers 4 --rate 2
+#   python -m experiments.control --compiled-plans routines.plans.json
+#
+# The tasks file has one task per line; blank lines and lines starting with '#' are skipped.
+# Tasks are planned concurrently by a bounded pool of workers, and the requests to the
+# Messages endpoint are rate limited with a token bucket.
+
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from experiments import motor_control
+from experiments.motor_control import get_motor_funcs, planners, update_metrics
+from experiments.http_client import TokenBucket, configure_http_client
+from experiments.plan_cache import normalize_task, is_cacheable_plan
+
+
+COMPILED_PLANS_VERSION = 1
+
+
+def load_tasks(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def compile_tasks(tasks, planner="iterative", workers=4, rate=None, burst=None, progress=True):
+    """ Plans `tasks` concurrently; returns (compiled plans dict, report)
+
+    Args:
+        :param workers: int
+            Number of tasks planned at the same time
+        :param rate: float
+            Max Messages API requests/sec across all workers (no limit if None)
+        :param burst: int
+            Requests allowed at once before `rate` applies (default: `workers`)
+
+    Tasks with the same normalized text are planned once. Plans that are incomplete or
+    contain errors are listed in `failed` instead of being compiled.
+    """
+    unique = {}
+    for task in tasks:
+        unique.setdefault(normalize_task(task), task)
+    _, dummy_funcs = get_motor_funcs(dummy=True)
+    limiter = TokenBucket(rate, burst or workers) if rate else None
+    previous_limiter, motor_control.rate_limiter = motor_control.rate_limiter, limiter
+    plans = {}
+    failed = []
+    usage = {}
+    lock = threading.Lock()
+
+    def plan(key, task):
+        metrics = {}
+        try:
+            steps, answer, messages = planners[planner](task, funcs=dummy_funcs, metrics=metrics)
+        except Exception as e:
+            steps, answer = [], None
+            print(f"Failed to plan '{task}': {e}")
+        with lock:
+            update_metrics(usage, metrics, round_trips=metrics.get("round_trips", 0))
+            if is_cacheable_plan(steps, answer):
+                plans[key] = dict(task=task, steps=steps, answer=answer)
+            else:
+                failed.append(task)
+            if progress:
+                print(f"[{len(plans) + len(failed)}/{len(unique)}] {'ok' if key in plans else 'FAILED'}: {task}")
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+            for future in [executor.submit(plan, key, task) for key, task in unique.items()]:
+                future.result()
+    finally:
+        motor_control.rate_limiter = previous_limiter
+    secs = time.perf_counter() - start
+    report = dict(tasks=len(unique), compiled=len(plans), failed=len(failed), secs=secs,
+                  tasks_per_sec=len(unique) / secs if secs else 0.0,
+                  rate_limit_wait_secs=limiter.waited_secs if limiter else 0.0, **usage)
+    compiled = dict(version=COMPILED_PLANS_VERSION, created=time.time(), planner=planner,
+                    model=motor_control.model, plans=plans, failed=failed)
+    return compiled, report
+
+
+def save_compiled_plans(compiled, path):
+    with open(path, "w") as f:
+        json.dump(compiled, f, indent=1)
+
+
+class CompiledPlans:
+    """ Read-only plans of a compiled plan file, looked up like `PlanCache` by the normalized task """
+
+    def __init__(self, path):
+        with open(path) as f:
+            compiled = json.load(f)
+        if compiled.get("version") != COMPILED_PLANS_VERSION:
+            raise ValueError(f"unsupported compiled plan file version {compiled.get('version')} in {path}")
+        self.path = path
+        self.plans = compiled.get("plans") or {}
+
+    def get(self, task):
+        """ Returns (steps, answer) for `task`, or None if it was not compiled """
+        if (plan := self.plans.get(normalize_task(task))) is None:
+            return None
+        return plan["steps"], plan["answer"]
+
+    def tasks(self):
+        return [plan["task"] for plan in self.plans.values()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plans the tasks of a file into a compiled plan file")
+    parser.add_argument("tasks", help="text file with one task per line")
+    parser.add_argument("-o", "--output", required=True, help="compiled plan file (JSON) to write")
+    parser.add_argument("--planner", choices=sorted(planners), default="iterative")
+    parser.add_argument("--workers", type=int, default=4, help="tasks planned concurrently")
+    parser.add_argument("--rate", type=float, default=None, help="max Messages API requests/sec")
+    parser.add_argument("--burst", type=int, default=None, help="requests allowed at once (default: workers)")
+    args = parser.parse_args()
+    # one pooled connection per worker
+    configure_http_client(pool_size=max(args.workers, 1))
+    compiled, report = compile_tasks(load_tasks(args.tasks), planner=args.planner, workers=args.workers,
+                                     rate=args.rate, burst=args.burst)
+    save_compiled_plans(compiled, args.output)
+    print(f"Compiled {report['compiled']}/{report['tasks']} tasks in {report['secs']:.2f} secs "
+          f"({report['tasks_per_sec']:.2f} tasks/sec, {report.get('round_trips', 0)} requests, "
+          f"{report['rate_limit_wait_secs']:.2f} secs waiting on the rate limit) into {args.output}")
+    for task in compiled["failed"]:
+        print(f"Failed: {task}")
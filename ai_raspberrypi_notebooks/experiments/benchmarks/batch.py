@@ -0,0 +1,62 @@
+# Throughput of the batch planner with 1 vs N workers against the stub server
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.batch --latency 0.3 --workers 1 4 8 --rate 10
+#
+# Every scripted task is compiled with `compile_tasks`; the compiled steps are checked against
+# the script so that concurrency cannot silently mix up the conversations.
+
+import os
+import argparse
+from experiments import motor_control
+from experiments.stub_server import StubServer, ScriptedResponder, load_scripts
+from experiments.motor_control import planners
+from experiments.http_client import configure_http_client
+from experiments.batch import compile_tasks
+from experiments.plan_cache import normalize_task
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+
+
+def count_mismatches(compiled, scripts):
+    mismatches = 0
+    for script in scripts:
+        plan = compiled["plans"].get(normalize_task(script["task"]))
+        actions = [step["Action"] for step in plan["steps"]] if plan else None
+        if actions != [step["Action"] for step in script["steps"]]:
+            mismatches += 1
+    return mismatches
+
+
+def benchmark(scripts, workers=(1, 4), planner="iterative", latency=0.0, rate=None, burst=None):
+    tasks = [script["task"] for script in scripts]
+    rows = []
+    with StubServer(responder=ScriptedResponder(scripts), latency=latency) as server:
+        motor_control.API_URL = server.url
+        for n in workers:
+            motor_control.cache.clear()
+            configure_http_client(pool_size=n)
+            compiled, report = compile_tasks(tasks, planner=planner, workers=n, rate=rate, burst=burst,
+                                             progress=False)
+            rows.append(dict(workers=n, mismatches=count_mismatches(compiled, scripts), **report))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=TASKS_FILE, help="JSONL file of scripted tasks")
+    parser.add_argument("--planner", choices=sorted(planners), default="iterative")
+    parser.add_argument("--latency", type=float, default=0.2, help="injected latency in secs per request")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--rate", type=float, default=None, help="max requests/sec")
+    parser.add_argument("--burst", type=int, default=None)
+    args = parser.parse_args()
+    rows = benchmark(load_scripts(args.tasks), workers=args.workers, planner=args.planner,
+                     latency=args.latency, rate=args.rate, burst=args.burst)
+    print(f"\n{'workers':>7} {'tasks':>5} {'secs':>7} {'tasks/s':>8} {'speedup':>8} {'requests':>8} "
+          f"{'rl_wait_s':>9} {'mismatch':>8}")
+    for row in rows:
+        print(f"{row['workers']:>7} {row['tasks']:>5} {row['secs']:>7.2f} {row['tasks_per_sec']:>8.2f} "
+              f"{rows[0]['secs'] / row['secs']:>7.2f}x {row.get('round_trips', 0):>8} "
+              f"{row['rate_limit_wait_secs']:>9.2f} {row['mismatches']:>8}")
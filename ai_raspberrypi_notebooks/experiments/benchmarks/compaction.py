@@ -0,0 +1,94 @@
+# History compaction of the iterative planner on long synthetic "dance" tasks: whether the
+# plan is complete, round trips, input tokens per task, and the largest prompt of the task
+# (which grows with the steps unless the history is compacted)
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.compaction --steps 8 16 32 --keep-last 2
+#
+# "default" is the planner as configured by default (10 iterations, full history), "full" has
+# enough iterations for every step and "compact" also lists only the last `--keep-last` steps.
+# The state lines of a few plans (timed and free-running moves) are checked as well.
+
+import random
+import argparse
+from experiments import motor_control
+from experiments.stub_server import StubServer, ScriptedResponder
+from experiments.motor_control import get_motor_funcs, get_action_steps, summarize_steps
+
+
+MOVES = [
+    ("turn left", dict(name="run_for_degrees", degrees=90, speed=-50, blocking=False)),
+    ("turn right", dict(name="run_for_degrees", degrees=90, speed=50, blocking=False)),
+    ("go forward", dict(name="run_for_rotations", rotations=1, speed=50, blocking=False)),
+    ("go backward", dict(name="run_for_rotations", rotations=1, speed=-50, blocking=False)),
+    ("spin for a second", dict(name="run_for_seconds", seconds=1, speed=75, blocking=False)),
+    ("face front", dict(name="run_to_position", degrees=0, speed=50, blocking=True)),
+]
+
+
+# (actions, what the state line must say)
+STATE_CHECKS = [
+    ([dict(name="run_for_seconds", seconds=3, speed=75)], "default motor about +4050 degrees from the start"),
+    ([dict(name="run_for_seconds", seconds=3, speed=75), dict(name="start", speed=50)],
+     "default motor running at speed 50 (position unknown)"),
+    ([dict(name="start", speed=50), dict(name="stop"), dict(name="run_for_degrees", degrees=90, speed=-50)],
+     "default motor ran freely, then turned -90 degrees (position unknown)"),
+    ([dict(name="run_to_position", degrees=90, speed=50), dict(name="run_for_rotations", rotations=1, port="B")],
+     "default motor +0 degrees from the position 90; B motor +360 degrees from the start"),
+]
+
+
+def check_states():
+    """ Returns (state line, whether it says what was expected) of each of `STATE_CHECKS` """
+    results = []
+    for actions, expected in STATE_CHECKS:
+        state = summarize_steps([{"Action": action} for action in actions])
+        results.append((state, expected in state))
+    return results
+
+
+def make_dance(n, rand):
+    """ Script of a task of `n` moves """
+    moves = [rand.choice(MOVES) for i in range(n)]
+    task = "Dance: " + ", ".join(phrase for phrase, action in moves) + "."
+    steps = [{"Thought": f"Move {i + 1} of the dance: {phrase}.", "Action": action}
+             for i, (phrase, action) in enumerate(moves)]
+    return dict(task=task, steps=steps, answer=f"Danced {n} moves.")
+
+
+def benchmark(lengths=(8, 16, 32), keep_last=2, seed=0):
+    rand = random.Random(seed)
+    scripts = [make_dance(n, rand) for n in lengths]
+    _, funcs = get_motor_funcs(dummy=True)
+    configs = {
+        "default": {},
+        "full": dict(iterations=max(lengths) + 2),
+        "compact": dict(iterations=max(lengths) + 2, keep_last=keep_last),
+    }
+    results = []
+    with StubServer(responder=ScriptedResponder(scripts)) as server:
+        motor_control.API_URL = server.url
+        for script in scripts:
+            for label, options in configs.items():
+                motor_control.cache.clear()
+                metrics = {}
+                steps, answer, messages = get_action_steps(script["task"], funcs, metrics=metrics, **options)
+                results.append(dict(metrics, steps=len(steps), config=label, n=len(script["steps"]),
+                                    correct=[step["Action"] for step in steps] == [s["Action"] for s in script["steps"]]
+                                    and answer == script["answer"]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, nargs="+", default=[8, 16, 32], help="moves of the synthetic tasks")
+    parser.add_argument("--keep-last", type=int, default=2, help="steps listed verbatim in the compacted prompt")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    results = benchmark(args.steps, keep_last=args.keep_last, seed=args.seed)
+    print(f"\n{'moves':>5} {'config':>8} {'steps':>5} {'trips':>5} {'in_tok':>7} {'max_in':>7} {'saved':>7} {'ok':>3}")
+    for row in results:
+        print(f"{row['n']:>5} {row['config']:>8} {row['steps']:>5} {row['round_trips']:>5} {row['prompt_tokens']:>7} "
+              f"{row['max_prompt_tokens']:>7} {row.get('saved_prompt_tokens', 0):>7} {'y' if row['correct'] else 'n':>3}")
+    print()
+    for state, ok in check_states():
+        print(f"{'y' if ok else 'n'} {state}")
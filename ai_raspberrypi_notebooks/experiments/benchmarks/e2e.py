@@ -0,0 +1,233 @@
+# End-to-end benchmark of the voice loop against local stand-in servers
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.e2e --llm-latency 0.4 --audio-latency 0.3 --output results.json
+#   python -m experiments.benchmarks.e2e ... --compare results.json
+#
+# Each utterance of the corpus is replayed through `get_audio_instruction` (VAD capture from
+# the WAV file), `transcribe`, the planner, `invoke_tool` and the text-to-speech of the final
+# answer. The Messages endpoint and the OpenAI audio endpoints are `StubServer`s, so the
+# timings are those of this code plus the injected latencies.
+#
+# The corpus is a directory with a `manifest.jsonl` of {"wav": file name, "transcript": text};
+# the transcript is what the transcription stand-in answers and must be a task of the
+# scripted plans. Without `--corpus`, synthetic utterances are generated for the scripted tasks.
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import functools
+import subprocess
+import numpy as np
+from openai import OpenAI
+from experiments import motor_control, audio_control
+from experiments.stub_server import StubServer, ScriptedResponder, load_scripts
+from experiments.motor_control import get_motor_funcs, invoke_tool, planners
+from experiments.audio_capture import WavInputStream
+from experiments.audio_encoding import ENCODINGS, float_to_int16, write_wav
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+STAGES = ["capture", "transcribe", "plan", "execute", "speak", "turn"]
+
+
+def make_fixtures(path, scripts, samplerate=16000, seed=0):
+    """ Writes a synthetic utterance (noise bursts at syllable rate) per scripted task """
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "manifest.jsonl"), "w") as f:
+        for i, script in enumerate(scripts):
+            secs = 0.06 * len(script["task"])
+            t = np.arange(int(secs * samplerate)) / samplerate
+            envelope = 0.5 * (1 - np.cos(2 * np.pi * 4 * t))  # ~4 syllables per second
+            speech = 0.3 * envelope * rng.standard_normal(len(t))
+            silence = np.zeros(int(0.3 * samplerate))
+            recording = np.concatenate([silence, speech, silence]).astype(np.float32)
+            name = f"utterance_{i:02d}.wav"
+            with open(os.path.join(path, name), "wb") as wav:
+                write_wav(wav, float_to_int16(recording), samplerate)
+            f.write(json.dumps({"wav": name, "transcript": script["task"]}) + "\n")
+
+
+def load_corpus(path):
+    with open(os.path.join(path, "manifest.jsonl")) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    return [dict(item, wav=os.path.join(path, item["wav"])) for item in items]
+
+
+class ReplayTranscriber:
+    """ Answers transcription requests with the transcript of the utterance being replayed """
+
+    def __init__(self):
+        self.transcript = ""
+
+    def __call__(self, body):
+        return self.transcript
+
+
+class NullOutputStream:
+    """ `sounddevice.OutputStream` stand-in that discards the audio """
+
+    def __init__(self, **kwargs):
+        self.frames = 0
+
+    def write(self, data):
+        self.frames += len(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(timings, stage, f, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def run_utterance(item, funcs, dummy_funcs, planner, encoding, stream_tts, realtime):
+    timings = {}
+    start = time.perf_counter()
+    factory = functools.partial(WavInputStream, item["wav"], realtime=realtime)
+    byte_stream = timed(timings, "capture", audio_control.get_audio_instruction, duration=10, vad=True,
+                        stream_factory=factory, encoding=encoding)
+    task = timed(timings, "transcribe", audio_control.transcribe, byte_stream)
+    metrics = {}
+    steps, answer, messages = timed(timings, "plan", planners[planner], task, funcs=dummy_funcs, metrics=metrics)
+
+    def execute():
+        for step in steps:
+            if not step["Action"].get("error"):
+                invoke_tool(step["Action"], funcs)
+    timed(timings, "execute", execute)
+    if answer:
+        if stream_tts:
+            timed(timings, "speak", audio_control.stream_speech, answer, output_stream_factory=NullOutputStream)
+        else:
+            timed(timings, "speak", audio_control.text_to_speech, answer)
+    timings["turn"] = time.perf_counter() - start
+    return dict(task=task, steps=len(steps), timings=timings, round_trips=metrics.get("round_trips", 0),
+                prompt_tokens=metrics.get("prompt_tokens", 0))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return dict(p50=float(p50), p95=float(p95), p99=float(p99), n=len(values))
+
+
+def benchmark(corpus, scripts, planner="iterative", llm_latency=0.0, audio_latency=0.0, stream_delay=0.0,
+              encoding=None, stream_tts=False, realtime=False, repeat=1, motor="dummy"):
+    transcriber = ReplayTranscriber()
+    if motor == "sim":
+        _, funcs = get_motor_funcs(dummy="sim", time_scale=0.01)
+    else:
+        _, funcs = get_motor_funcs(dummy=True)
+    _, dummy_funcs = get_motor_funcs(dummy=True)
+    rows = []
+    with StubServer(responder=ScriptedResponder(scripts), latency=llm_latency, stream_delay=stream_delay) as llm, \
+            StubServer(transcriber=transcriber, latency=audio_latency, stream_delay=stream_delay) as audio:
+        motor_control.API_URL = llm.url
+        audio_control.client = OpenAI(api_key="stub", base_url=audio.base_url, max_retries=0)
+        for i in range(repeat):
+            for item in corpus:
+                motor_control.cache.clear()
+                transcriber.transcript = item["transcript"]
+                llm_before, audio_before = llm.stats.as_dict(), audio.stats.as_dict()
+                row = run_utterance(item, funcs, dummy_funcs, planner, encoding, stream_tts, realtime)
+                llm_after, audio_after = llm.stats.as_dict(), audio.stats.as_dict()
+                row.update(
+                    llm_requests=llm_after["requests"] - llm_before["requests"],
+                    audio_requests=audio_after["requests"] - audio_before["requests"],
+                    bytes_up=(llm_after["bytes_in"] - llm_before["bytes_in"]
+                              + audio_after["bytes_in"] - audio_before["bytes_in"]),
+                    bytes_down=(llm_after["bytes_out"] - llm_before["bytes_out"]
+                                + audio_after["bytes_out"] - audio_before["bytes_out"]),
+                )
+                rows.append(row)
+    return rows
+
+
+def summarize(rows):
+    stages = {stage: percentiles([row["timings"][stage] for row in rows if stage in row["timings"]])
+              for stage in STAGES}
+    n = len(rows) or 1
+    return dict(
+        stages=stages,
+        tasks=len(rows),
+        round_trips_per_task=sum(row["llm_requests"] + row["audio_requests"] for row in rows) / n,
+        llm_round_trips_per_task=sum(row["llm_requests"] for row in rows) / n,
+        bytes_up_per_task=sum(row["bytes_up"] for row in rows) / n,
+        bytes_down_per_task=sum(row["bytes_down"] for row in rows) / n,
+    )
+
+
+def print_summary(summary, baseline=None):
+    print(f"\n{'stage':<12} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9}" + (f" {'p50_delta':>10}" if baseline else ""))
+    for stage, p in summary["stages"].items():
+        if p is None:
+            continue
+        line = f"{stage:<12} {p['p50'] * 1e3:>9.1f} {p['p95'] * 1e3:>9.1f} {p['p99'] * 1e3:>9.1f}"
+        if baseline and (b := baseline["summary"]["stages"].get(stage)):
+            line += f" {(p['p50'] - b['p50']) / b['p50']:>+10.1%}" if b["p50"] else ""
+        print(line)
+    print(f"tasks: {summary['tasks']}, round trips/task: {summary['round_trips_per_task']:.2f} "
+          f"(LLM {summary['llm_round_trips_per_task']:.2f}), bytes/task: "
+          f"{summary['bytes_up_per_task']:.0f} up, {summary['bytes_down_per_task']:.0f} down")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None, help="directory with manifest.jsonl and WAV files")
+    parser.add_argument("--tasks", default=TASKS_FILE, help="JSONL file of scripted plans")
+    parser.add_argument("--planner", choices=sorted(planners), default="iterative")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="injected secs per Messages request")
+    parser.add_argument("--audio-latency", type=float, default=0.0, help="injected secs per audio request")
+    parser.add_argument("--stream-delay", type=float, default=0.0, help="secs between streamed chunks")
+    parser.add_argument("--encoding", choices=sorted(ENCODINGS), default=None)
+    parser.add_argument("--stream-tts", action="store_true")
+    parser.add_argument("--realtime", action="store_true", help="replay the utterances at the real audio rate")
+    parser.add_argument("--motor", choices=["dummy", "sim"], default="dummy")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", default=None, help="save the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    scripts = load_scripts(args.tasks)
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            corpus_dir = tmp
+            make_fixtures(corpus_dir, scripts)
+        rows = benchmark(load_corpus(corpus_dir), scripts, planner=args.planner, llm_latency=args.llm_latency,
+                         audio_latency=args.audio_latency, stream_delay=args.stream_delay,
+                         encoding=args.encoding, stream_tts=args.stream_tts, realtime=args.realtime,
+                         repeat=args.repeat, motor=args.motor)
+    summary = summarize(rows)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Comparing with {args.compare} (commit {baseline.get('commit')})")
+    print_summary(summary, baseline)
+    if args.output:
+        config = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        results = dict(commit=get_git_commit(), created=time.time(), config=config, summary=summary, rows=rows)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
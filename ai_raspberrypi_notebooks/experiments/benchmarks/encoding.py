@@ -0,0 +1,63 @@
+# Upload size and encode time of each audio encoding against the 44.1 kHz WAV upload
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.encoding [path/to/utterance.wav ...]
+#
+# Compressed formats need ffmpeg for pydub. Without WAV files, 4 secs of synthetic
+# speech-like audio is used.
+
+import time
+import argparse
+from io import BytesIO
+import numpy as np
+import wavio as wv
+from experiments.audio_capture import read_wav
+from experiments.audio_encoding import encode_audio, resample, ENCODINGS
+
+
+def synthetic_recording(samplerate=44100, secs=4.0):
+    t = np.arange(int(samplerate * secs)) / samplerate
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 3 * t))
+    voice = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate([140, 280, 420, 700, 1100], start=1))
+    noise = np.random.default_rng(0).normal(scale=0.01, size=t.shape)
+    return (0.2 * envelope * voice + noise).astype(np.float32).reshape(-1, 1)
+
+
+def legacy_wav_bytes(recording, samplerate):
+    start = time.perf_counter()
+    byte_stream = BytesIO()
+    wv.write(byte_stream, recording, samplerate, sampwidth=2)
+    return byte_stream.getbuffer().nbytes, time.perf_counter() - start
+
+
+def benchmark(recording, samplerate):
+    baseline, secs = legacy_wav_bytes(recording, samplerate)
+    rows = [dict(format=f"wav@{samplerate}", bytes=baseline, encode_secs=secs, ratio=1.0)]
+    encode_audio(recording[:samplerate], samplerate, fmt="wav")  # warm up the resampler import
+    for fmt in ENCODINGS:
+        try:
+            byte_stream, stats = encode_audio(recording, samplerate, fmt=fmt)
+        except Exception as e:
+            print(f"Failed to encode {fmt}: {e}")
+            continue
+        rows.append(dict(format=f"{fmt}@{stats['samplerate']}", bytes=stats["bytes"],
+                         encode_secs=stats["encode_secs"], ratio=baseline / stats["bytes"]))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", help="16-bit PCM WAV files")
+    args = parser.parse_args()
+    inputs = [("synthetic", synthetic_recording(), 44100)]
+    if args.paths:
+        inputs = []
+        for path in args.paths:
+            frames, rate = read_wav(path)
+            if rate != 44100:
+                frames = resample(frames, rate, 44100)
+            inputs.append((path, frames, 44100))
+    for label, recording, samplerate in inputs:
+        print(f"{label} ({len(recording) / samplerate:.2f} secs):")
+        for r in benchmark(recording, samplerate):
+            print(f"  {r['format']:>12}: {r['bytes']:>8} bytes, {r['encode_secs'] * 1000:7.2f} ms, "
+                  f"{r['ratio']:5.1f}x smaller")
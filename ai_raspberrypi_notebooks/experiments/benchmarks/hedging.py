@@ -0,0 +1,77 @@
+# Planning latency percentiles with and without hedged requests, against a stub server with
+# a slow tail and invalid answers
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.hedging --latency 0.2 --tail-rate 0.05 --tail-latency 2 --invalid-rate 0.03
+#
+# Both runs see the same sequence of slow and invalid answers (same seed). A task fails if
+# its plan does not match the script.
+
+import os
+import argparse
+import numpy as np
+from experiments import motor_control
+from experiments.stub_server import StubServer, ScriptedResponder, load_scripts
+from experiments.motor_control import get_motor_funcs, planners
+from experiments.hedging import configure_hedging
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+
+
+def run(scripts, hedge, planner="iterative", repeat=5, hedge_model=None, percentile=90, seed=0, **stub_options):
+    _, dummy_funcs = get_motor_funcs(dummy=True)
+    hedger = configure_hedging(enabled=hedge, hedge_model=hedge_model, percentile=percentile,
+                               initial_deadline=1.0)
+    secs = []
+    failed = 0
+    try:
+        with StubServer(responder=ScriptedResponder(scripts), seed=seed, **stub_options) as server:
+            motor_control.API_URL = server.url
+            for i in range(repeat):
+                for script in scripts:
+                    motor_control.cache.clear()
+                    metrics = {}
+                    steps, answer, messages = planners[planner](script["task"], funcs=dummy_funcs, metrics=metrics)
+                    secs.append(metrics["secs"])
+                    if [step["Action"] for step in steps] != [step["Action"] for step in script["steps"]]:
+                        failed += 1
+            requests = server.stats.requests
+    finally:
+        configure_hedging(enabled=False)
+    p50, p95, p99 = np.percentile(secs, [50, 95, 99])
+    row = dict(hedge=hedge, tasks=len(secs), failed=failed, requests=requests, p50=p50, p95=p95, p99=p99)
+    if hedger is not None:
+        row.update(hedger.report())
+    return row
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=TASKS_FILE, help="JSONL file of scripted tasks")
+    parser.add_argument("--planner", choices=["iterative", "compact"], default="iterative")
+    parser.add_argument("--latency", type=float, default=0.2, help="injected latency in secs per request")
+    parser.add_argument("--tail-rate", type=float, default=0.05, help="fraction of slow requests")
+    parser.add_argument("--tail-latency", type=float, default=2.0, help="extra secs of slow requests")
+    parser.add_argument("--invalid-rate", type=float, default=0.03, help="fraction of invalid answers")
+    parser.add_argument("--hedge-model", default=None, help="model of the hedge requests")
+    parser.add_argument("--hedge-latency", type=float, default=None,
+                        help="injected latency in secs of the hedge model")
+    parser.add_argument("--percentile", type=int, default=90)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    model_latency = {args.hedge_model: args.hedge_latency} if args.hedge_model and args.hedge_latency is not None else {}
+    scripts = load_scripts(args.tasks)
+    rows = [run(scripts, hedge, planner=args.planner, repeat=args.repeat, hedge_model=args.hedge_model,
+                percentile=args.percentile, seed=args.seed, latency=args.latency, tail_rate=args.tail_rate,
+                tail_latency=args.tail_latency, invalid_rate=args.invalid_rate, model_latency=model_latency)
+            for hedge in (False, True)]
+    print(f"\n{'hedge':<6} {'tasks':>5} {'failed':>6} {'requests':>8} {'p50_s':>7} {'p95_s':>7} {'p99_s':>7}")
+    for row in rows:
+        print(f"{str(row['hedge']):<6} {row['tasks']:>5} {row['failed']:>6} {row['requests']:>8} "
+              f"{row['p50']:>7.3f} {row['p95']:>7.3f} {row['p99']:>7.3f}")
+    hedged = rows[1]
+    print(f"hedge rate: {hedged['hedge_rate']:.1%} of {hedged['calls']} calls, hedge wins: {hedged['hedge_wins']}, "
+          f"invalid answers: {hedged['invalid']}, extra tokens: {hedged['extra_tokens']} "
+          f"({hedged['extra_token_rate']:.1%}), extra requests: {hedged['requests'] / rows[0]['requests'] - 1:+.1%}")
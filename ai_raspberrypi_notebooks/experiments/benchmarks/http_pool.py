@@ -0,0 +1,58 @@
+# Compares a fresh `requests.Session` per call against the pooled keep-alive client
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.http_pool --calls 20 --latency 0.05 --connect-latency 0.15
+
+import time
+import argparse
+import statistics
+from experiments.stub_server import StubServer
+from experiments.http_client import make_http_session, get_http_session, close_http_client
+from experiments.motor_control import call_http_endpoint
+
+
+def run_calls(url, calls, fresh_session):
+    data = {"model": "stub", "max_tokens": 16, "messages": [{"role": "user", "content": "Hello"}]}
+    secs = []
+    for i in range(calls):
+        start = time.perf_counter()
+        session = make_http_session() if fresh_session else get_http_session()
+        try:
+            status, resp = call_http_endpoint(data=data, url=url, api_key="stub", api_ver="2023-06-01",
+                                              session=session)
+        finally:
+            if fresh_session:
+                session.close()
+        secs.append(time.perf_counter() - start)
+        if status != 200:
+            print(f"Unexpected status: {status}")
+    return secs
+
+
+def benchmark(calls=20, latency=0.0, connect_latency=0.0):
+    results = {}
+    for label, fresh in [("fresh_session", True), ("pooled", False)]:
+        close_http_client()
+        with StubServer(latency=latency, connect_latency=connect_latency) as server:
+            secs = run_calls(server.url, calls, fresh_session=fresh)
+            stats = server.stats.as_dict()
+        results[label] = dict(
+            mean_secs=statistics.mean(secs),
+            p50_secs=statistics.median(secs),
+            max_secs=max(secs),
+            connections=stats["connections"],
+            requests=stats["requests"],
+        )
+    close_http_client()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    results = benchmark(calls=args.calls, latency=args.latency, connect_latency=args.connect_latency)
+    for label, r in results.items():
+        print(f"{label:>14}: mean {r['mean_secs'] * 1000:.2f} ms, p50 {r['p50_secs'] * 1000:.2f} ms, "
+              f"max {r['max_secs'] * 1000:.2f} ms, connections {r['connections']} for {r['requests']} requests")
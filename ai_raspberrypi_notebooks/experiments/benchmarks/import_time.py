@@ -0,0 +1,60 @@
+# Import time budget of the control entry point
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.import_time --budget 0.5
+#
+# Imports `experiments.control` in fresh interpreters with `-X importtime`, reports the best
+# cumulative time and the slowest modules, and exits with status 1 if the time is over
+# `--budget` secs or if any of the heavy modules that are only needed on first use
+# (openai, sounddevice, pydub, ...) was imported.
+
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Imported where they are used, never at startup
+DEFERRED_MODULES = ("openai", "requests", "urllib3", "scipy", "pydub", "sounddevice", "wavio", "buildhat")
+
+
+def parse_importtime(stderr):
+    """ Returns {module: (self secs, cumulative secs)} from the `-X importtime` output """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return times
+
+
+def measure(module="experiments.control"):
+    code = f"import sys, json; import {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True,
+                            text=True, check=True)
+    return parse_importtime(result.stderr), json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="experiments.control")
+    parser.add_argument("--budget", type=float, default=0.5, help="max cumulative import secs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to print")
+    args = parser.parse_args()
+    runs = [measure(args.module) for i in range(args.repeat)]
+    times, modules = min(runs, key=lambda run: run[0][args.module][1])
+    secs = times[args.module][1]
+    print(f"{'module':<40} {'self_ms':>8} {'cumul_ms':>9}")
+    for name, (self_secs, cumulative_secs) in sorted(times.items(), key=lambda kv: -kv[1][0])[:args.top]:
+        print(f"{name:<40} {self_secs * 1e3:>8.1f} {cumulative_secs * 1e3:>9.1f}")
+    deferred = sorted({m.split(".")[0] for m in modules} & set(DEFERRED_MODULES))
+    print(f"\nimport {args.module}: {secs:.3f} secs (best of {args.repeat}), budget {args.budget:.3f} secs")
+    failed = False
+    if secs > args.budget:
+        print("FAILED: over budget")
+        failed = True
+    if deferred:
+        print(f"FAILED: imported at startup: {', '.join(deferred)}")
+        failed = True
+    sys.exit(1 if failed else 0)
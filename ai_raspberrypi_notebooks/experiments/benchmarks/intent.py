@@ -0,0 +1,87 @@
+# Accuracy and latency of the rule-based fast path over a corpus of recorded transcripts
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.intent
+#
+# Each line of the corpus has a `transcript` and the `expected` actions, or null when the
+# fast path should defer to the LLM. A compiled plan that differs from `expected` is a
+# false accept, which is the error that matters: it would run the wrong motion. Tasks that
+# only differ by their ports must also get different plan cache keys.
+
+import os
+import json
+import time
+import argparse
+import statistics
+from experiments.intent import compile_task
+from experiments.plan_cache import normalize_task
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TRANSCRIPTS_FILE = os.path.join(DATA_DIR, "transcripts.jsonl")
+# tasks that must not share a plan cache key
+DISTINCT_TASKS = [
+    ("Spin motors A and B forward", "Spin motors B forward"),
+    ("Run motor A for 2 seconds", "Run motor for 2 seconds"),
+]
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def benchmark(corpus, repeat=100):
+    rows = []
+    for item in corpus:
+        compiled = None
+        secs = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            compiled = compile_task(item["transcript"])
+            secs.append(time.perf_counter() - start)
+        actions = [step["Action"] for step in compiled[0]] if compiled else None
+        expected = item.get("expected")
+        if actions is None:
+            outcome = "deferred" if expected is None else "missed"
+        else:
+            outcome = "correct" if actions == expected else "false_accept"
+        rows.append(dict(transcript=item["transcript"], outcome=outcome, actions=actions,
+                         secs=statistics.median(secs)))
+    return rows
+
+
+def summarize(rows):
+    counts = {k: 0 for k in ["correct", "deferred", "missed", "false_accept"]}
+    for row in rows:
+        counts[row["outcome"]] += 1
+    compilable = counts["correct"] + counts["missed"] + counts["false_accept"]
+    secs = [row["secs"] for row in rows]
+    return dict(
+        counts,
+        total=len(rows),
+        coverage=(counts["correct"] / compilable) if compilable else 0.0,
+        accuracy=(counts["correct"] + counts["deferred"]) / len(rows) if rows else 0.0,
+        p50_usecs=statistics.median(secs) * 1e6,
+        max_usecs=max(secs) * 1e6,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=TRANSCRIPTS_FILE)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    rows = benchmark(load_corpus(args.corpus), repeat=args.repeat)
+    for row in rows:
+        if args.verbose or row["outcome"] in ("missed", "false_accept"):
+            print(f"{row['outcome']:>12}: {row['transcript']} -> {row['actions']}")
+    summary = summarize(rows)
+    print(f"transcripts: {summary['total']}, correct: {summary['correct']}, deferred: {summary['deferred']}, "
+          f"missed: {summary['missed']}, false accepts: {summary['false_accept']}")
+    print(f"coverage of compilable commands: {summary['coverage']:.1%}, overall accuracy: {summary['accuracy']:.1%}")
+    print(f"compile latency: p50 {summary['p50_usecs']:.1f} usecs, max {summary['max_usecs']:.1f} usecs")
+    collisions = [pair for pair in DISTINCT_TASKS if normalize_task(pair[0]) == normalize_task(pair[1])]
+    for first, second in collisions:
+        print(f"same plan cache key: {first!r} and {second!r} -> {normalize_task(first)!r}")
+    print(f"plan cache key collisions: {len(collisions)}/{len(DISTINCT_TASKS)}")
@@ -0,0 +1,44 @@
+# Cost per recorded span, counter and histogram observation of `experiments.metrics`
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.metrics_overhead
+
+import os
+import time
+import argparse
+import tempfile
+from experiments.metrics import Metrics, JSONLSink
+
+
+def per_call_usecs(f, n):
+    start = time.perf_counter()
+    for i in range(n):
+        f()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def benchmark(n=100000):
+    metrics = Metrics()
+
+    def span():
+        with metrics.span("stage", tool="run_for_degrees"):
+            pass
+
+    rows = dict(
+        empty_loop=per_call_usecs(lambda: None, n),
+        incr=per_call_usecs(lambda: metrics.incr("hits"), n),
+        observe=per_call_usecs(lambda: metrics.observe("secs", 0.01), n),
+        span=per_call_usecs(span, n),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics.sink = JSONLSink(os.path.join(tmp, "metrics.jsonl"))
+        rows["span_with_jsonl_sink"] = per_call_usecs(span, n)
+        metrics.sink.close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000)
+    args = parser.parse_args()
+    for name, usecs in benchmark(args.n).items():
+        print(f"{name:<22} {usecs:8.2f} usecs/call")
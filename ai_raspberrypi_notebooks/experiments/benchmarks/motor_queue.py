@@ -0,0 +1,105 @@
+# Motor command queues on simulated motors: how long the voice loop is held up, whether
+# queued plans (including one ending with a "stop" step) end where the sequential ones do,
+# and how fast a new command preempts the queued motion by making the motor coast
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.motor_queue --time-scale 0.2
+
+import time
+import argparse
+from experiments.motor_control import get_port_funcs, invoke_tool
+from experiments.motor_queue import attach_queues, preempt_queues
+
+
+PLAN = [
+    dict(name="run_for_degrees", degrees=90, speed=-50, blocking=True),
+    dict(name="run_for_rotations", rotations=1, speed=50, blocking=False),
+    dict(name="run_to_position", degrees=90, speed=30, blocking=False),
+    dict(name="run_for_seconds", seconds=0.5, speed=40, blocking=True),
+    dict(name="run_for_degrees", degrees=45, speed=50, blocking=False),
+]
+STOP_PLAN = [
+    dict(name="run_for_degrees", degrees=90, speed=50, blocking=False),
+    dict(name="run_for_degrees", degrees=90, speed=50, blocking=False),
+    dict(name="stop"),
+]
+LONG_MOVE = dict(rotations=2, speed=20)  # run_for_rotations for 2 secs
+
+
+def sim(time_scale):
+    return get_port_funcs(("A",), dummy="sim", time_scale=time_scale)
+
+
+def run_plan(funcs, motor, plan=PLAN):
+    """ Returns (secs invoke_tool held the caller, secs until the motor finished) """
+    start = time.perf_counter()
+    for action in plan:
+        invoke_tool(action, funcs)
+    held = time.perf_counter() - start
+    motor.wait_idle()
+    return held, time.perf_counter() - start
+
+
+def serialization(time_scale, plan=PLAN):
+    motors, funcs = sim(time_scale)
+    direct_held, direct_secs = run_plan(funcs, motors["A"], plan)
+    direct_position = motors["A"].get_position()
+    motors, funcs = sim(time_scale)
+    queues, queued_funcs = attach_queues(motors, funcs)
+    start = time.perf_counter()
+    for action in plan:
+        invoke_tool(action, queued_funcs)
+    queued_held = time.perf_counter() - start
+    queues["A"].wait_idle()
+    queued_secs = time.perf_counter() - start
+    report = queues["A"].report()
+    queues["A"].close()
+    return dict(direct_held=direct_held, direct_secs=direct_secs, direct_position=direct_position,
+                queued_held=queued_held, queued_secs=queued_secs, queued_position=motors["A"].get_position(),
+                report=report)
+
+
+def preemption(time_scale, coast=True, moves=5, after=0.3):
+    """ Queues `moves` long moves, then preempts them for a new command after `after` secs, making
+    the motor coast (or, without `coast`, only cancelling the moves waiting to start)
+    """
+    motors, funcs = sim(time_scale)
+    queues, queued_funcs = attach_queues(motors, funcs)
+    futures = [queues["A"].submit("run_for_rotations", LONG_MOVE) for i in range(moves)]
+    time.sleep(after)
+    start = time.perf_counter()
+    preempt_queues(queues, stop=coast)
+    # the next command only waits for the interrupted move to return
+    next_future = queues["A"].submit("run_for_degrees", dict(degrees=10, speed=50))
+    futures[0].exception()  # the move in progress returns once the motor is released
+    stopped = time.perf_counter() - start
+    next_future.result()
+    report = queues["A"].report()
+    queues["A"].close()
+    expected = LONG_MOVE["rotations"] * 360 * moves + 10
+    return dict(by=("coast" if coast else "cancel only"), stop_secs=stopped,
+                cancelled=sum(future.cancelled() for future in futures), position=motors["A"].get_position(),
+                unpreempted_position=expected, report=report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--time-scale", type=float, default=0.2, help="scale of the simulated motor times")
+    args = parser.parse_args()
+
+    print(f"\n{'plan':<5} {'execution':<10} {'held_ms':>8} {'motion_s':>9} {'position':>9}")
+    for label, plan in (("mixed", PLAN), ("stop", STOP_PLAN)):
+        row = serialization(args.time_scale, plan)
+        print(f"{label:<5} {'direct':<10} {row['direct_held'] * 1e3:>8.1f} {row['direct_secs']:>9.2f} "
+              f"{row['direct_position']:>9}")
+        print(f"{label:<5} {'queued':<10} {row['queued_held'] * 1e3:>8.1f} {row['queued_secs']:>9.2f} "
+              f"{row['queued_position']:>9}")
+        report = row["report"]
+        print(f"queue: max depth {report['max_depth']}, wait p50 {report['wait_p50'] * 1e3:.1f} ms, "
+              f"p95 {report['wait_p95'] * 1e3:.1f} ms, max {report['wait_max'] * 1e3:.1f} ms")
+
+    print(f"\n{'preempted by':<12} {'stop_ms':>8} {'cancelled':>9} {'position':>9} {'without':>8} {'next_wait_ms':>12}")
+    for coast in (True, False):
+        row = preemption(args.time_scale, coast=coast)
+        waits = row["report"]
+        print(f"{row['by']:<12} {row['stop_secs'] * 1e3:>8.1f} {row['cancelled']:>9} {row['position']:>9} "
+              f"{row['unpreempted_position']:>8} {waits['wait_max'] * 1e3:>12.1f}")
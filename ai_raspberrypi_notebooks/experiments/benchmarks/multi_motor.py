@@ -0,0 +1,73 @@
+# Wall time of multi-motor plans executed one step after another vs. concurrently per port
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.multi_motor --time-scale 0.1
+#
+# Runs on simulated motors that take (scaled) real time to move.
+
+import time
+import argparse
+from experiments.motor_control import MOTOR_PORTS, get_port_funcs, invoke_tool
+from experiments.motor_executor import execute_concurrently
+
+
+def step(thought, **action):
+    return {"Thought": thought, "Action": action}
+
+
+PLANS = {
+    "spin both wheels forward": [
+        step("Left wheel forward.", name="run_for_rotations", rotations=2, speed=50, port="A"),
+        step("Right wheel forward.", name="run_for_rotations", rotations=2, speed=50, port="B"),
+    ],
+    "drive forward, then turn left": [
+        step("Left wheel forward.", name="run_for_rotations", rotations=1, speed=50, port="A"),
+        step("Right wheel forward.", name="run_for_rotations", rotations=1, speed=50, port="B"),
+        step("Left wheel back.", name="run_for_degrees", degrees=180, speed=-50, port="A"),
+        step("Right wheel forward.", name="run_for_degrees", degrees=180, speed=50, port="B"),
+    ],
+    "four-wheel drive for 2 rotations": [
+        step(f"Wheel {port} forward.", name="run_for_rotations", rotations=2, speed=75, port=port)
+        for port in MOTOR_PORTS
+    ],
+    "arm to 90 degrees while the base turns": [
+        step("Raise the arm.", name="run_to_position", degrees=90, speed=30, port="C"),
+        step("Turn the base.", name="run_for_degrees", degrees=360, speed=50, port="A"),
+        step("Lower the arm.", name="run_to_position", degrees=0, speed=30, port="C"),
+    ],
+    "single motor (no parallelism)": [
+        step("Turn left.", name="run_for_degrees", degrees=90, speed=-50),
+        step("Turn right.", name="run_for_degrees", degrees=90, speed=50),
+    ],
+}
+
+
+def execute_sequentially(thought_actions, funcs):
+    for thought_action in thought_actions:
+        invoke_tool(dict(thought_action["Action"], blocking=True), funcs)
+
+
+def benchmark(time_scale=0.1, serial_latency=0.005):
+    motors, funcs = get_port_funcs(MOTOR_PORTS, dummy="sim", time_scale=time_scale, serial_latency=serial_latency)
+    rows = []
+    for task, plan in PLANS.items():
+        start = time.perf_counter()
+        execute_sequentially(plan, funcs)
+        sequential = time.perf_counter() - start
+        answer, report = execute_concurrently(plan, funcs)
+        rows.append(dict(task=task, steps=len(plan), ports=len(report["port_secs"]),
+                         sequential_secs=sequential / time_scale, concurrent_secs=report["secs"] / time_scale))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--time-scale", type=float, default=0.1,
+                        help="simulated motion time multiplier (secs below are rescaled to real time)")
+    parser.add_argument("--serial-latency", type=float, default=0.005,
+                        help="simulated secs per command on the serial link")
+    args = parser.parse_args()
+    rows = benchmark(time_scale=args.time_scale, serial_latency=args.serial_latency)
+    print(f"\n{'task':<40} {'steps':>5} {'ports':>5} {'seq_secs':>9} {'conc_secs':>9} {'speedup':>8}")
+    for row in rows:
+        print(f"{row['task']:<40} {row['steps']:>5} {row['ports']:>5} {row['sequential_secs']:>9.2f} "
+              f"{row['concurrent_secs']:>9.2f} {row['sequential_secs'] / row['concurrent_secs']:>7.2f}x")
@@ -0,0 +1,81 @@
+# Commands and estimated motion time saved by the plan optimizer
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.optimizer
+#
+# Optimizes the scripted plans of the task corpus and the fast-path plans of the transcript
+# corpus, executes both versions on `DummyMotor` and checks that the net displacement of
+# the motor is unchanged.
+
+import os
+import json
+import argparse
+from experiments.motor_control import get_motor_funcs, invoke_tool
+from experiments.intent import compile_task
+from experiments.plan_optimizer import optimize_plan, net_displacement
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+TRANSCRIPTS_FILE = os.path.join(DATA_DIR, "transcripts.jsonl")
+
+
+def load_plans(tasks_path, transcripts_path):
+    plans = []
+    with open(tasks_path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                plans.append((item["task"], item["steps"]))
+    with open(transcripts_path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if (compiled := compile_task(item["transcript"])) is not None:
+                    plans.append((item["transcript"], compiled[0]))
+    return plans
+
+
+def execute(steps, funcs):
+    """ Executes the plan on the dummy motor; returns the number of tool calls """
+    calls = 0
+    for step in steps:
+        action = step["Action"]
+        if not action.get("error"):
+            invoke_tool(action, funcs)
+            calls += 1
+    return calls
+
+
+def benchmark(plans, verbose=False):
+    dummy_motor, funcs = get_motor_funcs(dummy=True)
+    rows = []
+    for task, steps in plans:
+        optimized, report = optimize_plan(steps, funcs)
+        calls_before = execute(steps, funcs)
+        calls_after = execute(optimized, funcs)
+        same = net_displacement(steps) == net_displacement(optimized)
+        rows.append(dict(task=task, calls_before=calls_before, calls_after=calls_after,
+                         same_displacement=same, **report))
+        if verbose or report["commands_saved"] or not same:
+            print(f"{task!r}: {report['commands_before']} -> {report['commands_after']} commands, "
+                  f"{report['estimated_secs_saved']:.2f} secs saved"
+                  + ("" if same else ", NET DISPLACEMENT CHANGED"))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=TASKS_FILE)
+    parser.add_argument("--transcripts", default=TRANSCRIPTS_FILE)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    rows = benchmark(load_plans(args.tasks, args.transcripts), verbose=args.verbose)
+    before = sum(row["calls_before"] for row in rows)
+    after = sum(row["calls_after"] for row in rows)
+    secs_before = sum(row["estimated_secs_before"] for row in rows)
+    secs_saved = sum(row["estimated_secs_saved"] for row in rows)
+    print(f"plans: {len(rows)}, optimized: {sum(1 for row in rows if row['commands_saved'])}, "
+          f"displacement changed: {sum(1 for row in rows if not row['same_displacement'])}")
+    print(f"commands: {before} -> {after} ({before - after} saved)")
+    print(f"estimated motion time: {secs_before:.2f} -> {secs_before - secs_saved:.2f} secs "
+          f"({secs_saved:.2f} secs saved)")
@@ -0,0 +1,68 @@
+# Micro-benchmarks of the ReAct completion parser over a corpus of saved completions
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.parser -n 2000
+#
+# The corpus (JSONL of {"kind": "step" | "plan", "text"}) has the completions of the scripted
+# tasks for the iterative and single-shot prompts, and the variants models produce: an invented
+# `Observation` after the action, JSON on the next line or over several lines, invalid actions.
+
+import os
+import json
+import time
+import argparse
+from experiments.motor_control import ReActParser, get_motor_funcs, parse_thought_action, parse_step
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+COMPLETIONS_FILE = os.path.join(DATA_DIR, "completions.jsonl")
+
+
+def load_completions(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def per_completion_usecs(f, texts, n):
+    start = time.perf_counter()
+    for i in range(n):
+        for text in texts:
+            f(text)
+    return (time.perf_counter() - start) / (n * len(texts)) * 1e6
+
+
+def feed_chunks(text, chunk_size=8):
+    parser = ReActParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+    parser.close()
+    return parser
+
+
+def benchmark(completions, n=2000):
+    _, funcs = get_motor_funcs(dummy=True)
+    steps = [c["text"] for c in completions if c["kind"] == "step"]
+    plans = [c["text"] for c in completions if c["kind"] == "plan"]
+    cases = [
+        ("step: parse_thought_action", steps, parse_thought_action),
+        ("step: parse + decode + validate", steps, lambda text: parse_step(text, funcs)),
+        ("plan: parse all entries", plans, ReActParser.parse),
+        ("plan: parse + decode + validate", plans, lambda text: ReActParser.parse(text, funcs=funcs, strict=True)),
+        ("plan: streamed in 8 char chunks", plans, feed_chunks),
+    ]
+    rows = []
+    for name, texts, f in cases:
+        usecs = per_completion_usecs(f, texts, n)
+        chars = sum(len(text) for text in texts) / len(texts)
+        rows.append(dict(name=name, completions=len(texts), usecs=usecs, mb_per_sec=chars / usecs))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--completions", default=COMPLETIONS_FILE, help="JSONL file of saved completions")
+    parser.add_argument("-n", type=int, default=2000, help="passes over the corpus")
+    args = parser.parse_args()
+    rows = benchmark(load_completions(args.completions), n=args.n)
+    print(f"\n{'case':<36} {'n':>4} {'usecs':>8} {'MB/s':>7}")
+    for row in rows:
+        print(f"{row['name']:<36} {row['completions']:>4} {row['usecs']:>8.2f} {row['mb_per_sec']:>7.1f}")
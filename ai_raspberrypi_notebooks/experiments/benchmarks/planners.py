@@ -0,0 +1,60 @@
+# Compares the planners (iterative ReAct loop, single-shot whole plan, and the iterative loop
+# with the compact multi-turn prompt) per task: round trips, input tokens (of which served
+# from the prompt cache), bytes uploaded, time and whether the plan matches the script
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.planners --latency 0.3
+
+import os
+import argparse
+from experiments import motor_control
+from experiments.stub_server import StubServer, ScriptedResponder, load_scripts
+from experiments.motor_control import get_motor_funcs, planners
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+
+
+def benchmark(scripts, latency=0.0):
+    _, funcs = get_motor_funcs(dummy=True)
+    results = []
+    with StubServer(responder=ScriptedResponder(scripts), latency=latency) as server:
+        motor_control.API_URL = server.url
+        for script in scripts:
+            row = dict(task=script["task"])
+            for label, planner in planners.items():
+                motor_control.cache.clear()
+                metrics = {}
+                bytes_in = server.stats.as_dict()["bytes_in"]
+                steps, answer, messages = planner(script["task"], funcs, metrics=metrics)
+                metrics["bytes_up"] = server.stats.as_dict()["bytes_in"] - bytes_in
+                metrics.setdefault("cached_tokens", 0)
+                metrics["steps"] = len(steps)
+                metrics["correct"] = [step["Action"] for step in steps] == [s["Action"] for s in script["steps"]]
+                row[label] = metrics
+            results.append(row)
+    return results
+
+
+def print_results(results):
+    print(f"{'task':<50} {'planner':>12} {'trips':>6} {'in_tok':>7} {'cached':>7} {'bytes':>7} {'secs':>7} {'ok':>3}")
+    totals = {label: dict(round_trips=0, prompt_tokens=0, cached_tokens=0, bytes_up=0, secs=0.0, correct=0)
+              for label in planners}
+    for row in results:
+        for label in planners:
+            m = row[label]
+            print(f"{row['task'][:50]:<50} {label:>12} {m['round_trips']:>6} {m['prompt_tokens']:>7} "
+                  f"{m['cached_tokens']:>7} {m['bytes_up']:>7} {m['secs']:>7.3f} {'y' if m['correct'] else 'n':>3}")
+            for k in totals[label]:
+                totals[label][k] += m[k]
+    for label, t in totals.items():
+        print(f"{'TOTAL':<50} {label:>12} {t['round_trips']:>6} {t['prompt_tokens']:>7} {t['cached_tokens']:>7} "
+              f"{t['bytes_up']:>7} {t['secs']:>7.3f} {t['correct']:>3}/{len(results)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=TASKS_FILE, help="JSONL file of scripted tasks")
+    parser.add_argument("--latency", type=float, default=0.0, help="injected latency in secs per request")
+    args = parser.parse_args()
+    print_results(benchmark(load_scripts(args.tasks), latency=args.latency))
@@ -0,0 +1,70 @@
+# Time-to-first-action of the streamed planner against waiting for the full completion
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.streaming --stream-delay 0.02
+
+import time
+import argparse
+from experiments import motor_control
+from experiments.stub_server import StubServer
+from experiments.motor_control import (
+    get_motor_funcs, stream_action_steps, call_completion_endpoint, parse_thought_action_list,
+    plan_instructions,
+)
+
+
+PLAN = """Thought: To turn left, I will run the motor for -90 degrees.
+Action: {"name": "run_for_degrees", "degrees": 90, "speed": -50, "blocking": false}
+Thought: Now I need to turn right twice. First right turn.
+Action: {"name": "run_for_degrees", "degrees": 90, "speed": 50, "blocking": false}
+Thought: Second right turn.
+Action: {"name": "run_for_degrees", "degrees": 90, "speed": 50, "blocking": false}
+Thought: I now know the final answer
+Final Answer: Turned left and then turned right twice."""
+
+TASK = "Please turn left and then turn right twice."
+
+
+def time_streamed(funcs):
+    start = time.perf_counter()
+    first = None
+    n = 0
+    for step in stream_action_steps(TASK, funcs=funcs):
+        if "Action" in step:
+            n += 1
+            if first is None:
+                first = time.perf_counter() - start
+    return first, time.perf_counter() - start, n
+
+
+def time_full(funcs):
+    start = time.perf_counter()
+    prompt = [{"role": "user", "content": plan_instructions.format(task=TASK, thought_actions="")}]
+    content, usage, completion = call_completion_endpoint(prompt=prompt, model=motor_control.model)
+    items = parse_thought_action_list(content, first_only=False)
+    n = len([item for item in items if item.get("key") == "Action"])
+    total = time.perf_counter() - start
+    return total, total, n
+
+
+def benchmark(stream_delay=0.02, latency=0.1, chunk_size=8):
+    _, funcs = get_motor_funcs(dummy=True)
+    results = {}
+    with StubServer(responder=lambda request: PLAN, latency=latency,
+                    stream_chunk_size=chunk_size, stream_delay=stream_delay) as server:
+        motor_control.API_URL = server.url
+        for label, f in [("full_completion", time_full), ("streamed", time_streamed)]:
+            first, total, n = f(funcs)
+            results[label] = dict(first_action_secs=first, total_secs=total, actions=n)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream-delay", type=float, default=0.02, help="secs between streamed deltas")
+    parser.add_argument("--latency", type=float, default=0.1, help="secs before the first byte")
+    parser.add_argument("--chunk-size", type=int, default=8, help="characters per streamed delta")
+    args = parser.parse_args()
+    results = benchmark(stream_delay=args.stream_delay, latency=args.latency, chunk_size=args.chunk_size)
+    for label, r in results.items():
+        print(f"{label:>16}: first action {r['first_action_secs']:.3f} secs, "
+              f"total {r['total_secs']:.3f} secs, {r['actions']} actions")
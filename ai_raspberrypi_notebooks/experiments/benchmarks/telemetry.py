@@ -0,0 +1,74 @@
+# Stall detection, sample rate and memory of the motor telemetry, on simulated motors that
+# stop short of some moves
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.telemetry --moves 40 --stall-rate 0.2
+#
+# Every move is run blocking through `invoke_tool`, so its observation has the motor state
+# after the move; a move counts as detected if the observation says it stalled exactly when
+# the simulated motor stopped it short.
+
+import time
+import random
+import argparse
+from experiments.motor_control import get_port_funcs, invoke_tool
+from experiments.telemetry import attach_telemetry
+
+
+def random_move(rand):
+    name = rand.choice(["run_for_degrees", "run_for_rotations", "run_to_position"])
+    speed = rand.choice([20, 40, -40, 60])
+    if name == "run_for_degrees":
+        return dict(name=name, degrees=rand.choice([45, 90, 180, 270]), speed=speed)
+    if name == "run_for_rotations":
+        return dict(name=name, rotations=rand.choice([0.5, 1, 2]), speed=speed)
+    return dict(name=name, degrees=rand.choice([-90, 0, 90, 180]), speed=abs(speed))
+
+
+def run(moves=40, stall_rate=0.2, time_scale=0.2, seed=0, min_interval=0.02, capacity=512, stall_secs=0.5):
+    motors, funcs = get_port_funcs(("A",), dummy="sim", time_scale=time_scale, stall_rate=stall_rate, seed=seed)
+    motor = motors["A"]
+    telemetries, funcs = attach_telemetry(motors, funcs, min_interval=min_interval, capacity=capacity,
+                                          stall_secs=stall_secs)
+    telemetry = telemetries["A"]
+    rand = random.Random(seed)
+    counts = dict(moves=0, stalls=0, detected=0, missed=0, false_stalls=0, unsettled=0)
+    start = time.perf_counter()
+    for i in range(moves):
+        stalls = motor.stalls
+        observation = invoke_tool(random_move(rand), funcs)
+        was_stalled = motor.stalls > stalls
+        counts["moves"] += 1
+        counts["stalls"] += was_stalled
+        if "stalled" in observation:
+            counts["detected" if was_stalled else "false_stalls"] += 1
+        elif was_stalled:
+            counts["missed"] += 1
+        elif "target reached" not in observation:
+            counts["unsettled"] += 1
+    secs = time.perf_counter() - start
+    stats = telemetry.stats()
+    telemetry.detach()
+    return dict(counts, secs=secs, callbacks_per_sec=stats["callbacks"] / secs,
+                samples_per_sec=stats["buffered"] / secs, samples=stats["samples"],
+                buffer_bytes=stats["buffer_bytes"])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--moves", type=int, default=40)
+    parser.add_argument("--stall-rate", type=float, default=0.2, help="probability that a move stops short")
+    parser.add_argument("--time-scale", type=float, default=0.2, help="scale of the simulated motor times")
+    parser.add_argument("--min-interval", type=float, nargs="+", default=[0.0, 0.02, 0.05],
+                        help="min secs between buffered samples")
+    parser.add_argument("--capacity", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rows = [dict(run(moves=args.moves, stall_rate=args.stall_rate, time_scale=args.time_scale, seed=args.seed,
+                     min_interval=min_interval, capacity=args.capacity), min_interval=min_interval)
+            for min_interval in args.min_interval]
+    print(f"\n{'min_int':>7} {'moves':>5} {'stalls':>6} {'detect':>6} {'missed':>6} {'false':>5} {'unsett':>6} "
+          f"{'cb/s':>6} {'smp/s':>6} {'bytes':>6} {'secs':>6}")
+    for row in rows:
+        print(f"{row['min_interval']:>7.3f} {row['moves']:>5} {row['stalls']:>6} {row['detected']:>6} "
+              f"{row['missed']:>6} {row['false_stalls']:>5} {row['unsettled']:>6} {row['callbacks_per_sec']:>6.1f} "
+              f"{row['samples_per_sec']:>6.1f} {row['buffer_bytes']:>6} {row['secs']:>6.2f}")
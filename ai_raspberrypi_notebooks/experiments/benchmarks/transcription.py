@@ -0,0 +1,152 @@
+# Latency, real-time factor and accuracy of the transcription backends on a recorded corpus
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.transcription --corpus path/to/corpus --backends cloud local
+#   python -m experiments.benchmarks.transcription --corpus path/to/corpus --cloud-stub-latency 0.6
+#
+# The corpus is a directory with a `manifest.jsonl` of {"wav": file name, "transcript": text},
+# as for `benchmarks.e2e`. The real-time factor is the transcription secs over the audio secs.
+# A transcript matches if it normalizes to the same task as the reference (same plan cache
+# key). `cloud` calls the OpenAI API, or with `--cloud-stub-latency` a local stand-in that
+# answers the reference transcript after that many secs (upload and latency only). Without
+# `--corpus`, synthetic noise utterances are used, which only measures speed.
+# `constrain_to_vocabulary` is checked first on a few transcripts (`CONSTRAIN_CHECKS`).
+
+import time
+import argparse
+import tempfile
+from io import BytesIO
+import numpy as np
+from experiments import audio_control
+from experiments.plan_cache import normalize_task
+from experiments.stub_server import StubServer, load_scripts
+from experiments.transcription import get_backend, load_audio, constrain_to_vocabulary, LOCAL_MODEL
+from experiments.benchmarks.e2e import make_fixtures, load_corpus, ReplayTranscriber, TASKS_FILE
+
+
+# (transcript, constrained transcript): misheard command words are fixed, real commands are kept
+CONSTRAIN_CHECKS = [
+    ("Turn lift.", "Turn left."),
+    ("Turn write twice.", "Turn right twice."),
+    ("Go forward tree rotations.", "Go forward three rotations."),
+    ("Run the motor on port B.", "Run the motor on port B."),
+    ("Step forward.", "Step forward."),
+    ("Turn the light on please.", "Turn the light on please."),
+    ("What is the weather like today?", "What is the weather like today?"),
+]
+
+
+def check_constraints():
+    """ Returns the (transcript, expected, constrained) of `CONSTRAIN_CHECKS` that are not constrained as expected """
+    results = [(text, expected, constrain_to_vocabulary(text)) for text, expected in CONSTRAIN_CHECKS]
+    return [row for row in results if row[1] != row[2]]
+
+
+def words(text):
+    return normalize_task(text or "").split()
+
+
+def word_errors(reference, hypothesis):
+    """ Word-level edit distance """
+    row = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, start=1):
+        prev, row[0] = row[0], i
+        for j, hyp_word in enumerate(hypothesis, start=1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (ref_word != hyp_word))
+    return row[-1]
+
+
+def read_utterance(path):
+    with open(path, "rb") as f:
+        byte_stream = BytesIO(f.read())
+    byte_stream.name = "audio.wav"
+    byte_stream.content_type = "audio/wav"
+    return byte_stream
+
+
+def run(backend, corpus, replay=None, repeat=1):
+    rows = []
+    for i in range(repeat):
+        for item in corpus:
+            byte_stream = read_utterance(item["wav"])
+            audio_secs = load_audio(byte_stream)[1]
+            if replay is not None:
+                replay.transcript = item["transcript"]
+            start = time.perf_counter()
+            try:
+                text = backend.transcribe(byte_stream)
+            except Exception as e:
+                print(f"{backend.name} failed on {item['wav']}: {e}")
+                text = None
+            secs = time.perf_counter() - start
+            reference = words(item["transcript"])
+            rows.append(dict(secs=secs, rtf=secs / audio_secs if audio_secs else 0.0, failed=text is None,
+                             errors=word_errors(reference, words(text)), ref_words=len(reference),
+                             match=text is not None and normalize_task(text) == normalize_task(item["transcript"])))
+    return rows
+
+
+def summarize(name, rows, setup_secs):
+    secs = [row["secs"] for row in rows]
+    p50, p95 = np.percentile(secs, [50, 95])
+    return dict(backend=name, n=len(rows), setup_secs=setup_secs, p50=p50, p95=p95,
+                rtf=float(np.mean([row["rtf"] for row in rows])),
+                wer=sum(row["errors"] for row in rows) / max(1, sum(row["ref_words"] for row in rows)),
+                match=sum(row["match"] for row in rows) / len(rows), failed=sum(row["failed"] for row in rows))
+
+
+def benchmark(corpus, backends=("cloud", "local"), cloud_stub_latency=None, repeat=1, **local_options):
+    results = []
+    for name in backends:
+        start = time.perf_counter()
+        backend = get_backend(name, **local_options)
+        setup_secs = time.perf_counter() - start
+        try:
+            if name == "cloud" and cloud_stub_latency is not None:
+                replay = ReplayTranscriber()
+                with StubServer(transcriber=replay, latency=cloud_stub_latency) as audio:
+                    from openai import OpenAI
+                    audio_control.client = OpenAI(api_key="stub", base_url=audio.base_url, max_retries=0)
+                    rows = run(backend, corpus, replay=replay, repeat=repeat)
+                audio_control.client = None
+            else:
+                rows = run(backend, corpus, repeat=repeat)
+        finally:
+            backend.close()
+        results.append(summarize(name, rows, setup_secs))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=None, help="directory with manifest.jsonl and WAV files")
+    parser.add_argument("--tasks", default=TASKS_FILE, help="scripted tasks for the synthetic corpus")
+    parser.add_argument("--backends", nargs="+", choices=["cloud", "local", "auto"], default=["cloud", "local"])
+    parser.add_argument("--cloud-stub-latency", type=float, default=None,
+                        help="replace the OpenAI API by a stand-in that answers after this many secs")
+    parser.add_argument("--model", default=LOCAL_MODEL, help="faster-whisper model of the local backend")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--cpu-threads", type=int, default=4)
+    parser.add_argument("--no-vocabulary", action="store_true", help="do not prompt with the command vocabulary")
+    parser.add_argument("--constrain", action="store_true", help="constrain the local transcripts to the command vocabulary")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    local_options = dict(model=args.model, compute_type=args.compute_type, cpu_threads=args.cpu_threads)
+    if args.no_vocabulary:
+        local_options["vocabulary"] = None
+    local_options["constrain"] = args.constrain
+    changed = check_constraints()
+    print(f"constrain_to_vocabulary: {len(CONSTRAIN_CHECKS) - len(changed)}/{len(CONSTRAIN_CHECKS)} transcripts as expected")
+    for text, expected, result in changed:
+        print(f"  {text!r} -> {result!r}, expected {expected!r}")
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus_dir = args.corpus
+        if corpus_dir is None:
+            print("No --corpus: synthetic utterances, the accuracy columns are meaningless")
+            corpus_dir = tmp
+            make_fixtures(corpus_dir, load_scripts(args.tasks))
+        results = benchmark(load_corpus(corpus_dir), backends=args.backends, cloud_stub_latency=args.cloud_stub_latency,
+                            repeat=args.repeat, **local_options)
+    print(f"\n{'backend':<8} {'n':>4} {'setup_s':>8} {'p50_ms':>8} {'p95_ms':>8} {'rtf':>6} {'wer':>6} {'match':>6} {'failed':>6}")
+    for row in results:
+        print(f"{row['backend']:<8} {row['n']:>4} {row['setup_secs']:>8.2f} {row['p50'] * 1e3:>8.1f} "
+              f"{row['p95'] * 1e3:>8.1f} {row['rtf']:>6.3f} {row['wer']:>6.1%} {row['match']:>6.1%} {row['failed']:>6}")
@@ -0,0 +1,72 @@
+# Planning + execution time of each scripted task on a simulated motor
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.turn_time --latency 0.3 --time-scale 0.1 --optimize
+#
+# Plans with the stub server standing in for the Messages API, then executes the plan on a
+# `SimulatedMotor` and waits until it stops moving. Motion secs are reported in real
+# (unscaled) time.
+
+import os
+import time
+import argparse
+import statistics
+from experiments import motor_control
+from experiments.stub_server import StubServer, ScriptedResponder, load_scripts
+from experiments.motor_control import get_motor_funcs, invoke_tool, planners
+from experiments.plan_optimizer import optimize_plan
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TASKS_FILE = os.path.join(DATA_DIR, "tasks.jsonl")
+
+
+def benchmark(scripts, planner="iterative", latency=0.0, optimize=False, **sim_options):
+    motor, funcs = get_motor_funcs(dummy="sim", **sim_options)
+    _, dummy_funcs = get_motor_funcs(dummy=True)
+    time_scale = motor.time_scale
+    rows = []
+    with StubServer(responder=ScriptedResponder(scripts), latency=latency) as server:
+        motor_control.API_URL = server.url
+        for script in scripts:
+            motor_control.cache.clear()
+            start = time.perf_counter()
+            steps, answer, messages = planners[planner](script["task"], funcs=dummy_funcs)
+            plan_secs = time.perf_counter() - start
+            if optimize:
+                steps, report = optimize_plan(steps, funcs)
+            commands = motor.commands
+            start = time.perf_counter()
+            for step in steps:
+                if not step["Action"].get("error"):
+                    invoke_tool(step["Action"], funcs)
+            motor.wait_idle()
+            execute_secs = (time.perf_counter() - start) / time_scale
+            rows.append(dict(task=script["task"], commands=motor.commands - commands, plan_secs=plan_secs,
+                             execute_secs=execute_secs, turn_secs=plan_secs + execute_secs))
+    return rows, motor.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", default=TASKS_FILE, help="JSONL file of scripted tasks")
+    parser.add_argument("--planner", choices=sorted(planners), default="iterative")
+    parser.add_argument("--latency", type=float, default=0.0, help="injected latency in secs per request")
+    parser.add_argument("--optimize", action="store_true", help="optimize plans before execution")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="simulated motion time multiplier")
+    parser.add_argument("--serial-latency", type=float, default=0.005, help="simulated secs per motor command")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="probability of a failed motor command")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="probability of a move stopping short")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rows, stats = benchmark(load_scripts(args.tasks), planner=args.planner, latency=args.latency,
+                            optimize=args.optimize, time_scale=args.time_scale,
+                            serial_latency=args.serial_latency, fault_rate=args.fault_rate,
+                            stall_rate=args.stall_rate, seed=args.seed)
+    print(f"\n{'task':<50} {'cmds':>5} {'plan_s':>7} {'exec_s':>7} {'turn_s':>7}")
+    for row in rows:
+        print(f"{row['task'][:50]:<50} {row['commands']:>5} {row['plan_secs']:>7.3f} "
+              f"{row['execute_secs']:>7.3f} {row['turn_secs']:>7.3f}")
+    turn_secs = [row["turn_secs"] for row in rows]
+    print(f"turn time: mean {statistics.mean(turn_secs):.3f} secs, max {max(turn_secs):.3f} secs; "
+          f"commands: {sum(row['commands'] for row in rows)}")
+    print(f"motor: {stats}")
@@ -0,0 +1,39 @@
+# Replays WAV utterances through `record_utterance` with a fake input stream and reports
+# how long each capture takes compared to the fixed 4 secs `sd.rec` window
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.benchmarks.vad path/to/utterances/*.wav [--realtime]
+
+import argparse
+import functools
+from experiments.audio_capture import record_utterance, read_wav, WavInputStream
+
+
+FIXED_WINDOW_SECS = 4.0
+
+
+def benchmark(paths, samplerate=44100, realtime=False):
+    rows = []
+    for path in paths:
+        frames, wav_rate = read_wav(path)
+        factory = functools.partial(WavInputStream, path, realtime=realtime)
+        recording = record_utterance(samplerate=samplerate, stream_factory=factory)
+        file_secs = len(frames) / wav_rate
+        kept_secs = len(recording) / samplerate
+        rows.append(dict(path=path, file_secs=file_secs, kept_secs=kept_secs,
+                         truncated_by_fixed_window=file_secs > FIXED_WINDOW_SECS))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="16-bit PCM WAV files")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--realtime", action="store_true", help="deliver blocks at the real audio rate")
+    args = parser.parse_args()
+    rows = benchmark(args.paths, samplerate=args.samplerate, realtime=args.realtime)
+    for r in rows:
+        print(f"{r['path']}: file {r['file_secs']:.2f} secs, kept {r['kept_secs']:.2f} secs"
+              f"{' (fixed window would truncate)' if r['truncated_by_fixed_window'] else ''}")
+    if rows:
+        kept = sum(r["kept_secs"] for r in rows)
+        print(f"audio kept: {kept:.2f} secs vs {FIXED_WINDOW_SECS * len(rows):.2f} secs with the fixed window")
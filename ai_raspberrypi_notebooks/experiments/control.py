@@ -4,12 +4,157 @@
 
 import os
 import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint, pformat
 from experiments.audio_control import *
 from experiments.motor_control import *
+from experiments.plan_cache import PlanCache, DEFAULT_PLAN_CACHE_PATH
+from experiments.intent import compile_task
+from experiments.plan_optimizer import optimize_plan
+from experiments.motor_executor import execute_concurrently
+from experiments.metrics import registry, configure_metrics
+from experiments.batch import CompiledPlans
+from experiments.hedging import configure_hedging
+from experiments.telemetry import attach_telemetry, stalled, describe
+from experiments.transcription import configure_transcriber, LOCAL_MODEL
+from experiments.motor_queue import attach_queues, preempt_queues
+from experiments.audio_encoding import ENCODINGS
+from experiments.tts_cache import TTSCache, DEFAULT_TTS_CACHE_DIR, DEFAULT_PREWARM_PHRASES
 
 
-def control(real_funcs, dummy_funcs):
+def execute_steps(thought_actions, funcs, executed=None, telemetries=None):
+    """ Invokes the actions of `thought_actions` on `funcs` and returns the final answer, if any
+
+    If `executed` is a list, the steps are appended to it as they are executed. If the motor
+    `telemetries` are provided, execution stops when a motor stalls and the answer is its state.
+    """
+    for thought_action in thought_actions:
+        if "Final Answer" in thought_action:
+            return thought_action.get("Final Answer")
+        thought = thought_action.get("Thought")
+        step = thought_action.get("Action")
+        print(f"\nThought: {thought}")
+        print(f"Action: {step}\n")
+        if not (error := step.get("error")):
+            obs = invoke_tool(step, funcs)
+        else:
+            print(f"Error in executing step: {error}")
+        if executed is not None:
+            executed.append(thought_action)
+        if telemetries and not error and (state := stalled(telemetries, step)) is not None:
+            registry.incr("motor_stalls", port=state["port"])
+            print(f"Stopping the plan: {describe(state)}")
+            return describe(state)
+    return None
+
+
+def get_known_plan(task, plan_cache=None, fast_path=False, compiled_plans=None):
+    """ Returns (thought_actions, answer) from the compiled plans, the rule-based fast path or the
+    plan cache, or None
+    """
+    if compiled_plans is not None and (compiled := compiled_plans.get(task)) is not None:
+        registry.incr("compiled_plan_hits")
+        print("Using compiled plan...")
+        return compiled
+    if fast_path:
+        if (compiled := compile_task(task)) is not None:
+            registry.incr("fast_path_hits")
+            print("Using fast-path plan...")
+            return compiled
+        registry.incr("fast_path_misses")
+    if plan_cache is not None and (cached := plan_cache.get(task)) is not None:
+        print("Using cached plan...")
+        return cached
+    return None
+
+
+def cache_plan(task, thought_actions, answer, plan_cache=None):
+    if plan_cache is not None:
+        plan_cache.put(task, thought_actions, answer)
+        print(f"Plan cache: {plan_cache.stats()}")
+
+
+def plan_task(task, dummy_funcs, planner="iterative", plan_cache=None, fast_path=False, cancel=None,
+              compiled_plans=None):
+    """ Plans `task` without executing it; returns (thought_actions, answer)
+
+    The plan comes from the first of: the compiled plans, the rule-based fast path, the plan
+    cache, and the LLM planner. Plans cancelled through the `cancel` event are not cached.
+    """
+    if (known := get_known_plan(task, plan_cache=plan_cache, fast_path=fast_path,
+                                compiled_plans=compiled_plans)) is not None:
+        return known
+    with registry.span("plan", planner=planner):
+        thought_actions, answer, messages = planners[planner](task, funcs=dummy_funcs, cancel=cancel)
+    if cancel is None or not cancel.is_set():
+        cache_plan(task, thought_actions, answer, plan_cache=plan_cache)
+    return thought_actions, answer
+
+
+def execute_plan(thought_actions, funcs, concurrent=False, telemetries=None):
+    """ Executes a whole plan, with the steps of different motor ports in parallel if `concurrent`
+
+    Stall checks with the motor `telemetries` only apply to the sequential execution.
+    """
+    if not concurrent:
+        with registry.span("execute"):
+            return execute_steps(thought_actions, funcs, telemetries=telemetries)
+    with registry.span("execute", concurrent=True):
+        answer, report = execute_concurrently(thought_actions, funcs)
+    print("Executed in {:.2f} secs ({})".format(
+        report["secs"], ", ".join(f"{port}: {secs:.2f}s" for port, secs in report["port_secs"].items())))
+    return answer
+
+
+def optimize_steps(thought_actions, funcs):
+    """ Returns the plan with redundant motor commands folded or removed (see `optimize_plan`) """
+    steps, report = optimize_plan(thought_actions, funcs)
+    if report["commands_saved"]:
+        print(f"Plan optimizer: {report['commands_before']} -> {report['commands_after']} commands, "
+              f"~{report['estimated_secs_saved']:.2f} secs of motion saved")
+    return steps
+
+
+def run_task(task, real_funcs, dummy_funcs, stream=False, planner="iterative", plan_cache=None,
+             fast_path=False, optimize=False, concurrent=False, compiled_plans=None, telemetries=None,
+             closed_loop=False, queues=None):
+    """ Plans `task` and executes the plan on `real_funcs`; returns (thought_actions, answer)
+
+    See `plan_task` for where the plan comes from and `control` for the arguments. The
+    returned plan is the one from the planner, before optimization.
+    """
+    if queues:
+        preempt_queues(queues)  # a new command cancels the motion left from the previous one
+    known = get_known_plan(task, plan_cache=plan_cache, fast_path=fast_path,
+                           compiled_plans=compiled_plans) if stream or closed_loop else None
+    if closed_loop and known is None:
+        # each action is executed on the motors as it is planned, so the planner sees their state;
+        # such plans depend on where the motors were, so they are not cached
+        with registry.span("plan", planner=planner, closed_loop=True):
+            thought_actions, answer, messages = planners[planner](task, funcs=real_funcs)
+    elif stream and known is None:
+        thought_actions = []
+        answer = execute_steps(stream_action_steps(task, funcs=dummy_funcs), real_funcs,
+                               executed=thought_actions, telemetries=telemetries)
+        if not (telemetries and any(telemetry.snapshot()["stalled"] for telemetry in telemetries.values())):
+            cache_plan(task, thought_actions, answer, plan_cache=plan_cache)
+    else:
+        thought_actions, answer = known or plan_task(task, dummy_funcs, planner=planner,
+                                                     plan_cache=plan_cache, fast_path=fast_path,
+                                                     compiled_plans=compiled_plans)
+        stopped = execute_plan(optimize_steps(thought_actions, real_funcs) if optimize else thought_actions,
+                               real_funcs, concurrent=concurrent, telemetries=telemetries)
+        answer = stopped or answer
+    return thought_actions, answer
+
+
+def control(real_funcs, dummy_funcs, stream=False, planner="iterative", plan_cache=None, fast_path=False,
+            vad=False, encoding=None, stream_tts=False, tts_cache=None, optimize=False, concurrent=False,
+            compiled_plans=None, telemetries=None, closed_loop=False, queues=None):
     """ Runs an audio input loop
 
     Args:
@@ -17,6 +162,46 @@ def control(real_funcs, dummy_funcs):
             References to motor functions to actually perform the physical actions
         :param dummy_funcs: dict
             References to dummy motor functions that will be used to only generate execution plans
+        :param stream: bool
+            If True, the plan is streamed and each step is executed as soon as it is parsed
+            instead of after planning is finished
+        :param planner: str
+            Name of the planner in `planners` used when not streaming
+        :param plan_cache: PlanCache
+            If provided, plans are looked up by the (normalized) task first and a hit is
+            executed without calling the LLM; new plans are added to the cache
+        :param fast_path: bool
+            If True, common commands ("turn left twice", "go forward 3 rotations", ...) are
+            compiled to actions by `compile_task` without calling the LLM
+        :param vad: bool
+            If True, recording stops soon after the speaker stops (up to 10 secs) instead of
+            always recording 4 secs
+        :param encoding: str
+            If provided, the recording is downsampled to 16 kHz and encoded in this format
+            ("wav", "flac", "mp3" or "opus") before it is uploaded for transcription
+        :param stream_tts: bool
+            If True, speech is played as it is synthesized instead of after the whole clip
+        :param tts_cache: TTSCache
+            If provided, phrases that were spoken before are played from the cache
+        :param optimize: bool
+            If True, consecutive moves are folded into one command and moves that cancel out
+            are dropped before the plan is executed (not applied when streaming)
+        :param concurrent: bool
+            If True, the steps of different motor ports run in parallel, each port's steps in
+            order, and every move waits for the motor to finish (not applied when streaming)
+        :param compiled_plans: CompiledPlans
+            If provided, tasks compiled with `experiments.batch` are executed from it without
+            calling the LLM
+        :param telemetries: dict
+            Motor telemetry by port from `attach_telemetry`, for `real_funcs`; if provided, a
+            plan stops when a motor stalls and its state is the final answer
+        :param closed_loop: bool
+            If True, the iterative planners execute each action on `real_funcs` as it is
+            planned, so the observations are the motor state from the telemetry
+        :param queues: dict
+            Motor command queues by port from `attach_queues`, for `real_funcs`; if provided,
+            actions are queued and run by each motor's executor thread without holding up
+            the loop, and a new task cancels the actions still queued
     
     Loops over the following steps:
         1. Prints 'Press [return] to speak, or 'q' to exit: ' and waits for user input
@@ -37,39 +222,238 @@ def control(real_funcs, dummy_funcs):
             print("'q' pressed... Exiting")
             break
         
-        byte_stream = get_audio_instruction(duration=4)
+        if vad:
+            byte_stream = get_audio_instruction(duration=10, vad=True, encoding=encoding)
+        else:
+            byte_stream = get_audio_instruction(duration=4, encoding=encoding)
+        if byte_stream is None:
+            print("No speech detected")
+            continue
         task = transcribe(byte_stream)
         print(f"\nTask: {task}\n")
         if True:
-            audio = speak(f"You said: {task}. Is that correct?")
+            audio = speak(f"You said: {task}. Is that correct?", stream=stream_tts, tts_cache=tts_cache)
             confirm = input("[y/n]: ")
             if not(confirm.lower() == "y"):
                 continue
             else:
                 print("proceeding with operating motor...")
-        thought_actions, answer, messages = get_action_steps(task, funcs=dummy_funcs)
-        for thought_action in thought_actions:
-            thought = thought_action.get("Thought")
-            step = thought_action.get("Action")
-            print(f"\nThought: {thought}")
-            print(f"Action: {step}\n")
-            if not (error := step.get("error")):
-                obs = invoke_tool(step, real_funcs)
-                # obs = invoke_tool(step, dummy_funcs)
-            else:
-                print(f"Error in executing step: {error}")
+        thought_actions, answer = run_task(task, real_funcs, dummy_funcs, stream=stream, planner=planner,
+                                           plan_cache=plan_cache, fast_path=fast_path, optimize=optimize,
+                                           concurrent=concurrent, compiled_plans=compiled_plans,
+                                           telemetries=telemetries, closed_loop=closed_loop, queues=queues)
         
         if answer:
             print(f"Final answer: {answer}")
-            audio = speak(answer)
+            audio = speak(answer, stream=stream_tts, tts_cache=tts_cache)
+
+
+class StageTimer:
+    """ Wall time of each stage of a turn of the voice loop """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def report(self):
+        self.timings["turn"] = time.perf_counter() - self.start
+        for name, secs in self.timings.items():
+            registry.observe("stage_secs", secs, stage=name)
+        registry.event("turn", **self.timings)
+        print("Stage timings: " + ", ".join(f"{k}={v:.3f}s" for k, v in self.timings.items()))
+        return self.timings
+
+
+def timed_call(f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def control_pipelined(real_funcs, dummy_funcs, planner="iterative", plan_cache=None, fast_path=False,
+                      vad=False, encoding=None, stream_tts=False, tts_cache=None, optimize=False,
+                      concurrent=False, compiled_plans=None, telemetries=None, queues=None):
+    """ Runs the same audio input loop as `control`, overlapping the stages of each turn
+
+    Planning starts speculatively as soon as the task is transcribed, while the confirmation
+    is spoken and the user answers; it is cancelled if the user rejects the transcript. The
+    final answer is synthesized while the plan executes on the motor, and played after.
+    Timings of every stage are printed at the end of each turn. See `control` for the arguments;
+    plans are always executed after planning, so there is no closed-loop mode.
+    """
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline") as executor:
+        for i in range(5):
+            inp = input("Press [return] to speak, or 'q' to exit: ")
+
+            if inp.lower().startswith("q"):
+                print("'q' pressed... Exiting")
+                break
+
+            timer = StageTimer()
+            with timer.stage("record"):
+                if vad:
+                    byte_stream = get_audio_instruction(duration=10, vad=True, encoding=encoding)
+                else:
+                    byte_stream = get_audio_instruction(duration=4, encoding=encoding)
+            if byte_stream is None:
+                print("No speech detected")
+                continue
+            with timer.stage("transcribe"):
+                task = transcribe(byte_stream)
+            print(f"\nTask: {task}\n")
+
+            cancel = threading.Event()
+            plan_future = executor.submit(timed_call, plan_task, task, dummy_funcs, planner=planner,
+                                          plan_cache=plan_cache, fast_path=fast_path, cancel=cancel,
+                                          compiled_plans=compiled_plans)
+            with timer.stage("confirm_speech"):
+                speak(f"You said: {task}. Is that correct?", stream=stream_tts, tts_cache=tts_cache)
+            with timer.stage("confirm_input"):
+                confirm = input("[y/n]: ")
+            if not(confirm.lower() == "y"):
+                cancel.set()
+                if not plan_future.cancel():
+                    print("Cancelling speculative planning...")
+                timer.report()
+                continue
+            print("proceeding with operating motor...")
+
+            with timer.stage("plan_wait"):
+                (thought_actions, answer), plan_secs = plan_future.result()
+            if queues:
+                preempt_queues(queues)
+            timer.timings["plan"] = plan_secs
+            if optimize:
+                thought_actions = optimize_steps(thought_actions, real_funcs)
+            answer_future = executor.submit(prepare_speech, answer, tts_cache=tts_cache) if answer else None
+            with timer.stage("execute"):
+                if stopped := execute_plan(thought_actions, real_funcs, concurrent=concurrent, telemetries=telemetries):
+                    # the answer was synthesized for the whole plan
+                    answer, answer_future = stopped, executor.submit(prepare_speech, stopped, tts_cache=tts_cache)
+            if answer_future is not None:
+                with timer.stage("answer_speech_wait"):
+                    segment = answer_future.result()
+                print(f"Final answer: {answer}")
+                with timer.stage("answer_play"):
+                    play_segment(segment)
+            timer.report()
 
 
 if __name__ == '__main__':
-    dummy_motor, dummy_funcs = get_motor_funcs(dummy=True)
-    real_motor, real_funcs = get_motor_funcs(dummy=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the plan and execute each step as soon as it is parsed")
+    parser.add_argument("--planner", choices=sorted(planners), default="iterative",
+                        help="planner used when not streaming")
+    parser.add_argument("--plan-cache", nargs="?", const=DEFAULT_PLAN_CACHE_PATH, default=None,
+                        metavar="PATH", help=f"cache plans on disk (default path: {DEFAULT_PLAN_CACHE_PATH})")
+    parser.add_argument("--fast-path", action="store_true",
+                        help="compile common commands without calling the LLM")
+    parser.add_argument("--vad", action="store_true",
+                        help="stop recording when the speaker stops instead of after 4 secs")
+    parser.add_argument("--encoding", choices=sorted(ENCODINGS), default=None,
+                        help="downsample to 16 kHz and encode the audio before transcription")
+    parser.add_argument("--stream-tts", action="store_true",
+                        help="play speech as it is synthesized")
+    parser.add_argument("--tts-cache", nargs="?", const=DEFAULT_TTS_CACHE_DIR, default=None, metavar="DIR",
+                        help=f"cache synthesized speech on disk (default dir: {DEFAULT_TTS_CACHE_DIR})")
+    parser.add_argument("--tts-prewarm", metavar="FILE", default=None,
+                        help="phrases (one per line) to synthesize into the speech cache at startup")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="overlap planning with the confirmation and speech with execution")
+    parser.add_argument("--optimize", action="store_true",
+                        help="fold and cancel redundant motor commands before executing a plan")
+    parser.add_argument("--ports", default="A",
+                        help=f"comma-separated Build HAT ports with a motor (of {','.join(MOTOR_PORTS)})")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="run the steps of different motor ports in parallel")
+    parser.add_argument("--metrics-jsonl", metavar="PATH", default=None,
+                        help="append timing spans and events to this JSON lines file")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--compiled-plans", metavar="PATH", default=None,
+                        help="plan file written by `python -m experiments.batch`, executed without the LLM")
+    parser.add_argument("--hedge", action="store_true",
+                        help="fire a second planning request if the first is slower than the recent p90 or invalid")
+    parser.add_argument("--hedge-model", default=None,
+                        help="model of the hedge requests (default: the planning model)")
+    parser.add_argument("--telemetry", action="store_true",
+                        help="stream the motor positions, stop a plan when a motor stalls, and add the state to observations")
+    parser.add_argument("--closed-loop", action="store_true",
+                        help="execute each action as it is planned so the planner sees the motor state (implies --telemetry)")
+    parser.add_argument("--transcriber", choices=["cloud", "local", "auto"], default="cloud",
+                        help="speech-to-text with the OpenAI API, on the CPU, or with the API falling back to the CPU")
+    parser.add_argument("--local-model", default=LOCAL_MODEL,
+                        help="faster-whisper model of the local transcriber")
+    parser.add_argument("--constrain-vocabulary", action="store_true",
+                        help="replace misheard direction, number and unit words of the local transcripts")
+    parser.add_argument("--motor-queue", action="store_true",
+                        help="queue the actions of each motor on its own thread; a new task (e.g. stop) cancels queued motion")
+    parser.add_argument("--max-iterations", type=int, default=10,
+                        help="max completions of the iterative and compact planners per task")
+    parser.add_argument("--token-budget", type=int, default=None,
+                        help="stop planning a task once it has used this many tokens")
+    parser.add_argument("--compact-history", type=int, nargs="?", const=2, default=None, metavar="N",
+                        help="list only the last N steps (default 2) in the iterative prompt, after a state line of the earlier ones")
+    args = parser.parse_args()
+    if args.closed_loop and args.planner not in ("iterative", "compact"):
+        parser.error("--closed-loop needs the iterative or compact planner")
+    if args.closed_loop and args.pipelined:
+        parser.error("--closed-loop cannot be used with --pipelined")
+    if args.closed_loop and args.motor_queue:
+        # queued actions return before the motor moves, so their observations have no measured state
+        parser.error("--closed-loop cannot be used with --motor-queue")
+
+    configure_metrics(jsonl_path=args.metrics_jsonl, prometheus_port=args.metrics_port)
+    configure_planning(args.max_iterations, tokens=args.token_budget, keep_last=args.compact_history)
+    hedged = configure_hedging(hedge_model=args.hedge_model) if args.hedge or args.hedge_model else None
+    configure_transcriber(args.transcriber, constrain=args.constrain_vocabulary, model=args.local_model)
+    ports = [port.strip().upper() for port in args.ports.split(",") if port.strip()]
+    dummy_motors, dummy_funcs = get_port_funcs(ports, dummy=True)
+    real_motors, real_funcs = get_port_funcs(ports, dummy=False)
     
-    print(f"Motor connected: {real_motor.connected}")
+    for port, real_motor in real_motors.items():
+        print(f"Motor {port} connected: {real_motor.connected}")
+    telemetries = None
+    if args.telemetry or args.closed_loop:
+        telemetries, real_funcs = attach_telemetry(real_motors, real_funcs)
+    queues = None
+    if args.motor_queue:
+        queues, real_funcs = attach_queues(real_motors, real_funcs)
     
-    control(real_funcs, dummy_funcs)
-    print("Turning off the motor...")
-    real_motor.off()
+    plan_cache = PlanCache(args.plan_cache) if args.plan_cache else None
+    compiled_plans = CompiledPlans(args.compiled_plans) if args.compiled_plans else None
+    tts_cache = TTSCache(args.tts_cache) if args.tts_cache else None
+    if tts_cache is not None:
+        prewarm_tts_cache(tts_cache, load_phrases(args.tts_prewarm) if args.tts_prewarm else DEFAULT_PREWARM_PHRASES)
+    if args.pipelined:
+        control_pipelined(real_funcs, dummy_funcs, planner=args.planner, plan_cache=plan_cache,
+                          fast_path=args.fast_path, vad=args.vad, encoding=args.encoding,
+                          stream_tts=args.stream_tts, tts_cache=tts_cache, optimize=args.optimize, concurrent=args.concurrent,
+                          compiled_plans=compiled_plans, telemetries=telemetries, queues=queues)
+    else:
+        control(real_funcs, dummy_funcs, stream=args.stream, planner=args.planner, plan_cache=plan_cache,
+                fast_path=args.fast_path, vad=args.vad,
+                encoding=args.encoding, stream_tts=args.stream_tts,
+                tts_cache=tts_cache, optimize=args.optimize, concurrent=args.concurrent,
+                compiled_plans=compiled_plans, telemetries=telemetries, closed_loop=args.closed_loop,
+                queues=queues)
+    print("Turning off the motors...")
+    for queue in (queues or {}).values():
+        queue.close()
+    for telemetry in (telemetries or {}).values():
+        telemetry.detach()
+    for real_motor in real_motors.values():
+        real_motor.off()
+    if hedged is not None:
+        print(f"Hedged requests: {hedged.report()}")
+    configure_transcriber()  # stops the local transcriber
+    configure_metrics()  # flushes and closes the JSONL sink
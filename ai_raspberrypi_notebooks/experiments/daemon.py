@@ -0,0 +1,298 @@
+# Resident mode of the control loop: the motors, HTTP session, OpenAI client, audio devices
+# and caches are set up once, and tasks are then sent over a Unix socket:
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.daemon --ports A,B --plan-cache --fast-path &
+#   python -m experiments.daemon --send "turn left twice" --speak
+#   python -m experiments.daemon --listen --vad          # record the task from the microphone
+#   python -m experiments.daemon --stop
+#
+# Requests and responses are JSON objects, one per line. Requests are handled one at a time
+# since the turns share the motors. The client side only imports the standard library, so
+# sending a task costs no startup time either.
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+
+DEFAULT_SOCKET_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ai_raspberrypi", "control.sock")
+
+
+def warm_up():
+    """ Imports the deferred modules and creates the clients the first turn would otherwise pay for;
+    returns the secs taken by each
+    """
+    from experiments.audio_control import get_client
+    from experiments.http_client import get_http_session
+    timings = {}
+
+    def timed(name, f):
+        start = time.perf_counter()
+        try:
+            f()
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+        timings[name] = time.perf_counter() - start
+
+    def audio_devices():
+        import sounddevice as sd  # initializes PortAudio, which scans the audio devices
+        sd.query_devices()
+
+    timed("openai", get_client)
+    timed("http_session", get_http_session)
+    timed("audio_devices", audio_devices)
+    timed("pydub", lambda: __import__("pydub.playback"))
+    print("Warm-up: " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
+    return timings
+
+
+class ControlDaemon:
+    """ Runs the turns requested over the socket with the resources set up at startup
+
+    Args:
+        :param run_options: dict
+            Arguments of `control.run_task` (planner, plan_cache, fast_path, ...)
+        :param speech_options: dict
+            Arguments of `audio_control.speak` (stream, tts_cache)
+    """
+
+    def __init__(self, real_funcs, dummy_funcs, run_options=None, speech_options=None, encoding=None):
+        self.real_funcs = real_funcs
+        self.dummy_funcs = dummy_funcs
+        self.run_options = run_options or {}
+        self.speech_options = speech_options or {}
+        self.encoding = encoding
+        self.turns = 0
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+    def run_turn(self, request):
+        from experiments import control
+        timings = {}
+        start = time.perf_counter()
+        task = request.get("task")
+        if request.get("listen"):
+            vad = request.get("vad", False)
+            byte_stream = control.get_audio_instruction(duration=10 if vad else 4, vad=vad, encoding=self.encoding)
+            timings["record"] = time.perf_counter() - start
+            if byte_stream is None:
+                print("No speech detected")
+                return dict(error="no speech detected", secs=timings)
+            task = control.transcribe(byte_stream)
+            timings["transcribe"] = time.perf_counter() - start - timings["record"]
+        if not task:
+            return dict(error="no task given")
+        print(f"\nTask: {task}\n")
+        run_start = time.perf_counter()
+        thought_actions, answer = control.run_task(task, self.real_funcs, self.dummy_funcs, **self.run_options)
+        timings["run"] = time.perf_counter() - run_start
+        if answer and request.get("speak"):
+            speak_start = time.perf_counter()
+            control.speak(answer, **self.speech_options)
+            timings["speak"] = time.perf_counter() - speak_start
+        timings["turn"] = time.perf_counter() - start
+        self.turns += 1
+        return dict(task=task, steps=thought_actions, answer=answer, secs=timings)
+
+    def handle(self, request):
+        """ Returns the response to a request: {"task": ...}, {"listen": true}, or {"cmd": "ping" | "stats" | "stop"} """
+        cmd = request.get("cmd", "turn")
+        if cmd == "ping":
+            return dict(ok=True, turns=self.turns, uptime_secs=time.time() - self.started)
+        if cmd == "stats":
+            from experiments.metrics import registry
+            return dict(turns=self.turns, metrics=registry.snapshot())
+        if cmd == "stop":
+            self.stopping.set()
+            return dict(ok=True)
+        if cmd != "turn":
+            return dict(error=f"invalid cmd {cmd}")
+        try:
+            return self.run_turn(request)
+        except Exception as e:
+            print(f"Failed turn: {e}")
+            return dict(error=f"{type(e).__name__}: {e}")
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = dict(error=f"invalid request: {e}")
+            else:
+                response = self.server.daemon.handle(request)
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode("utf-8"))
+            if self.server.daemon.stopping.is_set():
+                # shutdown() waits for serve_forever(), which runs this handler
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    """ Serves one connection at a time """
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            if ping(path):
+                raise RuntimeError(f"a daemon is already listening on {path}")
+            os.unlink(path)  # left over by a daemon that did not exit cleanly
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        super().__init__(path, DaemonHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.daemon = daemon
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def send(request, path=DEFAULT_SOCKET_PATH, timeout=None):
+    """ Sends a request to the daemon listening on `path`; returns its response """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f"no response from the daemon on {path}")
+    return json.loads(line)
+
+
+def ping(path=DEFAULT_SOCKET_PATH, timeout=1.0):
+    try:
+        return send(dict(cmd="ping"), path=path, timeout=timeout).get("ok", False)
+    except OSError:
+        return False
+
+
+def serve(args):
+    from experiments import control
+    from experiments.plan_cache import PlanCache
+    from experiments.tts_cache import TTSCache
+    from experiments.batch import CompiledPlans
+    from experiments.telemetry import attach_telemetry
+    from experiments.transcription import configure_transcriber
+    from experiments.motor_queue import attach_queues
+
+    start = time.perf_counter()
+    control.configure_metrics(jsonl_path=args.metrics_jsonl, prometheus_port=args.metrics_port)
+    control.configure_planning(args.max_iterations, tokens=args.token_budget, keep_last=args.compact_history)
+    ports = [port.strip().upper() for port in args.ports.split(",") if port.strip()]
+    dummy_motors, dummy_funcs = control.get_port_funcs(ports, dummy=True)
+    real_motors, real_funcs = control.get_port_funcs(ports, dummy={"hat": False, "dummy": True}.get(args.motor, args.motor))
+    plan_cache = PlanCache(args.plan_cache) if args.plan_cache else None
+    tts_cache = TTSCache(args.tts_cache) if args.tts_cache else None
+    compiled_plans = CompiledPlans(args.compiled_plans) if args.compiled_plans else None
+    telemetries = None
+    if args.telemetry or args.closed_loop:
+        telemetries, real_funcs = attach_telemetry(real_motors, real_funcs)
+    queues = None
+    if args.motor_queue:
+        queues, real_funcs = attach_queues(real_motors, real_funcs)
+    # the local model is loaded here, whether or not the clients are warmed up
+    configure_transcriber(args.transcriber, constrain=args.constrain_vocabulary, model=args.local_model)
+    if not args.no_warm_up:
+        warm_up()
+    run_options = dict(stream=args.stream, planner=args.planner, plan_cache=plan_cache, fast_path=args.fast_path,
+                       optimize=args.optimize, concurrent=args.concurrent, compiled_plans=compiled_plans,
+                       telemetries=telemetries, closed_loop=args.closed_loop, queues=queues)
+    daemon = ControlDaemon(real_funcs, dummy_funcs, run_options=run_options, encoding=args.encoding,
+                           speech_options=dict(stream=args.stream_tts, tts_cache=tts_cache))
+    server = DaemonServer(args.socket, daemon)
+    print(f"Ready in {time.perf_counter() - start:.2f} secs, listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Turning off the motors...")
+        for queue in (queues or {}).values():
+            queue.close()
+        for telemetry in (telemetries or {}).values():
+            telemetry.detach()
+        for real_motor in real_motors.values():
+            real_motor.off()
+        control.configure_metrics()
+        configure_transcriber()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the control loop as a daemon, or sends it a request")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="path of the Unix socket")
+    client = parser.add_argument_group("client")
+    client.add_argument("--send", metavar="TASK", default=None, help="send a task to the running daemon")
+    client.add_argument("--listen", action="store_true", help="have the daemon record the task from the microphone")
+    client.add_argument("--vad", action="store_true", help="stop recording soon after the speaker stops")
+    client.add_argument("--speak", action="store_true", help="have the daemon speak the final answer")
+    client.add_argument("--stats", action="store_true", help="print the metrics of the running daemon")
+    client.add_argument("--stop", action="store_true", help="stop the running daemon")
+    daemon = parser.add_argument_group("daemon")
+    daemon.add_argument("--ports", default="A", help="comma-separated Build HAT ports of the motors")
+    daemon.add_argument("--motor", choices=["hat", "dummy", "sim"], default="hat",
+                        help="run on the Build HAT, on dummy motors, or on simulated motors")
+    daemon.add_argument("--planner", default="iterative", help="one of `motor_control.planners`")
+    daemon.add_argument("--stream", action="store_true", help="stream the plan and execute each step as it is parsed")
+    daemon.add_argument("--plan-cache", nargs="?", const=True, default=None, metavar="PATH")
+    daemon.add_argument("--fast-path", action="store_true")
+    daemon.add_argument("--optimize", action="store_true")
+    daemon.add_argument("--concurrent", action="store_true")
+    daemon.add_argument("--compiled-plans", metavar="PATH", default=None)
+    daemon.add_argument("--telemetry", action="store_true", help="stop a plan when a motor stalls")
+    daemon.add_argument("--closed-loop", action="store_true", help="plan with the motor state as observations")
+    daemon.add_argument("--motor-queue", action="store_true", help="queue the actions of each motor on its own thread")
+    daemon.add_argument("--max-iterations", type=int, default=10, help="max planning completions per task")
+    daemon.add_argument("--token-budget", type=int, default=None, help="max planning tokens per task")
+    daemon.add_argument("--compact-history", type=int, nargs="?", const=2, default=None, metavar="N",
+                        help="list only the last N steps in the planning prompt")
+    daemon.add_argument("--encoding", default=None, help="encoding of the recorded audio before upload (one of `audio_encoding.ENCODINGS`)")
+    daemon.add_argument("--transcriber", choices=["cloud", "local", "auto"], default="cloud")
+    daemon.add_argument("--local-model", default=None, help="faster-whisper model of the local transcriber (default: `transcription.LOCAL_MODEL`)")
+    daemon.add_argument("--constrain-vocabulary", action="store_true", help="replace misheard command words of the local transcripts")
+    daemon.add_argument("--stream-tts", action="store_true")
+    daemon.add_argument("--tts-cache", nargs="?", const=True, default=None, metavar="DIR")
+    daemon.add_argument("--metrics-jsonl", metavar="PATH", default=None)
+    daemon.add_argument("--metrics-port", type=int, default=None)
+    daemon.add_argument("--no-warm-up", action="store_true", help="do not import and connect the clients at startup")
+    args = parser.parse_args()
+
+    if args.send or args.listen or args.stats or args.stop:
+        if args.stop:
+            request = dict(cmd="stop")
+        elif args.stats:
+            request = dict(cmd="stats")
+        else:
+            request = dict(task=args.send, listen=args.listen, vad=args.vad, speak=args.speak)
+        print(json.dumps(send(request, path=args.socket), indent=1))
+    else:
+        # the choices are checked here so that the client side only imports the standard library
+        from experiments.motor_control import planners
+        from experiments.audio_encoding import ENCODINGS
+        from experiments.transcription import LOCAL_MODEL
+        if args.planner not in planners:
+            parser.error(f"argument --planner: invalid choice: {args.planner!r} (choose from {', '.join(sorted(planners))})")
+        if args.encoding is not None and args.encoding not in ENCODINGS:
+            parser.error(f"argument --encoding: invalid choice: {args.encoding!r} (choose from {', '.join(sorted(ENCODINGS))})")
+        if args.closed_loop and args.planner not in ("iterative", "compact"):
+            parser.error("--closed-loop needs the iterative or compact planner")
+        if args.closed_loop and args.motor_queue:
+            parser.error("--closed-loop cannot be used with --motor-queue")
+        args.local_model = args.local_model or LOCAL_MODEL
+        if args.plan_cache is True:
+            from experiments.plan_cache import DEFAULT_PLAN_CACHE_PATH
+            args.plan_cache = DEFAULT_PLAN_CACHE_PATH
+        if args.tts_cache is True:
+            from experiments.tts_cache import DEFAULT_TTS_CACHE_DIR
+            args.tts_cache = DEFAULT_TTS_CACHE_DIR
+        serve(args)
@@ -0,0 +1,160 @@
+# Hedged completion requests for the planning calls, to cut their tail latency:
+#   python -m experiments.control --hedge --hedge-model claude-3-5-haiku-20241022
+#
+# The first request gets a deadline of the rolling p90 latency of its model. If it has not
+# answered by then, or its answer does not validate, a second request is fired (optionally to
+# a faster model) and the first answer that validates wins. Requests that lose the race and
+# are already running cannot be aborted with `requests`; their answers are discarded when
+# they arrive and their tokens are counted as the extra cost of hedging.
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from experiments import motor_control
+from experiments.metrics import registry
+
+
+class LatencyWindow:
+    """ Rolling window of request latencies; `deadline()` is their `percentile`
+
+    Until `min_samples` latencies are recorded the deadline is `initial_deadline`.
+    """
+
+    def __init__(self, size=100, percentile=90, min_samples=10, initial_deadline=2.0):
+        self.samples = deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_deadline = initial_deadline
+        self.lock = threading.Lock()
+
+    def add(self, secs):
+        with self.lock:
+            self.samples.append(secs)
+
+    def deadline(self):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return self.initial_deadline
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+
+class HedgedCompletion:
+    """ Calls `motor_control.call_completion_endpoint`, hedging slow or invalid answers
+
+    Args:
+        :param hedge_model: str
+            Model of the hedge request (default: the model of the first request)
+        :param percentile: int
+            Percentile of the recent latencies after which the hedge request is fired
+        :param initial_deadline: float
+            Deadline in secs until enough latencies are recorded
+
+    Set it as `motor_control.hedger` (see `configure_hedging`) to hedge the planning calls.
+    """
+
+    def __init__(self, hedge_model=None, percentile=90, window=100, min_samples=10, initial_deadline=2.0,
+                 max_workers=8):
+        self.hedge_model = hedge_model
+        self.window_options = dict(size=window, percentile=percentile, min_samples=min_samples,
+                                   initial_deadline=initial_deadline)
+        self.windows = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.lock = threading.Lock()
+        self.stats = dict(calls=0, hedged=0, hedge_wins=0, invalid=0, failed=0, tokens=0, extra_tokens=0)
+
+    def window(self, model):
+        with self.lock:
+            if (window := self.windows.get(model)) is None:
+                window = self.windows[model] = LatencyWindow(**self.window_options)
+            return window
+
+    def add_stats(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.stats[k] += v
+
+    def request(self, prompt, model, system):
+        start = time.perf_counter()
+        result = motor_control.call_completion_endpoint(prompt=prompt, model=model, system=system)
+        self.window(model).add(time.perf_counter() - start)
+        return result
+
+    def submit(self, prompt, model, system):
+        future = self.executor.submit(self.request, prompt, model, system)
+        future.model = model
+        return future
+
+    @staticmethod
+    def is_valid(future, validate):
+        if future.exception() is not None:
+            return False
+        content, usage, completion = future.result()
+        return bool(content) and (validate is None or validate(content))
+
+    def count_extra(self, future):
+        """ Done callback of the requests that lost the race """
+        if future.cancelled() or future.exception() is not None:
+            return
+        tokens = (future.result()[1] or {}).get("total_tokens") or 0
+        self.add_stats(tokens=tokens, extra_tokens=tokens)
+        registry.incr("hedge_extra_tokens", tokens, model=future.model)
+
+    def __call__(self, prompt, model, system=None, validate=None):
+        """ Returns the (content, usage, completion) of the first answer for which `validate(content)`
+        is true, or of the first request if none is
+        """
+        self.add_stats(calls=1)
+        first = self.submit(prompt, model, system)
+        pending = {first}
+        hedge = winner = None
+        timeout = self.window(model).deadline()
+        while pending and winner is None:
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if self.is_valid(future, validate):
+                    winner = future
+                    break
+                self.add_stats(invalid=1)
+                registry.incr("completion_invalid", model=future.model)
+            if winner is None and hedge is None:
+                # the first request is late or its answer is invalid
+                hedge = self.submit(prompt, self.hedge_model or model, system)
+                pending.add(hedge)
+                timeout = None
+                self.add_stats(hedged=1)
+                registry.incr("completion_hedges", model=hedge.model)
+        if winner is None:
+            self.add_stats(failed=1)
+            winner = first
+        elif winner is hedge:
+            self.add_stats(hedge_wins=1)
+            registry.incr("completion_hedge_wins", model=hedge.model)
+        for future in (first, hedge):
+            if future is not None and future is not winner and not future.cancel():
+                future.add_done_callback(self.count_extra)
+        if winner.exception() is not None:
+            raise winner.exception()
+        content, usage, completion = winner.result()
+        self.add_stats(tokens=(usage or {}).get("total_tokens") or 0)
+        return content, usage, completion
+
+    def report(self):
+        """ Returns the stats with the hedge rate and the extra tokens as a fraction of all tokens """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["hedge_rate"] = stats["hedged"] / stats["calls"] if stats["calls"] else 0.0
+        stats["extra_token_rate"] = stats["extra_tokens"] / stats["tokens"] if stats["tokens"] else 0.0
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def configure_hedging(enabled=True, **kwargs):
+    """ Sets `motor_control.hedger` to a new `HedgedCompletion(**kwargs)`, or unsets it; returns it """
+    if motor_control.hedger is not None:
+        motor_control.hedger.close()
+    motor_control.hedger = HedgedCompletion(**kwargs) if enabled else None
+    return motor_control.hedger
@@ -0,0 +1,162 @@
+import time
+import threading
+
+
+# Defaults for the shared HTTP client; can be overridden with `configure_http_client`
+HTTP_POOL_SIZE = 4
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.3  # sleep between retries is `backoff_factor * 2 ** (retry - 1)` secs
+# statuses of requests the server refused without processing them, so that a completion POST
+# is never run (and billed) twice
+HTTP_RETRY_STATUSES = (429, 503, 529)
+HTTP_CONNECT_TIMEOUT = 7
+HTTP_READ_TIMEOUT = 30
+
+_session = None
+_session_lock = threading.Lock()
+_http_config = dict(
+    pool_size=HTTP_POOL_SIZE,
+    max_retries=HTTP_MAX_RETRIES,
+    backoff_factor=HTTP_BACKOFF_FACTOR,
+    retry_statuses=HTTP_RETRY_STATUSES,
+)
+
+
+def make_http_session(pool_size=HTTP_POOL_SIZE):
+    """ Creates a `requests.Session` with a keep-alive connection pool
+
+    The session itself does not retry: `send_request` does, within the deadline of the request.
+
+    Args:
+        :param pool_size: int
+            Number of connections kept alive per host
+    """
+    # imported on first use to keep the startup of `experiments.control` short
+    import requests
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_http_session():
+    """ Returns the module-level pooled session, creating it on first use """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = make_http_session(pool_size=_http_config["pool_size"])
+    return _session
+
+
+def configure_http_client(**kwargs):
+    """ Updates the pool size of the shared session and the retry policy of `send_request`
+
+    The existing session, if any, is closed and a new one is created lazily on next use.
+    """
+    global _session
+    invalid = set(kwargs) - set(_http_config)
+    if invalid:
+        raise ValueError(f"invalid http client options {sorted(invalid)}")
+    with _session_lock:
+        _http_config.update(kwargs)
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def close_http_client():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_request_timeout(max_timeout=HTTP_READ_TIMEOUT, network_timeout=HTTP_CONNECT_TIMEOUT):
+    """ Returns the (connect, read) timeout tuple passed to `requests`
+
+    `network_timeout` bounds the TCP/TLS connect; `max_timeout` bounds the wait for
+    the server to respond, which is what dominates slow completions.
+    """
+    connect_timeout = min(network_timeout, max_timeout) if network_timeout else max_timeout
+    return connect_timeout, max_timeout
+
+
+def is_connect_error(e):
+    """ Whether a `requests` exception happened before the request was sent """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+
+def retry_after_secs(resp):
+    try:
+        return max(0.0, float(resp.headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return None
+
+
+def send_request(method, url, max_timeout=HTTP_READ_TIMEOUT, network_timeout=HTTP_CONNECT_TIMEOUT, session=None,
+                 **kwargs):
+    """ Sends a request with `session` (default: the shared one) and returns the response,
+    retrying with backoff while the total wait stays within `max_timeout` secs
+
+    Only failed connections and the `retry_statuses` are retried: a request that may have reached
+    the server (read errors and timeouts, other statuses) is not sent again. Other arguments are
+    passed to `requests`.
+    """
+    import requests
+    session = session or get_http_session()
+    max_retries, backoff_factor = _http_config["max_retries"], _http_config["backoff_factor"]
+    deadline = time.monotonic() + max_timeout
+    for attempt in range(max_retries + 1):
+        timeout = get_request_timeout(max_timeout=deadline - time.monotonic(), network_timeout=network_timeout)
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            if attempt == max_retries or not is_connect_error(e):
+                raise
+            resp, error, wait = None, e, backoff_factor * 2 ** attempt
+        else:
+            if resp.status_code not in _http_config["retry_statuses"] or attempt == max_retries:
+                return resp
+            wait = retry_after_secs(resp) or backoff_factor * 2 ** attempt
+        if time.monotonic() + wait >= deadline:
+            if resp is None:
+                raise error
+            return resp
+        if resp is not None:
+            resp.close()
+        time.sleep(wait)
+
+
+class TokenBucket:
+    """ Rate limiter allowing `rate` requests/sec on average and bursts of up to `burst` requests """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError(f"invalid rate {rate}, must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited_secs = 0.0
+
+    def acquire(self):
+        """ Takes a token, sleeping until one is available; returns the secs waited """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is taken now, possibly going negative; callers behind it wait longer
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited_secs += wait
+        if wait:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,265 @@
+# Rule-based fast path that compiles common motor commands to tool actions without the LLM.
+# Anything the grammar does not fully understand is left to `get_action_steps`.
+
+from experiments.plan_cache import normalize_task
+
+
+# Defaults that the `instructions` prompt asks the LLM to use
+DEFAULT_SPEED = 50
+DEFAULT_BLOCKING = False
+TURN_DEGREES = 90
+
+MOVE_VERBS = {"go", "move", "drive", "run", "rotate", "spin", "turn"}
+FORWARD_WORDS = {"forward", "forwards", "ahead"}
+BACKWARD_WORDS = {"backward", "backwards", "back", "reverse"}
+UNITS = {"rotation": "rotations", "degree": "degrees", "second": "seconds", "sec": "seconds", "secs": "seconds"}
+UNIT_TOOLS = {"rotations": "run_for_rotations", "degrees": "run_for_degrees", "seconds": "run_for_seconds"}
+# words that may appear anywhere without changing the meaning of the command
+SKIP_WORDS = {"motor", "it", "for", "by", "can", "you", "could", "i", "want", "robot", "wheel", "again"}
+
+
+def is_number(word):
+    try:
+        float(word)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def to_number(word):
+    value = float(word)
+    return int(value) if value == int(value) else value
+
+
+class TaskParser:
+    """ Recursive-descent parser over the words of a normalized task
+
+    Each `parse_*` method either consumes the words of one clause and returns a list of
+    (description, action) pairs, or returns None leaving the position unchanged.
+    """
+
+    def __init__(self, words):
+        self.words = words
+        self.pos = 0
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.words[i] if i < len(self.words) else None
+
+    def accept(self, *options):
+        word = self.peek()
+        for option in options:
+            if word == option or (isinstance(option, (set, frozenset)) and word in option):
+                self.pos += 1
+                return word
+        return None
+
+    def skip_fillers(self):
+        while self.peek() in SKIP_WORDS:
+            self.pos += 1
+
+    def parse_number(self):
+        if is_number(self.peek()):
+            self.pos += 1
+            return to_number(self.words[self.pos - 1])
+        return None
+
+    def parse_speed(self):
+        """ [at|with] [speed] N; returns None if no speed is given """
+        start = self.pos
+        self.accept("at", "with")
+        if self.accept("speed") is not None:
+            self.skip_fillers()
+            self.accept("of", "to")
+            if (speed := self.parse_number()) is not None:
+                return speed
+        self.pos = start
+        return None
+
+    def parse_repeat(self):
+        """ N time (from "twice", "3 times", ...) """
+        if is_number(self.peek()) and self.peek(1) == "time":
+            n = int(to_number(self.peek()))
+            self.pos += 2
+            return n
+        return 1
+
+    def parse_degrees(self):
+        """ N degree; returns None (leaving the position unchanged) unless N is a positive integer """
+        if not (is_number(self.peek()) and self.peek(1) == "degree"):
+            return None
+        degrees = to_number(self.peek())
+        if not isinstance(degrees, int) or degrees <= 0:
+            return None
+        self.pos += 2
+        return degrees
+
+    def parse_turn(self):
+        """ [verb] left|right|around [N degree] ..., or [verb] N degree left|right ... """
+        start = self.pos
+        self.accept(MOVE_VERBS)
+        self.skip_fillers()
+        side = self.accept("left", "right", "around")
+        degrees = 2 * TURN_DEGREES if side == "around" else TURN_DEGREES
+        if side is None:
+            # e.g. "turn 45 degrees left"
+            if (degrees := self.parse_degrees()) is None or (side := self.accept("left", "right")) is None:
+                self.pos = start
+                return None
+        else:
+            self.skip_fillers()
+            if side != "around" and is_number(self.peek()) and self.peek(1) == "degree":
+                if (degrees := self.parse_degrees()) is None:
+                    self.pos = start
+                    return None
+        speed = self.parse_speed()
+        repeat = self.parse_repeat()
+        if speed is None:
+            speed = self.parse_speed()
+        speed = abs(speed if speed is not None else DEFAULT_SPEED)
+        action = {"name": "run_for_degrees", "degrees": degrees,
+                  "speed": -speed if side == "left" else speed, "blocking": DEFAULT_BLOCKING}
+        description = "turned around" if side == "around" else f"turned {side}"
+        if degrees != TURN_DEGREES and side != "around":
+            description += f" {degrees} degrees"
+        return [(description, dict(action)) for _ in range(repeat)]
+
+    def parse_move(self):
+        start = self.pos
+        verb = self.accept(MOVE_VERBS)
+        self.skip_fillers()
+        direction = self.accept(FORWARD_WORDS | BACKWARD_WORDS)
+        self.skip_fillers()
+        speed = self.parse_speed()
+        self.skip_fillers()
+        amount = self.parse_number()
+        unit = UNITS.get(self.peek()) if amount is not None else None
+        if unit is None:
+            self.pos = start
+            return None
+        self.pos += 1
+        if direction is None:
+            direction = self.accept(FORWARD_WORDS | BACKWARD_WORDS)
+        if verb is None and direction is None:
+            self.pos = start
+            return None
+        if speed is None:
+            speed = self.parse_speed()
+        repeat = self.parse_repeat()
+        self.skip_fillers()
+        if self.peek() in ("left", "right"):
+            # e.g. "go forward 3 rotations left": a side after the amount is left to the LLM
+            self.pos = start
+            return None
+        speed = abs(speed if speed is not None else DEFAULT_SPEED)
+        backward = direction in BACKWARD_WORDS
+        if amount < 0:
+            amount, backward = -amount, not backward
+        if not isinstance(amount, int):
+            # the prompt asks for integer parameters; leave fractions to the LLM
+            self.pos = start
+            return None
+        action = {"name": UNIT_TOOLS[unit], unit: amount,
+                  "speed": -speed if backward else speed, "blocking": DEFAULT_BLOCKING}
+        description = f"moved {'backwards' if backward else 'forward'} {amount} {unit}"
+        return [(description, dict(action)) for _ in range(repeat)]
+
+    def parse_position(self):
+        start = self.pos
+        self.accept(MOVE_VERBS)
+        self.skip_fillers()
+        if self.accept("to") is None or self.accept("position") is None:
+            self.pos = start
+            return None
+        degrees = self.parse_number()
+        if degrees is None or not isinstance(degrees, int) or not (-180 <= degrees <= 180):
+            self.pos = start
+            return None
+        self.accept("degree")
+        speed = self.parse_speed()
+        speed = abs(speed if speed is not None else DEFAULT_SPEED)
+        action = {"name": "run_to_position", "degrees": degrees, "speed": speed, "blocking": DEFAULT_BLOCKING}
+        return [(f"moved to position {degrees} degrees", action)]
+
+    def parse_start(self):
+        start = self.pos
+        if self.accept("start") is None:
+            return None
+        self.skip_fillers()
+        speed = self.parse_speed()
+        if speed is None:
+            speed = DEFAULT_SPEED
+        if self.peek() is not None and self.peek() not in ("stop", "start", "set", "turn"):
+            # e.g. "start moving backwards" is left to the LLM
+            self.pos = start
+            return None
+        return [("started the motor", {"name": "start", "speed": speed})]
+
+    def parse_stop(self):
+        if self.accept("stop") is None:
+            return None
+        self.skip_fillers()
+        return [("stopped the motor", {"name": "stop"})]
+
+    def parse_set_speed(self):
+        start = self.pos
+        if self.accept("set") is None:
+            return None
+        self.accept("default")
+        if self.accept("speed") is None:
+            self.pos = start
+            return None
+        self.accept("to")
+        speed = self.parse_number()
+        if speed is None or not isinstance(speed, int):
+            self.pos = start
+            return None
+        return [(f"set the default speed to {speed}", {"name": "set_default_speed", "default_speed": speed})]
+
+    def parse(self):
+        """ Returns the list of (description, action) pairs, or None if any word is not understood """
+        clauses = []
+        rules = [self.parse_set_speed, self.parse_position, self.parse_start, self.parse_stop,
+                 self.parse_turn, self.parse_move]
+        self.skip_fillers()
+        while self.peek() is not None:
+            for rule in rules:
+                if (clause := rule()) is not None:
+                    clauses.extend(clause)
+                    break
+            else:
+                return None
+            self.skip_fillers()
+        return clauses or None
+
+
+def is_valid_action(action):
+    speed = action.get("speed", 0)
+    if not (-100 <= speed <= 100) or (action["name"] == "run_to_position" and speed < 0):
+        return False
+    return -100 <= action.get("default_speed", 0) <= 100
+
+
+def describe(clauses):
+    """ Final answer in the style of the LLM's, e.g. "Turned left, then turned right 2 times." """
+    parts = []
+    for description, _ in clauses:
+        if parts and parts[-1][0] == description:
+            parts[-1][1] += 1
+        else:
+            parts.append([description, 1])
+    text = ", then ".join(d if n == 1 else f"{d} {n} times" for d, n in parts)
+    return text[:1].upper() + text[1:] + "."
+
+
+def compile_task(task):
+    """ Compiles `task` to (steps, answer) like `messages_to_steps` returns, without the LLM
+
+    Returns None unless every word of the task is understood, in which case the caller
+    should fall back to `get_action_steps`.
+    """
+    clauses = TaskParser(normalize_task(task).split()).parse()
+    if not clauses or not all(is_valid_action(action) for _, action in clauses):
+        return None
+    steps = [{"Thought": f"Fast path: {description}", "Action": action} for description, action in clauses]
+    return steps, describe(clauses)
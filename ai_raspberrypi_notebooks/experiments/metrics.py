@@ -0,0 +1,199 @@
+# Lightweight instrumentation: timed spans, counters and histograms per stage.
+#
+# The module-level `registry` is always on; recording a span costs two
+# `perf_counter` calls, a bisect and a dict update. Spans can additionally be written as
+# JSON lines to a file, and the totals served in the Prometheus text format:
+#   python -m experiments.control --metrics-jsonl metrics.jsonl --metrics-port 9100
+#   curl http://127.0.0.1:9100/metrics
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds in secs of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Upper bounds of the histogram buckets of counts (iterations, tokens)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return dict(count=self.count, sum=self.sum, buckets=dict(zip([*self.buckets, "+Inf"], self.counts)))
+
+
+class JSONLSink:
+    """ Appends records as JSON lines to `path`, flushing every `flush_every` records """
+
+    def __init__(self, path, flush_every=20):
+        self.file = open(path, "a", buffering=1 << 16)
+        self.flush_every = flush_every
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.pending += 1
+            if self.pending >= self.flush_every:
+                self.file.flush()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Metrics:
+    """ Registry of counters and histograms, keyed by name and labels
+
+    Args:
+        :param sink: JSONLSink
+            If provided, every span and `event` is also written to it
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def event(self, name, **fields):
+        if self.sink is not None:
+            self.sink.write(dict(ts=time.time(), event=name, **fields))
+
+    @contextmanager
+    def span(self, name, **labels):
+        """ Times the block into the `<name>_secs` histogram; yields a dict for extra fields of the record """
+        fields = {}
+        start = time.perf_counter()
+        error = None
+        try:
+            yield fields
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            secs = time.perf_counter() - start
+            self.observe(f"{name}_secs", secs, **labels)
+            if error is not None:
+                self.incr(f"{name}_errors", **labels)
+            if self.sink is not None:
+                record = dict(ts=time.time(), span=name, secs=secs, **labels, **fields)
+                if error is not None:
+                    record["error"] = error
+                self.sink.write(record)
+
+    def hit_rate(self, name):
+        """ Hit rate from the `<name>_hits` and `<name>_misses` counters """
+        with self.lock:
+            hits = sum(v for (n, _), v in self.counters.items() if n == f"{name}_hits")
+            misses = sum(v for (n, _), v in self.counters.items() if n == f"{name}_misses")
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def snapshot(self):
+        def fmt(name, labels):
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        with self.lock:
+            return dict(counters={fmt(*key): v for key, v in self.counters.items()},
+                        histograms={fmt(*key): h.as_dict() for key, h in self.histograms.items()})
+
+    def to_prometheus(self, prefix="raspberrypi_"):
+        """ Returns the counters and histograms in the Prometheus text exposition format """
+        def fmt_labels(labels, **extra):
+            items = [*labels, *extra.items()]
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {prefix}{name} counter")
+                for (n, labels), value in self.counters.items():
+                    if n == name:
+                        lines.append(f"{prefix}{name}{fmt_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                for (n, labels), h in self.histograms.items():
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for le, count in zip([*h.buckets, "+Inf"], h.counts):
+                        cumulative += count
+                        lines.append(f"{prefix}{name}_bucket{fmt_labels(labels, le=le)} {cumulative}")
+                    lines.append(f"{prefix}{name}_sum{fmt_labels(labels)} {h.sum}")
+                    lines.append(f"{prefix}{name}_count{fmt_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Metrics()
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(port=9100, host="127.0.0.1", metrics=None):
+    """ Serves `GET /metrics` from a daemon thread; returns the server """
+    server = ThreadingHTTPServer((host, port), PrometheusHandler)
+    server.daemon_threads = True
+    server.metrics = metrics or registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_metrics(jsonl_path=None, prometheus_port=None):
+    """ Sets the JSONL sink of the module-level registry and optionally serves it to Prometheus """
+    if registry.sink is not None:
+        registry.sink.close()
+    registry.sink = JSONLSink(jsonl_path) if jsonl_path else None
+    return serve_prometheus(prometheus_port) if prometheus_port else None
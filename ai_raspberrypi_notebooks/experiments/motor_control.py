@@ -1,17 +1,13 @@
 import os
 import re
+import itertools
 import traceback
-from io import BytesIO, FileIO
 import json as jsonlib
 from pprint import pprint, pformat
 import datetime
-import requests
-from requests.adapters import HTTPAdapter
-from buildhat import Motor
-import sounddevice as sd
-from scipy.io.wavfile import write
-import wavio as wv
-from openai import OpenAI
+from experiments.http_client import send_request, HTTP_READ_TIMEOUT, HTTP_CONNECT_TIMEOUT
+from experiments.metrics import registry, COUNT_BUCKETS
+from experiments.plan_optimizer import displacement, action_speed, DEFAULT_MOTOR_SPEED, DEGREES_PER_SEC_PER_SPEED
 
 
 API_URL = os.getenv("CLAUDE_API_URL")  # "https://api.anthropic.com/v1/messages"
@@ -19,22 +15,27 @@ API_KEY = os.getenv("CLAUDE_API_KEY")  # "<api_key>"
 API_VER = os.getenv("CLAUDE_API_VER")  # "2023-06-01"
 
 cache = {}
+# If set (e.g. to an `http_client.TokenBucket`), every Messages API request first calls its `acquire()`
+rate_limiter = None
+# If set (e.g. with `hedging.configure_hedging`), planning completions are requested through it
+hedger = None
+# Budget of the iterative planners per task (see `configure_planning`): max completions, and
+# max tokens (prompt and response) after which no further completion is requested (None: no limit)
+max_iterations = 10
+token_budget = None
+# If set, `get_action_steps` only lists the last `compact_history` steps in the prompt; the
+# earlier ones are summarized in a state line (see `summarize_steps`)
+compact_history = None
 
 
 def get_url_response(url, method="GET", headers=None, params=None, json=None, data=None,
-                     max_timeout=30, network_timeout=7):
+                     max_timeout=HTTP_READ_TIMEOUT, network_timeout=HTTP_CONNECT_TIMEOUT, session=None):
     resp = err_message = None
     try:
-        req = requests.Session()
-        req.mount(url, HTTPAdapter(max_retries=2))
-        if method == "GET":
-            resp = req.get(url, headers=headers, params=params, timeout=network_timeout)
-        elif method == "POST":
-            resp = req.post(url, headers=headers, params=params, json=json, data=data, timeout=network_timeout)
-        elif method == "DELETE":
-            resp = req.delete(url, headers=headers, timeout=network_timeout)
-        else:
+        if method not in ("GET", "POST", "DELETE"):
             raise ValueError(f"invalid method {method}")
+        resp = send_request(method, url, max_timeout=max_timeout, network_timeout=network_timeout, session=session,
+                            headers=headers, params=params, json=json, data=data)
     except Exception as e:
         err_message = traceback.format_exc()
         pprint(err_message)
@@ -64,26 +65,32 @@ def get_http_headers(api_key=None, api_ver=None):
     return headers
 
 
-def call_http_endpoint(data=None, url=None, api_key=None, api_ver=None, method="POST"):
-    url = url or self.url
-    api_key = api_key or self.api_key
+def call_http_endpoint(data=None, url=None, api_key=None, api_ver=None, method="POST",
+                       max_timeout=HTTP_READ_TIMEOUT, network_timeout=HTTP_CONNECT_TIMEOUT, session=None):
+    url = url or API_URL
+    api_key = api_key or API_KEY
     headers = get_http_headers(api_key=api_key, api_ver=api_ver)
     status, resp = get_url_response(url=url, method=method,
                                     headers=headers, json=data,
-                                    max_timeout=30,
-                                    network_timeout=30)
+                                    max_timeout=max_timeout,
+                                    network_timeout=network_timeout,
+                                    session=session)
     return status, resp
 
 
 def call_completion_endpoint(prompt, model=None, temperature=0.0,
-                             max_tokens=1024) -> dict:
+                             max_tokens=1024, system=None) -> dict:
     data = {
         "model": model,
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
+    if system:
+        data["system"] = system
     if isinstance(prompt, list):
         data["messages"] = prompt
+    if rate_limiter is not None:
+        rate_limiter.acquire()
     status, completion = call_http_endpoint(data=data, url=API_URL, api_key=API_KEY, api_ver=API_VER, method="POST")
     content = None
     if ("content" in completion and len(completion["content"]) > 0
@@ -95,27 +102,145 @@ def call_completion_endpoint(prompt, model=None, temperature=0.0,
     usage_ = completion.get("usage")
     usage = None
     if usage_:
-        usage = dict(resp_tokens=usage_["output_tokens"],
-                     prompt_tokens=usage_["input_tokens"],
-                     total_tokens=usage_["output_tokens"] + usage_["input_tokens"])
+        usage = get_usage(usage_)
     return content, usage, completion
 
 
-def get_completion(prompt, model="claude-3-5-sonnet-20241022", cache=None):
+def get_usage(usage_):
+    """ Converts the `usage` of a Messages API response; `prompt_tokens` includes prompt-cached tokens """
+    cached_tokens = usage_.get("cache_read_input_tokens") or 0
+    prompt_tokens = usage_["input_tokens"] + cached_tokens + (usage_.get("cache_creation_input_tokens") or 0)
+    return dict(resp_tokens=usage_["output_tokens"],
+                prompt_tokens=prompt_tokens,
+                total_tokens=usage_["output_tokens"] + prompt_tokens,
+                cached_tokens=cached_tokens)
+
+
+def parse_sse_events(lines):
+    """ Yields (event, data) from the lines of a server-sent events stream """
+    event = None
+    data = []
+    for line in lines:
+        if line is None:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event = None
+            data = []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+    if data:
+        yield event, "\n".join(data)
+
+
+def call_completion_endpoint_stream(prompt, model=None, temperature=0.0, max_tokens=1024,
+                                    usage=None, session=None, max_timeout=HTTP_READ_TIMEOUT,
+                                    network_timeout=HTTP_CONNECT_TIMEOUT):
+    """ Calls the Messages API with `stream: true` and yields the text deltas as they arrive
+
+    Args:
+        :param usage: dict
+            If provided, it is filled in with `resp_tokens`, `prompt_tokens` and `total_tokens`
+            once the stream reports them
+    """
+    data = {
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+    }
+    if isinstance(prompt, list):
+        data["messages"] = prompt
+    headers = get_http_headers(api_key=API_KEY, api_ver=API_VER)
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    with send_request("POST", API_URL, max_timeout=max_timeout, network_timeout=network_timeout, session=session,
+                      headers=headers, json=data, stream=True) as resp:
+        if not (200 <= resp.status_code < 300):
+            print(f"Response (status_code: {resp.status_code}) in error: {resp.text}")
+            return
+        input_tokens = output_tokens = 0
+        for event, payload in parse_sse_events(resp.iter_lines(decode_unicode=True)):
+            try:
+                message = jsonlib.loads(payload)
+            except ValueError:
+                continue
+            kind = message.get("type") or event
+            if kind == "content_block_delta":
+                delta = message.get("delta") or {}
+                if delta.get("type") == "text_delta" and delta.get("text"):
+                    yield delta["text"]
+            elif kind == "message_start":
+                start_usage = (message.get("message") or {}).get("usage") or {}
+                input_tokens = get_usage(dict(start_usage, input_tokens=start_usage.get("input_tokens", 0),
+                                              output_tokens=0))["prompt_tokens"]
+            elif kind == "message_delta":
+                output_tokens = (message.get("usage") or {}).get("output_tokens", output_tokens)
+            elif kind == "error":
+                print(f"Error in stream: {message.get('error')}")
+                break
+            elif kind == "message_stop":
+                break
+        if usage is not None:
+            usage.update(resp_tokens=output_tokens, prompt_tokens=input_tokens,
+                         total_tokens=output_tokens + input_tokens)
+
+
+def get_completion(prompt, model="claude-3-5-sonnet-20241022", cache=None, validate=None):
+    """ Returns (content, usage, completion) of a single-turn completion
+
+    Args:
+        :param validate: callable
+            Only used with `hedger`: a hedged answer wins only if `validate(content)` is true
+    """
     content = usage = completion = None
     if cache is not None and (val := cache.get(prompt)):
+        registry.incr("completion_cache_hits")
         if val:
             content = val.get("content")
             usage = val.get("usage")
             completion = val.get("completion")
         return content, usage, completion
+    if cache is not None:
+        registry.incr("completion_cache_misses")
     prompt_messages = [{"role": "user", "content": prompt}]
-    content, usage, completion = call_completion_endpoint(prompt=prompt_messages, model=model)
+    with registry.span("completion", model=model):
+        if hedger is not None:
+            content, usage, completion = hedger(prompt_messages, model=model, validate=validate)
+        else:
+            content, usage, completion = call_completion_endpoint(prompt=prompt_messages, model=model)
+    for k in ["prompt_tokens", "resp_tokens", "cached_tokens"]:
+        registry.incr(k, (usage or {}).get(k) or 0)
     if cache is not None:
         cache[prompt] = dict(content=content, usage=usage, completion=completion)
     return content, usage, completion
 
 
+def get_chat_completion(messages, system=None, model="claude-3-5-sonnet-20241022", cache=None, validate=None):
+    """ Same as `get_completion` for a multi-turn conversation with an optional system prompt """
+    key = jsonlib.dumps([system, messages])
+    if cache is not None and (val := cache.get(key)):
+        registry.incr("completion_cache_hits")
+        return val.get("content"), val.get("usage"), val.get("completion")
+    if cache is not None:
+        registry.incr("completion_cache_misses")
+    with registry.span("completion", model=model):
+        if hedger is not None:
+            content, usage, completion = hedger(messages, model=model, system=system, validate=validate)
+        else:
+            content, usage, completion = call_completion_endpoint(prompt=messages, model=model, system=system)
+    for k in ["prompt_tokens", "resp_tokens", "cached_tokens"]:
+        registry.incr(k, (usage or {}).get(k) or 0)
+    if cache is not None:
+        cache[key] = dict(content=content, usage=usage, completion=completion)
+    return content, usage, completion
+
+
 instructions = """
 You are an agent that translates tasks expressed in english natural language to tool APIs.
 The available tool APIs to operate motors are provided below. When an input text is provided 
@@ -161,6 +286,8 @@ specified by the task.
   11. Tasks that require turning `right` or `left` imply turn by 90 or -90 degrees as appropriate. \
   12. Values of all numerical parameters such as `degrees`, `speed`, `rotations`, \
 `seconds` must be integers.
+  13. The `port` parameter must be omitted unless the task refers to a specific motor or to more than \
+one motor; motors that should move together get one `Action` each, with their own `port`.
 
 IMPORTANT: Even though the `Observation` is part of the step format, you must never output the `Observation`.
 
@@ -174,6 +301,7 @@ Parameters:
     degrees: Number of degrees to rotate
     speed: Speed ranging from -100 to 100
     blocking: Whether call should block till finished.
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool2:
@@ -183,6 +311,7 @@ Parameters:
     rotations: Number of rotations
     speed: Speed ranging from -100 to 100
     blocking: Whether call should block till finished
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool3:
@@ -192,6 +321,7 @@ Parameters:
     seconds: Time in seconds
     speed: Speed ranging from -100 to 100
     blocking: Whether call should block till finished
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool4:
@@ -202,6 +332,7 @@ Parameters:
     speed: Speed ranging from 0 to 100
     blocking: Whether call should block till finished
     direction: shortest (default)/clockwise/anticlockwise
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool5:
@@ -209,6 +340,7 @@ Name: set_default_speed
 Description: Set the default speed of the motor.
 Parameters:
     default_speed: Speed ranging from -100 to 100
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool6:
@@ -216,11 +348,14 @@ Name: start
 Description: Start motor.
 Parameters:
     speed: Speed ranging from -100 to 100
+    port: Build HAT port of the motor: A (default), B, C or D
 
 
 Tool7:
 Name: stop
 Description: Stop motor.
+Parameters:
+    port: Build HAT port of the motor: A (default), B, C or D
 
 </tools>
 
@@ -233,6 +368,89 @@ Task: ```{task}```
 """
 
 
+# Variant of `instructions` that asks for the whole plan in a single completion
+plan_instructions = instructions.replace(
+    "You may output only the `Thought`, `Action`, and `Final Answer` if applicable for the next step, and wait "
+    "for the user to provide the `Observation` in case it is needed.",
+    "You must output the complete sequence of `Thought` and `Action` steps required for the task in one "
+    "response, one `Action` per step, followed by the `Final Answer`. Do not wait for the user to provide "
+    "the `Observation`; every `Action` will be assumed to succeed.",
+).replace(
+    "Begin! Output the next steps's `Thought`, `Action`, and `Final Answer` (if applicable).",
+    "Begin! Output the `Thought` and `Action` of all the steps, and then the `Final Answer`.",
+)
+
+
+# Compact alternative to `instructions` for `get_action_steps_compact`: the static part is
+# sent as the (prompt-cached) system prompt, with a tool schema generated by `make_tool_schema`,
+# and the steps so far are sent as conversation turns instead of being re-formatted into it
+compact_instructions = """You translate tasks in English into calls of the motor tools listed below.
+Reply with one step at a time, in this format:
+Thought: <your reasoning>
+Action: <JSON on a single line, e.g. {{"name": "<tool>", "<param>": <value>}}>
+The user replies with `Observation: <result>`; never write the Observation yourself.
+When the task is done, reply:
+Thought: I now know the final answer
+Final Answer: <the final answer>
+
+Rules:
+- If no tool can do a step, the Action is {{"error": "no tool applicable"}}.
+- `blocking` is false and `speed` is 50 unless the task says otherwise.
+- Forwards or right: positive speed. Backwards or left: negative speed. No direction: forwards.
+- Turning right or left is 90 degrees with run_for_degrees.
+- All numbers are integers.
+- Omit `port` unless the task names a motor or moves more than one motor (one Action per motor).
+
+Tools:
+{tools}"""
+
+TOOL_SUMMARIES = {
+    "run_for_degrees": "rotate N degrees; preferred to go forwards/backwards or turn left/right",
+    "run_for_rotations": "rotate N rotations",
+    "run_for_seconds": "run for N seconds",
+    "run_to_position": "run to an absolute position",
+    "set_default_speed": "set the default speed",
+    "start": "start running",
+    "stop": "stop",
+}
+PARAM_SPECS = {
+    "degrees": "int",
+    "rotations": "int",
+    "seconds": "int",
+    "default_speed": "int -100..100",
+    "speed": "int -100..100",
+    "blocking": "bool",
+    "direction": "shortest|clockwise|anticlockwise",
+    "port": "A|B|C|D",
+}
+# (tool, param) specs that differ from `PARAM_SPECS`
+TOOL_PARAM_SPECS = {
+    ("run_to_position", "degrees"): "int -180..180",
+    ("run_to_position", "speed"): "int 0..100",
+}
+OPTIONAL_PARAMS = {"direction", "port"}
+
+
+def make_tool_schema(funcs):
+    """ One line per tool of `funcs`, e.g. `run_for_degrees(degrees: int, speed: int -100..100, ...) - ...` """
+    order = list(PARAM_SPECS)
+    lines = []
+    for name, f_def in funcs.items():
+        params = sorted(f_def.get("params") or (), key=lambda p: (order.index(p) if p in order else len(order), p))
+        args = ", ".join(
+            f"{p}{'?' if p in OPTIONAL_PARAMS else ''}: {TOOL_PARAM_SPECS.get((name, p), PARAM_SPECS.get(p, 'any'))}"
+            for p in params)
+        summary = TOOL_SUMMARIES.get(name)
+        lines.append(f"{name}({args})" + (f" - {summary}" if summary else ""))
+    return "\n".join(lines)
+
+
+def compact_system_prompt(funcs):
+    """ Returns the system prompt blocks, marked for prompt caching """
+    text = compact_instructions.format(tools=make_tool_schema(funcs))
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
 model = "claude-3-5-sonnet-20241022"
 # prompt = [{"role": "user", "content": "Hello, world"}]
 
@@ -245,62 +463,195 @@ model = "claude-3-5-sonnet-20241022"
 # pprint(content)
 
 
-BEGIN_KEY = re.compile(r'^\s*(Thought|Action|Observation|Final Answer)\s*:', flags=re.MULTILINE|re.IGNORECASE)
-
-
-def skip_char(text, char):
-    if not text:
-        return text
-    pos = text.find(char)
-    if pos >= 0:
-        return text[(pos + 1):]
-    return text
+# A key starts a line: optional indent, the key (any case), optional spaces and a colon
+STEP_KEY = re.compile(r'^[ \t]*(Thought|Action|Observation|Final Answer)[ \t]*:', flags=re.MULTILINE|re.IGNORECASE)
+STEP_KEYS = ("Thought", "Action", "Observation", "Final Answer")
+json_decoder = jsonlib.JSONDecoder()
+
+
+class ReActEntry:
+    """ A `Thought`, `Action`, `Observation` or `Final Answer` of a completion, as offsets into its text
+
+    For an `Action`, `action` is the decoded JSON (None if it does not decode) and `error` the
+    reason it is invalid: a JSON error, the model's own `error`, or a failed validation.
+    """
+    __slots__ = ("parser", "key", "is_action", "start", "end", "text", "action", "error")
+
+    def __init__(self, parser, key, start):
+        self.parser = parser
+        self.key = key
+        self.is_action = key.lower() == "action"
+        self.start = start
+        self.end = None
+        self.text = None  # sliced out of the parser's text once the entry is complete
+        self.action = None
+        self.error = None
+
+    @property
+    def value(self):
+        if self.text is None:
+            return self.parser.text[self.start - self.parser.base:].strip()
+        return self.text.strip()
+
+    def as_action(self):
+        """ The decoded `Action` with `error` set if it is invalid; only `error` if it is not a JSON object """
+        if not isinstance(self.action, dict):
+            return {"error": self.error}
+        if self.error and not self.action.get("error"):
+            return dict(self.action, error=self.error)
+        return self.action
+
+
+class ReActParser:
+    """ Single-pass, incremental parser of the ReAct entries of a completion
+
+    Text is fed in arbitrary chunks and each complete line is scanned once for keys; the parser
+    only keeps the text it has not scanned yet and that of the open entry, so feeding a long
+    stream does not copy it over and over. An
+    `Action` is decoded once, as soon as its JSON object is complete (so it can be executed
+    while the rest of a plan is streamed), and validated against the params of `funcs` if given
+    (see `validate_action`); text after the object up to the next key is ignored. Other entries
+    are complete when the next key begins or the text is closed.
+    """
+
+    def __init__(self, funcs=None, strict=False):
+        self.funcs = funcs
+        self.strict = strict
+        self.text = ""  # the text from offset `base` on
+        self.base = 0
+        self.pos = 0  # offset of the first line not scanned yet
+        self.entries = []
+        self.open = None
+
+    @classmethod
+    def parse(cls, text, funcs=None, strict=False):
+        """ Returns a parser that has read the whole `text` """
+        parser = cls(funcs=funcs, strict=strict)
+        parser.text = text
+        parser.close()
+        return parser
+
+    def set_action(self, entry, action):
+        entry.action = action
+        if self.funcs is not None:
+            entry.error = validate_action(action, self.funcs, strict=self.strict)
+        elif not isinstance(action, dict):
+            entry.error = f"action is not a JSON object: {action}"
+        else:
+            entry.error = action.get("error")
+
+    def try_action(self):
+        """ Completes the open `Action` if its JSON object is complete; returns the entry or None """
+        entry = self.open
+        text = self.text
+        start = entry.start - self.base
+        while start < len(text) and text[start] in " \t\r\n":
+            start += 1
+        if start == len(text) or text[start] != "{":
+            return None
+        try:
+            action, end = json_decoder.raw_decode(text, start)
+        except ValueError:
+            return None
+        self.set_action(entry, action)
+        entry.text = text[start:end]
+        entry.start = self.base + start
+        entry.end = self.base + end
+        self.open = None
+        return entry
+
+    def complete(self, end):
+        entry, self.open = self.open, None
+        entry.end = end
+        entry.text = self.text[entry.start - self.base:end - self.base]
+        if entry.is_action:
+            try:
+                self.set_action(entry, jsonlib.loads(entry.text))
+            except ValueError as e:
+                entry.error = f"Error in parsing action: {e}"
+        return entry
+
+    def scan(self, end):
+        """ Scans the lines from `pos` to `end` for keys; returns the entries completed """
+        completed = []
+        if self.open is not None and self.open.is_action and (entry := self.try_action()) is not None:
+            completed.append(entry)
+        for m in STEP_KEY.finditer(self.text, self.pos - self.base, end - self.base):
+            if self.open is not None:
+                completed.append(self.complete(self.base + m.start()))
+            self.open = entry = ReActEntry(self, m.group(1), self.base + m.end())
+            self.entries.append(entry)
+            if entry.is_action and (entry := self.try_action()) is not None:
+                completed.append(entry)
+        self.pos = end
+        self.trim()
+        return completed
+
+    def trim(self):
+        """ Drops the text before the unscanned lines and the open entry """
+        keep = self.pos if self.open is None else min(self.pos, self.open.start)
+        if keep > self.base:
+            self.text = self.text[keep - self.base:]
+            self.base = keep
+
+    def feed(self, text):
+        """ Returns the entries completed by `text` """
+        self.text += text
+        if "\n" in text:
+            return self.scan(self.base + self.text.rfind("\n") + 1)
+        if "}" in text and self.open is not None and self.open.is_action:
+            # the JSON object of the open action may end before its line does
+            if (entry := self.try_action()) is not None:
+                self.trim()
+                return [entry]
+        return ()
+
+    def close(self):
+        """ Returns the entries completed by the end of the text """
+        completed = self.scan(self.base + len(self.text))
+        if self.open is not None:
+            completed.append(self.complete(self.base + len(self.text)))
+        return completed
+
+    def first_step(self):
+        """ Returns (thought_action, action entry or None) of the first step, as `parse_thought_action` """
+        thought_action = {}
+        action_entry = None
+        found = set()
+        for entry in self.entries:
+            key = entry.key
+            if key in found:
+                continue
+            found.add(key)
+            if action_entry is not None and key in STEP_KEYS:
+                break
+            elif key == "Observation":
+                continue
+            value = entry.value
+            if key == "Action" and value:
+                action_entry = entry
+            thought_action[key] = value
+        return thought_action, action_entry
 
 
 def parse_thought_action_list(text, first_only=True):
-    # print(f"Parsing:\n{text}")
-    iter = BEGIN_KEY.finditer(text)
+    """ Returns the entries of `text` as dicts with `key` and `value`, only the first of each key if `first_only` """
     values = []
-    prev_key = None
-    prev_pos = 0
-    for m in iter:
-        pos = m.start()
-        if prev_key is not None:
-            values.append(dict(key=prev_key, value=skip_char(text[prev_pos:pos], ":").strip()))
-        key = m.group(1)
-        prev_key = key
-        prev_pos = pos
-    if prev_key is not None:
-        values.append(dict(key=prev_key, value=skip_char(text[prev_pos:], ":").strip()))
-    # pprint(values)
-    if first_only:
-        new_values = []
-        found = set()
-        for v in values:
-            key = v.get("key")
-            val = v.get("value")
-            if key not in found:
-                found.add(key)
-                new_values.append(v)
-        values = new_values
+    found = set()
+    for entry in ReActParser.parse(text).entries:
+        if first_only:
+            if entry.key in found:
+                continue
+            found.add(entry.key)
+        values.append(dict(key=entry.key, value=entry.value))
     return values
 
 
 def parse_thought_action(text):
-    parsed = parse_thought_action_list(text)
-    action_found = False
-    ta = {}
-    for item in parsed:
-        key = item.get("key")
-        value = item.get("value")
-        if action_found and key in ["Thought", "Action", "Observation", "Final Answer"]:
-            break
-        elif key in ["Observation"]:
-            continue
-        elif key == "Action" and value:
-            action_found = True
-        ta[key] = value
-    return ta
+    """ Returns the `Thought`, `Action` (JSON text) and/or `Final Answer` of the first step of `text` """
+    with registry.span("parse"):
+        thought_action, action_entry = ReActParser.parse(text).first_step()
+    return thought_action
 
 
 def format_messages(messages):
@@ -316,6 +667,88 @@ def format_messages(messages):
     return("\n\n".join(mlist))
 
 
+def describe_motion(port, motion):
+    """ Where a motor is according to `summarize_steps` """
+    if motion["running"] is not None:
+        return f"{port} motor running at speed {motion['running']} (position unknown)"
+    if motion["reference"] is None:
+        return f"{port} motor ran freely, then turned {round(motion['net']):+d} degrees (position unknown)"
+    about = "about " if motion["estimated"] else ""
+    return f"{port} motor {about}{round(motion['net']):+d} degrees from the {motion['reference']}"
+
+
+def summarize_steps(steps, observations=()):
+    """ State line replacing completed steps in a compacted prompt: the number of steps, the
+    tools called, and how far each motor turned since the start (or its last `run_to_position`)
+
+    Timed moves are estimated at the Build HAT's ramp rate; after `start` the position is unknown.
+    """
+    counts = {}
+    default_speeds = {}
+    motions = {}  # port -> reference position (None: unknown), net degrees since, estimated, running speed
+    for step in steps:
+        action = step.get("Action") or {}
+        name = action.get("name") or "error"
+        counts[name] = counts.get(name, 0) + 1
+        port = action.get("port") or "default"
+        default_speed = default_speeds.get(port, DEFAULT_MOTOR_SPEED)
+        motion = motions.get(port, dict(reference="start", net=0, estimated=False, running=None))
+        if name == "set_default_speed":
+            default_speeds[port] = action.get("default_speed", default_speed)
+            continue
+        elif name == "run_to_position":
+            motion = dict(motion, reference=f"position {action.get('degrees') or 0}", net=0, estimated=False)
+        elif name == "run_for_seconds":
+            degrees = action_speed(action, default_speed) * DEGREES_PER_SEC_PER_SPEED * (action.get("seconds") or 0)
+            motion = dict(motion, net=motion["net"] + degrees, estimated=True)
+        elif name == "start":
+            motion = dict(motion, reference=None, net=0, running=action_speed(action, default_speed))
+        elif name == "stop":
+            if port not in motions:
+                continue
+            motion = dict(motion, running=None)
+        elif (degrees := displacement(action, default_speed)) is not None:
+            motion = dict(motion, net=motion["net"] + degrees)
+        else:
+            continue
+        motions[port] = motion
+    tools = ", ".join(f"{name} x{n}" for name, n in counts.items())
+    failed = sum(1 for observation in observations if observation and observation.startswith("Failed"))
+    if failed:
+        tools += f"; {failed} failed"
+    moved = "; ".join(describe_motion(port, motion) for port, motion in motions.items())
+    tools = f" ({tools})" if tools else ""
+    return f"State: {len(steps)} steps done{tools}; {moved or 'no motor moved'}. Only the last steps are listed below."
+
+
+def format_history(messages, formatted, steps, keep_last=None):
+    """ Returns the `thought_actions` of the prompt: the `formatted` messages, or with `keep_last`,
+    a state line of the earlier executed steps followed by the last `keep_last` messages
+    """
+    if keep_last is None or len(messages) <= keep_last:
+        return "\n\n".join(filter(None, formatted))
+    done = len(messages) - keep_last
+    # the executed messages have an `Observation` and their actions are the first steps
+    observations = [message["Observation"] for message in messages[:done] if "Observation" in message]
+    state = summarize_steps(steps[:len(observations)], observations)
+    return "\n\n".join(filter(None, [state] + formatted[done:]))
+
+
+def configure_planning(iterations=10, tokens=None, keep_last=None):
+    """ Sets the per-task budget of the iterative planners and the history compaction of `get_action_steps`
+
+    Args:
+        :param iterations: int
+            Max completions per task
+        :param tokens: int
+            If provided, no completion is requested once a task has used this many tokens
+        :param keep_last: int
+            If provided, only the last `keep_last` steps are listed in the prompt after a state line
+    """
+    global max_iterations, token_budget, compact_history
+    max_iterations, token_budget, compact_history = iterations, tokens, keep_last
+
+
 def make_f(name):
     def tf(**args):
         return f"invoked tool {name} with {args}"
@@ -331,6 +764,8 @@ class DummyMotor:
         self.set_default_speed = make_f("set_default_speed executed successfully")
         self.start = make_f("start executed successfully")
         self.stop = make_f("stop executed successfully")
+        self.coast = make_f("coast executed successfully")
+        self.off = make_f("off executed successfully")
 
 
 def prepare_motor_funcs(motor_a):
@@ -346,12 +781,58 @@ def prepare_motor_funcs(motor_a):
     return funcs
 
 
-def get_motor_funcs(dummy=False):
+MOTOR_PORTS = ("A", "B", "C", "D")
+
+
+def get_motor(port="A", dummy=False, **sim_options):
+    """ Returns a motor for `port`: a Build HAT motor, a `DummyMotor` if `dummy` is True, or a
+    `SimulatedMotor` that takes time to move if `dummy` is "sim" (configured by `sim_options`)
+    """
+    if dummy == "sim":
+        from experiments.motor_sim import SimulatedMotor
+        return SimulatedMotor(port, **sim_options)
     if dummy:
-        motor = DummyMotor()
-    else:
-        motor = Motor('A')
-    return motor, prepare_motor_funcs(motor)
+        return DummyMotor()
+    # imported on first use: importing buildhat is slow and only needed with the Build HAT attached
+    from buildhat import Motor
+    return Motor(port)
+
+
+def make_port_f(motors, name, default_port):
+    def pf(port=None, **args):
+        port = str(port or default_port).upper()
+        if port not in motors:
+            raise ValueError(f"No motor on port {port}, must be one of {sorted(motors)}")
+        return getattr(motors[port], name)(**args)
+    return pf
+
+
+def prepare_port_funcs(motors, default_port=None):
+    """ Motor functions that take an optional `port` parameter to select one of `motors`
+
+    Args:
+        :param motors: dict
+            Motors by Build HAT port name
+        :param default_port: str
+            Port used by actions without a `port` (default: the first of `motors`)
+    """
+    default_port = default_port or next(iter(motors))
+    funcs = prepare_motor_funcs(motors[default_port])
+    return {
+        name: {"f": make_port_f(motors, name, default_port), "params": set(f_def["params"]) | {"port"}}
+        for name, f_def in funcs.items()
+    }
+
+
+def get_port_funcs(ports=MOTOR_PORTS[:1], dummy=False, **sim_options):
+    """ Returns (motors by port, functions dispatching on the `port` of each action) """
+    motors = {port: get_motor(port, dummy=dummy, **sim_options) for port in ports}
+    return motors, prepare_port_funcs(motors)
+
+
+def get_motor_funcs(dummy=False, **sim_options):
+    motors, funcs = get_port_funcs(("A",), dummy=dummy, **sim_options)
+    return motors["A"], funcs
 
 
 def invoke_tool(d, funcs):
@@ -364,8 +845,12 @@ def invoke_tool(d, funcs):
     params = {k: v for k, v in d.items() if k in all_params}
     observation = None
     try:
-        f(**params)
+        with registry.span("invoke_tool", tool=name):
+            f(**params)
         observation = f"Executed tool {name} with {params}"
+        # motor state, if telemetry is attached to the funcs (see `experiments.telemetry`)
+        if (observe := f_def.get("observe")) is not None and (state := observe(params)):
+            observation = f"{observation}. {state}"
     except Exception as e:
         print(e)
         pprint(d)
@@ -396,43 +881,349 @@ def messages_to_steps(messages):
     return steps, answer
 
 
-def get_action_steps(task, funcs):
+def update_metrics(metrics, usage=None, round_trips=1):
+    """ Accumulates round trips and token usage of a completion call into `metrics` (if not None) """
+    if metrics is None:
+        return
+    metrics["round_trips"] = metrics.get("round_trips", 0) + round_trips
+    for k in ["prompt_tokens", "resp_tokens", "total_tokens", "cached_tokens"]:
+        metrics[k] = metrics.get(k, 0) + ((usage or {}).get(k) or 0)
+    metrics["max_prompt_tokens"] = max(metrics.get("max_prompt_tokens", 0), (usage or {}).get("prompt_tokens") or 0)
+
+
+def within_budget(planner, task_usage, iteration, iterations, tokens):
+    """ Returns False (and says why) if a task has used up its iterations or tokens """
+    if iteration >= iterations:
+        print(f"Planning stopped after {iterations} iterations")
+    elif tokens is not None and task_usage.get("total_tokens", 0) >= tokens:
+        print(f"Planning stopped after {task_usage['total_tokens']} tokens (budget {tokens})")
+    else:
+        return True
+    registry.incr("plan_budget_exhausted", planner=planner)
+    return False
+
+
+def parse_step(content, funcs, parsed=None):
+    """ Returns (thought_action, action entry or None) of the first step of a completion
+
+    If provided, `parsed` has the steps of the completions `is_valid_step` already parsed.
+    """
+    if parsed and (step := parsed.pop(content, None)) is not None:
+        return step
+    with registry.span("parse"):
+        return ReActParser.parse(content, funcs=funcs).first_step()
+
+
+def execute_step(thought_action, action_entry, funcs, steps):
+    """ Appends the decoded action of a parsed step to `steps` and invokes it, setting its `Observation`
+
+    Returns False if the planning loop should stop: the action does not decode, is the model's
+    `error`, or names no tool of `funcs`.
+    """
+    action = action_entry.action if action_entry is not None else None
+    if action is None:
+        print(action_entry.error if action_entry is not None else "Empty action")
+        return False
+    steps.append({"Action": action, "Thought": thought_action.get("Thought")})
+    pprint(action)
+    if error := action_entry.error:
+        print(error)
+        return False
+    thought_action["Observation"] = invoke_tool(action, funcs)
+    return True
+
+
+def get_action_steps(task, funcs, metrics=None, cancel=None, iterations=None, tokens=None, keep_last=None):
+    """ Plans `task` with the iterative ReAct loop, one completion per step
+
+    Args:
+        :param metrics: dict
+            If provided, filled in with `round_trips`, token usage and `secs` for the task
+        :param cancel: threading.Event
+            If provided and set, planning stops before the next completion call
+        :param iterations, tokens, keep_last:
+            Budget and history compaction (default: `max_iterations`, `token_budget` and
+            `compact_history`, see `configure_planning`)
+    """
+    iterations = max_iterations if iterations is None else iterations
+    tokens = token_budget if tokens is None else tokens
+    keep_last = compact_history if keep_last is None else keep_last
+    start = datetime.datetime.now()
     steps = []
     answer = messages = None
+    task_usage = {}
     if not task:
         print(f"No task given: {task}")
     else:
         messages = []
-        for i in range(10):
-            fmessages = format_messages(messages)
+        formatted = []  # `format_messages` of each message, so the history is not reformatted every iteration
+        full_chars = saved_chars = 0
+        parsed = {}  # steps of the completions validated by the hedger, so that each is parsed once
+        for i in itertools.count():
+            parsed.clear()
+            if cancel is not None and cancel.is_set():
+                print("Planning cancelled")
+                break
+            if not within_budget("iterative", task_usage, i, iterations, tokens):
+                break
+            fmessages = format_history(messages, formatted, steps, keep_last)
+            saved_chars += full_chars - len(fmessages)
             if False and messages:
                 print(f"Formatted messages>>>>>:\n{fmessages}\n=========")
             prompt = instructions.format(task=task, thought_actions=fmessages)
-            content, usage, completion = get_completion(prompt=prompt, model=model, cache=cache)
+            content, usage, completion = get_completion(prompt=prompt, model=model, cache=cache,
+                                                        validate=lambda c: is_valid_step(c, funcs, parsed))
+            update_metrics(metrics, usage)
+            update_metrics(task_usage, usage)
             if not content:
                 print(f"oh, oh! Failed to get response")
                 break
-            try:
-                thought_action = parse_thought_action(content)
-                messages.append(thought_action)
-                # print("==Thought action==")
-                # pprint(thought_action)
-                if "Final Answer" in thought_action:
-                    break
-                if "Action" in thought_action:
-                    json_content = jsonlib.loads(thought_action.get("Action"))
-                    pprint(json_content)
-                    if error := json_content.get("error"):
-                        print(error)
-                        break
-                    observation = invoke_tool(json_content, funcs)
-                    thought_action["Observation"] = observation
-            except Exception as e:
-                print(e)
-                print(content)
+            thought_action, action_entry = parse_step(content, funcs, parsed)
+            messages.append(thought_action)
+            if "Final Answer" in thought_action:
+                answer = thought_action.get("Final Answer") or None
                 break
+            if "Action" in thought_action:
+                if not execute_step(thought_action, action_entry, funcs, steps):
+                    break
+            formatted.append(text := format_messages([thought_action]))
+            if text:
+                full_chars += len(text) + 2 * (full_chars > 0)
         if False and messages:
             print(f"Final messages>>>>>:\n{format_messages(messages)}\n=========")
-        if messages:
-            steps, answer = messages_to_steps(messages)
+        if keep_last is not None:
+            # ~4 characters per token
+            task_usage["saved_prompt_tokens"] = saved_chars // 4
+            if metrics is not None:
+                metrics["saved_prompt_tokens"] = metrics.get("saved_prompt_tokens", 0) + saved_chars // 4
+            registry.observe("plan_saved_prompt_tokens", saved_chars // 4, buckets=COUNT_BUCKETS, planner="iterative")
+            print(f"History compaction saved ~{saved_chars // 4} of "
+                  f"{task_usage.get('prompt_tokens', 0) + saved_chars // 4} prompt tokens")
+    record_task_usage("iterative", task_usage, steps)
+    if metrics is not None:
+        metrics["secs"] = metrics.get("secs", 0) + (datetime.datetime.now() - start).total_seconds()
+    return steps, answer, messages
+
+
+def record_task_usage(planner, task_usage, steps):
+    """ Records the round trips (ReAct iterations) and tokens used to plan one task """
+    registry.observe("plan_round_trips", task_usage.get("round_trips", 0), buckets=COUNT_BUCKETS, planner=planner)
+    registry.observe("plan_prompt_tokens", task_usage.get("prompt_tokens", 0), buckets=COUNT_BUCKETS, planner=planner)
+    registry.observe("plan_resp_tokens", task_usage.get("resp_tokens", 0), buckets=COUNT_BUCKETS, planner=planner)
+    registry.event("plan", planner=planner, steps=len(steps), **task_usage)
+
+
+def validate_action(action, funcs, strict=False):
+    """ Returns an error message if `action` does not name a tool in `funcs`, else None
+
+    With `strict`, attributes other than `name` must also be among the tool's params.
+    """
+    if not isinstance(action, dict):
+        return f"action is not a JSON object: {action}"
+    if error := action.get("error"):
+        return error
+    name = action.get("name")
+    if not name or name not in funcs:
+        return f"invalid tool name: {name}"
+    if strict and (invalid := set(action) - {"name"} - set(funcs[name].get("params"))):
+        return f"invalid params for tool {name}: {sorted(invalid)}"
+    return None
+
+
+def is_valid_step(content, funcs, parsed=None):
+    """ True if the first step of `content` is a `Final Answer`, the model's `error` action, or an
+    `Action` that validates against the params of `funcs`
+
+    If provided, the step is stored in `parsed` under `content`, for `parse_step`.
+    """
+    step = parse_step(content, funcs)
+    if parsed is not None:
+        parsed[content] = step
+    thought_action, action_entry = step
+    if "Final Answer" in thought_action:
+        return True
+    if action_entry is None or not isinstance(action := action_entry.action, dict):
+        return False
+    return bool(action.get("error")) or validate_action(action, funcs, strict=True) is None
+
+
+def stream_action_steps(task, funcs, model=model):
+    """ Streams the plan for `task` and yields each step as soon as its `Action` is parsed
+
+    The whole plan is requested in one completion with `plan_instructions`, so the steps
+    can be executed while the model is still writing the rest of the plan.
+
+    Args:
+        :param funcs: dict
+            Motor functions; only used to validate the tool names in each `Action`
+
+    Yields dicts with `Thought` and `Action` (decoded JSON), and finally a dict with
+    `Final Answer` if the model provides one. The generator stops at the first invalid `Action`,
+    yielding it with an `error` attribute so the caller can report it.
+    """
+    if not task:
+        print(f"No task given: {task}")
+        return
+    start = datetime.datetime.now()
+    prompt = plan_instructions.format(task=task, thought_actions="")
+    prompt_messages = [{"role": "user", "content": prompt}]
+    parser = ReActParser(funcs=funcs)
+    thought = None
+    n_actions = 0
+    stream = call_completion_endpoint_stream(prompt=prompt_messages, model=model)
+    try:
+        # the trailing None flushes whatever the parser still holds once the stream ends
+        for text in itertools.chain(stream, [None]):
+            entries = parser.close() if text is None else parser.feed(text)
+            for entry in entries:
+                key = entry.key.lower()
+                if key == "thought":
+                    thought = entry.value
+                elif key == "final answer":
+                    yield {"Thought": thought, "Final Answer": entry.value}
+                    return
+                elif key == "action":
+                    action = entry.as_action()
+                    if n_actions == 0:
+                        secs = (datetime.datetime.now() - start).total_seconds()
+                        print(f"Time to first action: {secs} secs")
+                    n_actions += 1
+                    yield {"Thought": thought, "Action": action}
+                    thought = None
+                    if action.get("error"):
+                        return
+    finally:
+        stream.close()
+        secs = (datetime.datetime.now() - start).total_seconds()
+        print(f"Time for streamed plan: {secs} secs, {n_actions} actions")
+
+
+def get_action_steps_single_shot(task, funcs, metrics=None, cancel=None):
+    """ Plans `task` with a single completion instead of one completion per ReAct step
+
+    All `Thought`/`Action` steps are requested at once with `plan_instructions` and parsed
+    with `ReActParser`. The observations are synthesized by
+    invoking the actions on `funcs` (the dummy motor), so the returned messages look the same
+    as those of `get_action_steps`. Falls back to `get_action_steps` if the plan does not
+    validate against the tool params.
+
+    Returns the same (steps, answer, messages) as `get_action_steps`.
+    """
+    start = datetime.datetime.now()
+    if not task:
+        print(f"No task given: {task}")
+        return [], None, None
+    prompt = plan_instructions.format(task=task, thought_actions="")
+    content, usage, completion = get_completion(prompt=prompt, model=model, cache=cache)
+    update_metrics(metrics, usage)
+    messages = []
+    steps = []
+    answer = error = None
+    if not content:
+        error = "failed to get response"
+    else:
+        thought = None
+        with registry.span("parse"):
+            entries = ReActParser.parse(content, funcs=funcs, strict=True).entries
+        for entry in entries:
+            key = entry.key
+            if key == "Thought":
+                thought = entry.value
+            elif key == "Final Answer":
+                messages.append({"Thought": thought, "Final Answer": entry.value})
+                answer = entry.value or None
+                break
+            elif key == "Action":
+                if (action := entry.action) is None:
+                    error = entry.error
+                    break
+                thought_action = {"Thought": thought, "Action": entry.value}
+                thought = None
+                if isinstance(action, dict) and action.get("error"):
+                    # the model found no applicable tool; this ends the plan as in `get_action_steps`
+                    messages.append(thought_action)
+                    steps.append({"Action": action, "Thought": thought_action["Thought"]})
+                    break
+                if error := entry.error:
+                    break
+                thought_action["Observation"] = invoke_tool(action, funcs)
+                messages.append(thought_action)
+                steps.append({"Action": action, "Thought": thought_action["Thought"]})
+        if not error and not messages:
+            error = "no steps found"
+    if metrics is not None:
+        metrics["secs"] = metrics.get("secs", 0) + (datetime.datetime.now() - start).total_seconds()
+    if error:
+        print(f"Single-shot plan is invalid ({error}), falling back to iterative planning")
+        registry.incr("plan_fallbacks", planner="single_shot")
+        if metrics is not None:
+            metrics["fallback"] = True
+        if cancel is not None and cancel.is_set():
+            return [], None, messages
+        return get_action_steps(task, funcs, metrics=metrics, cancel=cancel)
+    task_usage = {}
+    update_metrics(task_usage, usage)
+    record_task_usage("single_shot", task_usage, steps)
     return steps, answer, messages
+
+
+def get_action_steps_compact(task, funcs, metrics=None, cancel=None, iterations=None, tokens=None):
+    """ Plans `task` with the iterative ReAct loop using the compact prompt
+
+    The system prompt (`compact_instructions` with the tool schema of `funcs`) is the same on
+    every iteration so that it can be served from the prompt cache, and each step is appended
+    to the conversation as an assistant turn followed by a user turn with its `Observation`.
+    Takes the same arguments and returns the same (steps, answer, messages) as `get_action_steps`;
+    the history is not compacted, which would change the cached prefix of every request.
+    """
+    iterations = max_iterations if iterations is None else iterations
+    tokens = token_budget if tokens is None else tokens
+    start = datetime.datetime.now()
+    steps = []
+    answer = messages = None
+    task_usage = {}
+    if not task:
+        print(f"No task given: {task}")
+    else:
+        system = compact_system_prompt(funcs)
+        chat = [{"role": "user", "content": f"Task: ```{task}```"}]
+        messages = []
+        parsed = {}  # steps of the completions validated by the hedger, so that each is parsed once
+        for i in itertools.count():
+            parsed.clear()
+            if cancel is not None and cancel.is_set():
+                print("Planning cancelled")
+                break
+            if not within_budget("compact", task_usage, i, iterations, tokens):
+                break
+            content, usage, completion = get_chat_completion(chat, system=system, model=model, cache=cache,
+                                                             validate=lambda c: is_valid_step(c, funcs, parsed))
+            update_metrics(metrics, usage)
+            update_metrics(task_usage, usage)
+            if not content:
+                print(f"oh, oh! Failed to get response")
+                break
+            thought_action, action_entry = parse_step(content, funcs, parsed)
+            messages.append(thought_action)
+            if "Final Answer" in thought_action:
+                answer = thought_action.get("Final Answer") or None
+                break
+            if "Action" not in thought_action:
+                print(f"No action in response: {content}")
+                break
+            if not execute_step(thought_action, action_entry, funcs, steps):
+                break
+            chat.append({"role": "assistant", "content": format_messages([{k: v for k, v in thought_action.items()
+                                                                           if k != "Observation"}])})
+            chat.append({"role": "user", "content": f"Observation: {thought_action['Observation']}"})
+    record_task_usage("compact", task_usage, steps)
+    if metrics is not None:
+        metrics["secs"] = metrics.get("secs", 0) + (datetime.datetime.now() - start).total_seconds()
+    return steps, answer, messages
+
+
+planners = {
+    "iterative": get_action_steps,
+    "single_shot": get_action_steps_single_shot,
+    "compact": get_action_steps_compact,
+}
@@ -0,0 +1,71 @@
+# Executes a plan on several motors at once: the steps of each Build HAT port run in order
+# on their own thread, and the steps of different ports run concurrently.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from experiments.motor_control import invoke_tool
+
+
+def action_port(action, default_port="A"):
+    return str(action.get("port") or default_port).upper()
+
+
+def split_by_port(thought_actions, default_port="A"):
+    """ Returns ({port: [thought_action, ...]} in plan order, final answer or None) """
+    by_port = {}
+    for thought_action in thought_actions:
+        if "Final Answer" in thought_action:
+            return by_port, thought_action.get("Final Answer")
+        action = thought_action.get("Action") or {}
+        by_port.setdefault(action_port(action, default_port), []).append(thought_action)
+    return by_port, None
+
+
+def run_port_steps(port, thought_actions, funcs):
+    """ Executes the steps of one port in order; each move blocks until the motor has finished """
+    start = time.perf_counter()
+    for thought_action in thought_actions:
+        step = thought_action.get("Action")
+        print(f"\n[{port}] Thought: {thought_action.get('Thought')}")
+        print(f"[{port}] Action: {step}\n")
+        if error := step.get("error"):
+            print(f"[{port}] Error in executing step: {error}")
+            continue
+        if "blocking" in funcs.get(step.get("name"), {}).get("params", ()):
+            # the port's thread waits for the motion, so the join below waits for all motors
+            step = dict(step, blocking=True)
+        invoke_tool(step, funcs)
+    return time.perf_counter() - start
+
+
+def execute_concurrently(thought_actions, funcs, default_port="A", executor=None):
+    """ Executes the plan with the steps of different ports running concurrently
+
+    Steps are grouped by their `port` (`default_port` if they have none). The steps of a
+    port run in plan order on one thread and wait for each move to finish; this returns
+    once every port has finished (a join barrier).
+
+    Args:
+        :param funcs: dict
+            Motor functions that dispatch on `port` (see `prepare_port_funcs`)
+        :param executor: concurrent.futures.Executor
+            Runs the ports; a thread pool with one thread per port is used if not given
+
+    Returns (final answer or None, report with the wall `secs` and the `port_secs` of each port).
+    """
+    by_port, answer = split_by_port(thought_actions, default_port)
+    start = time.perf_counter()
+    own_executor = executor is None and len(by_port) > 1
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=len(by_port), thread_name_prefix="motor-port")
+    try:
+        if executor is None:
+            port_secs = {port: run_port_steps(port, steps, funcs) for port, steps in by_port.items()}
+        else:
+            futures = {port: executor.submit(run_port_steps, port, steps, funcs) for port, steps in by_port.items()}
+            port_secs = {port: future.result() for port, future in futures.items()}
+    finally:
+        if own_executor:
+            executor.shutdown()
+    report = dict(secs=time.perf_counter() - start, port_secs=port_secs)
+    return answer, report
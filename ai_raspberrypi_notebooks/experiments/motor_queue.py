@@ -0,0 +1,212 @@
+# Per-motor command queues: each Build HAT port gets a queue and an executor thread that runs
+# the port's actions one at a time, each blocking until the motor has finished, so commands
+# for a motor never overlap and a long move never holds up the voice loop. `invoke_tool`
+# submits to the queue and returns at once; every submitted action has a future.
+#   python -m experiments.control --motor-queue
+#
+# A new voice command (or the user saying stop) preempts the queues with `preempt_queues`:
+# the actions still waiting are cancelled and the motor coasts at once, ending the move in
+# progress. A "stop" step of a plan is queued and run in order like any other step. A queue
+# holds at most `maxsize` actions, and an action that waited more than `max_wait` secs to
+# start is dropped rather than moving the motor late.
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from experiments.metrics import registry, COUNT_BUCKETS
+from experiments.motor_executor import action_port
+
+
+class MotorQueueFull(Exception):
+    pass
+
+
+class CommandExpired(Exception):
+    pass
+
+
+class MotorQueue:
+    """ Runs the actions of one motor in order on an executor thread
+
+    Args:
+        :param port: str
+            Build HAT port of the motor
+        :param funcs: dict
+            Motor functions that dispatch on `port` (see `prepare_port_funcs`)
+        :param motor: buildhat.Motor
+            If provided, `preempt` makes it coast to end the move in progress (else it calls
+            the `stop` of `funcs`)
+        :param maxsize: int
+            Max actions waiting to start; `submit` raises `MotorQueueFull` beyond
+        :param max_wait: float
+            Max secs an action may wait to start before it fails with `CommandExpired`
+    """
+
+    def __init__(self, port, funcs, motor=None, maxsize=16, max_wait=30.0):
+        self.port = port
+        self.funcs = funcs
+        self.motor = motor
+        self.maxsize = maxsize
+        self.max_wait = max_wait
+        self.pending = deque()  # (future, name, params, submit time)
+        self.running = None  # future of the action in progress
+        self.closed = False
+        self.cond = threading.Condition()
+        self.waits = deque(maxlen=1000)  # secs the recent actions waited to start
+        self.stats = dict(submitted=0, completed=0, failed=0, cancelled=0, expired=0, rejected=0, preemptions=0,
+                          max_depth=0)
+        self.thread = threading.Thread(target=self.run, name=f"motor-queue-{port}", daemon=True)
+        self.thread.start()
+
+    def depth(self):
+        """ Actions waiting or in progress """
+        with self.cond:
+            return len(self.pending) + (self.running is not None)
+
+    def submit(self, name, params):
+        """ Queues the action `name` with `params`; returns its future """
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError(f"the queue of motor {self.port} is closed")
+            if len(self.pending) >= self.maxsize:
+                self.stats["rejected"] += 1
+                registry.incr("motor_queue_rejected", port=self.port)
+                raise MotorQueueFull(f"{len(self.pending)} actions are already queued on motor {self.port}")
+            self.pending.append((future, name, params, time.perf_counter()))
+            depth = len(self.pending) + (self.running is not None)
+            self.stats["submitted"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+            self.cond.notify_all()
+        registry.observe("motor_queue_depth", depth, buckets=COUNT_BUCKETS, port=self.port)
+        return future
+
+    def call(self, future, name, params):
+        """ Runs an action, blocking until the motor has finished, and sets its future """
+        f_def = self.funcs[name]
+        if "blocking" in f_def["params"]:
+            params = dict(params, blocking=True)
+        try:
+            with registry.span("motor_command", port=self.port, tool=name):
+                result = f_def["f"](**params)
+        except Exception as e:
+            print(f"Motor {self.port}: {name} failed: {e}")
+            with self.cond:
+                self.stats["failed"] += 1
+            future.set_exception(e)
+        else:
+            with self.cond:
+                self.stats["completed"] += 1
+            future.set_result(result)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                future, name, params, submitted = self.pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.running = future
+                wait = time.perf_counter() - submitted
+                self.waits.append(wait)
+            registry.observe("motor_queue_wait_secs", wait, port=self.port)
+            if self.max_wait is not None and wait > self.max_wait:
+                with self.cond:
+                    self.stats["expired"] += 1
+                registry.incr("motor_queue_expired", port=self.port)
+                future.set_exception(CommandExpired(f"{name} waited {wait:.2f} secs to start on motor {self.port}"))
+            else:
+                self.call(future, name, params)
+            with self.cond:
+                self.running = None
+                self.cond.notify_all()
+
+    def preempt(self, stop=True):
+        """ Cancels the actions waiting to start and, if `stop`, ends the motion in progress;
+        returns the number of cancelled actions
+        """
+        with self.cond:
+            cancelled = 0
+            while self.pending:
+                cancelled += self.pending.popleft()[0].cancel()
+            running = self.running is not None
+            self.stats["cancelled"] += cancelled
+            self.stats["preemptions"] += 1
+        registry.incr("motor_queue_cancelled", cancelled, port=self.port)
+        if stop and running:
+            # the executor thread returns from the move once the motor is released
+            if self.motor is not None:
+                self.motor.coast()
+            else:
+                self.funcs["stop"]["f"](port=self.port)
+        return cancelled
+
+    def wait_idle(self, timeout=None):
+        """ Waits until no action is waiting or in progress; returns False on timeout """
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and self.running is None, timeout)
+
+    def report(self):
+        """ Returns the stats with the current depth and the p50/p95/max secs actions waited to start """
+        with self.cond:
+            stats = dict(self.stats, port=self.port, depth=len(self.pending) + (self.running is not None))
+            waits = sorted(self.waits)
+        for name, q in (("wait_p50", 0.5), ("wait_p95", 0.95)):
+            stats[name] = waits[min(len(waits) - 1, int(len(waits) * q))] if waits else 0.0
+        stats["wait_max"] = waits[-1] if waits else 0.0
+        return stats
+
+    def close(self, cancel=True):
+        """ Stops the executor thread, after the queued actions unless `cancel` """
+        if cancel:
+            self.preempt(stop=False)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+
+def preempt_queues(queues, stop=True):
+    """ Cancels the queued motion of every motor (e.g. for a new voice command); returns the number cancelled """
+    cancelled = sum(queue.preempt(stop=stop) for queue in queues.values())
+    if cancelled:
+        print(f"Cancelled {cancelled} queued motor actions")
+    return cancelled
+
+
+def attach_queues(motors, funcs, **options):
+    """ Starts a queue per motor; returns (queues by port, funcs that submit each action to the
+    queue of its port and return its future)
+
+    The `observe` entry of the funcs reports the queue depth, followed by the state from the
+    `observe` of `funcs` (e.g. telemetry), if any. Other arguments are passed to `MotorQueue`.
+    """
+    default_port = next(iter(motors))
+    queues = {port: MotorQueue(port, funcs, motor=motor, **options) for port, motor in motors.items()}
+
+    def port_queue(params):
+        port = action_port(params, default_port)
+        if port not in queues:
+            raise ValueError(f"No motor on port {port}, must be one of {sorted(queues)}")
+        return queues[port]
+
+    def wrap(name):
+        def qf(**params):
+            return port_queue(params).submit(name, params)
+        return qf
+
+    def wrap_observe(observe):
+        def queue_observe(params):
+            queue = port_queue(params)
+            text = f"{queue.depth()} actions queued on motor {queue.port}"
+            # the action may not have started yet, so the state is not waited for
+            state = observe(dict(params, blocking=False)) if observe is not None else None
+            return f"{text}. {state}" if state else text
+        return queue_observe
+
+    return queues, {name: dict(f_def, f=wrap(name), observe=wrap_observe(f_def.get("observe")))
+                    for name, f_def in funcs.items()}
@@ -0,0 +1,268 @@
+# Simulated Build HAT motor that takes (scaled) real time to execute commands, so that
+# executors and whole voice-loop turns can be benchmarked without a Pi. Like
+# `buildhat.Motor`, non-blocking commands are queued and run one after another by the
+# motor, and a blocking command first waits for the queued ones to finish.
+#
+# Timing follows the Build HAT library: positional moves ramp at `speed * 0.05`
+# rotations/sec and pause before the motor coasts, and every command pays a serial link
+# round trip. Faults (failed commands and stalls) can be injected at random.
+#
+# The position moves continuously during a move, and `when_rotated` callbacks are made
+# every `interval` ms while it changes, as the Build HAT streams its motor data. Like
+# `buildhat.Motor`, `stop` waits for the queued moves before it releases the motor, while
+# `coast` releases it at once, cutting the move in progress short where the motor is.
+
+import time
+import queue
+import random
+import threading
+
+
+DEGREES_PER_SEC_PER_SPEED = 360 * 0.05
+COAST_SECS = 0.2  # pause after positional moves before the motor is released
+SERIAL_LATENCY_SECS = 0.005  # round trip of a command over the serial link to the Build HAT
+
+
+class SimulatedMotorError(Exception):
+    pass
+
+
+def position_delta(apos, degrees, direction="shortest"):
+    """ Degrees to turn from absolute position `apos` to `degrees`, as `run_to_position` does """
+    diff = (degrees - apos + 180) % 360 - 180
+    if direction == "shortest":
+        return diff
+    clockwise = (degrees - apos) % 360
+    if direction == "clockwise":
+        return clockwise
+    if direction == "anticlockwise":
+        return clockwise - 360 if clockwise else 0
+    raise SimulatedMotorError("Invalid direction, should be: shortest, clockwise or anticlockwise")
+
+
+class SimulatedMotor:
+    """ Stand-in for `buildhat.Motor` with the same command and position methods
+
+    Args:
+        :param port: str
+            Build HAT port name, for logging
+        :param time_scale: float
+            Multiplies all simulated times (e.g. 0.1 runs 10x faster than real time)
+        :param serial_latency: float
+            Secs added to every command for the serial link round trip
+        :param fault_rate: float
+            Probability that a command fails with `SimulatedMotorError`
+        :param stall_rate: float
+            Probability that a move stops short at a random point (e.g. blocked wheel)
+        :param seed: int
+            Seed of the fault injection
+    """
+
+    def __init__(self, port="A", time_scale=1.0, serial_latency=SERIAL_LATENCY_SECS,
+                 fault_rate=0.0, stall_rate=0.0, seed=None):
+        self.port = port
+        self.time_scale = time_scale
+        self.serial_latency = serial_latency
+        self.fault_rate = fault_rate
+        self.stall_rate = stall_rate
+        self.random = random.Random(seed)
+        self.default_speed = 20
+        self.connected = True
+        self.position = 0.0  # degrees since start, like `get_position`, at the end of the last move
+        self.interval = 10  # ms between `when_rotated` samples, like `buildhat.Motor.interval`
+        self.commands = self.faults = self.stalls = 0
+        self.busy_secs = 0.0
+        self._running = None  # (speed, start time) while started with `start`
+        self._moving = None  # (degrees, real secs, start time, speed) during a move
+        self._when_rotated = None
+        self._sampler = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=f"motor-sim-{port}", daemon=True)
+        self._worker.start()
+
+    def _sleep(self, secs):
+        time.sleep(secs * self.time_scale)
+
+    def _run(self):
+        while True:
+            move = self._pending.get()
+            try:
+                self._move(*move)
+            except SimulatedMotorError as e:
+                print(f"Motor {self.port}: {e}")
+            finally:
+                self._pending.task_done()
+
+    def _move(self, degrees, secs, coast=True):
+        """ Turns by `degrees` in `secs` (possibly stopping short), then pauses before coasting """
+        speed = degrees / secs / DEGREES_PER_SEC_PER_SPEED if secs else 0
+        if self.stall_rate and self.random.random() < self.stall_rate:
+            fraction = self.random.random()
+            with self._lock:
+                self.stalls += 1
+            degrees, secs = degrees * fraction, secs * fraction
+        with self._lock:
+            self._stopped.clear()
+            self._moving = (degrees, secs * self.time_scale, time.perf_counter(), round(speed))
+        stopped = self._stopped.wait(secs * self.time_scale) if secs and self.time_scale else False
+        with self._lock:
+            if stopped:
+                real_secs, since = self._moving[1:3]
+                fraction = min(1.0, (time.perf_counter() - since) / real_secs)
+                degrees, secs = degrees * fraction, secs * fraction
+            self._moving = None
+            self.position += degrees
+            self.busy_secs += secs
+        if coast and not stopped:
+            self._sleep(COAST_SECS)
+
+    def _command(self, move, blocking):
+        """ Sends a command over the (simulated) serial link, then runs or queues the move """
+        self._sleep(self.serial_latency)
+        with self._lock:
+            self.commands += 1
+            if self.fault_rate and self.random.random() < self.fault_rate:
+                self.faults += 1
+                raise SimulatedMotorError(f"Simulated fault on port {self.port}")
+        if move is None:
+            return
+        if blocking:
+            self._wait_for_nonblocking()
+            self._move(*move)
+        else:
+            self._pending.put(move)
+
+    def _wait_for_nonblocking(self):
+        self._pending.join()
+
+    def _speed(self, speed, low=-100):
+        speed = self.default_speed if speed is None else speed
+        if not low <= speed <= 100:
+            raise SimulatedMotorError("Invalid Speed")
+        return speed
+
+    @staticmethod
+    def _ramp_secs(degrees, speed):
+        if speed == 0:
+            raise SimulatedMotorError("Speed must not be 0 for a positional move")
+        return abs(degrees) / (abs(speed) * DEGREES_PER_SEC_PER_SPEED)
+
+    def run_for_degrees(self, degrees, speed=None, blocking=True):
+        speed = self._speed(speed)
+        degrees = degrees if speed > 0 else -degrees
+        self._command((degrees, self._ramp_secs(degrees, speed)), blocking)
+
+    def run_for_rotations(self, rotations, speed=None, blocking=True):
+        self.run_for_degrees(rotations * 360, speed=speed, blocking=blocking)
+
+    def run_for_seconds(self, seconds, speed=None, blocking=True):
+        speed = self._speed(speed)
+        self._command((speed * DEGREES_PER_SEC_PER_SPEED * seconds, seconds, False), blocking)
+
+    def run_to_position(self, degrees, speed=None, blocking=True, direction="shortest"):
+        speed = self._speed(speed, low=0)
+        if not -180 <= degrees <= 180:
+            raise SimulatedMotorError("Invalid angle")
+        # the delta depends on where the queued moves leave the motor
+        self._wait_for_nonblocking()
+        delta = position_delta(self.get_aposition(), degrees, direction)
+        self._command((delta, self._ramp_secs(delta, speed) if delta else 0.0), blocking)
+
+    def set_default_speed(self, default_speed):
+        self.default_speed = self._speed(default_speed)
+
+    def start(self, speed=None):
+        speed = self._speed(speed)
+        self._wait_for_nonblocking()
+        self._command(None, blocking=False)
+        with self._lock:
+            self._settle()
+            self._running = (speed, time.perf_counter())
+
+    def stop(self):
+        self._wait_for_nonblocking()
+        self.coast()
+
+    def coast(self):
+        """ Releases the motor at once; the move in progress ends where the motor is, queued moves still run """
+        self._command(None, blocking=False)
+        with self._lock:
+            self._settle()
+            self._running = None
+            self._stopped.set()
+
+    def off(self):
+        self.stop()
+
+    def _settle(self):
+        """ Adds the turn since `start` to the position (with the lock held) """
+        if self._running is not None:
+            speed, since = self._running
+            now = time.perf_counter()
+            secs = (now - since) / self.time_scale if self.time_scale else 0.0
+            self.position += speed * DEGREES_PER_SEC_PER_SPEED * secs
+            self.busy_secs += secs
+            self._running = (speed, now)
+
+    def _current_position(self):
+        """ Position including the part of the current move done so far (with the lock held) """
+        self._settle()
+        if self._moving is None:
+            return self.position
+        degrees, secs, since, speed = self._moving
+        return self.position + degrees * (min(1.0, (time.perf_counter() - since) / secs) if secs else 1.0)
+
+    def _current_speed(self):
+        if self._running is not None:
+            return self._running[0]
+        return self._moving[3] if self._moving is not None else 0
+
+    def get_position(self):
+        """ Degrees turned since the motor was created """
+        with self._lock:
+            return round(self._current_position())
+
+    def get_aposition(self):
+        """ Absolute position in degrees, from -180 to 180 """
+        return (self.get_position() + 180) % 360 - 180
+
+    def get_speed(self):
+        with self._lock:
+            return self._current_speed()
+
+    @property
+    def when_rotated(self):
+        return self._when_rotated
+
+    @when_rotated.setter
+    def when_rotated(self, value):
+        """ Sets the callback made with (speed, position, absolute position) when the motor turns """
+        self._when_rotated = value
+        if value is not None and (self._sampler is None or not self._sampler.is_alive()):
+            self._sampler = threading.Thread(target=self._sample, name=f"motor-sim-{self.port}-data", daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        """ Calls `when_rotated` every `interval` ms if the position changed by a degree or more """
+        old = None
+        while (callback := self._when_rotated) is not None:
+            with self._lock:
+                position = round(self._current_position())
+                speed = self._current_speed()
+            if old is None:
+                old = position
+            elif abs(position - old) >= 1:
+                callback(speed, position, (position + 180) % 360 - 180)
+                old = position
+            time.sleep(self.interval / 1000)
+
+    def wait_idle(self):
+        """ Waits until the queued non-blocking commands have finished """
+        self._wait_for_nonblocking()
+
+    def stats(self):
+        with self._lock:
+            return dict(port=self.port, commands=self.commands, faults=self.faults, stalls=self.stalls,
+                        busy_secs=self.busy_secs, position=self.position)
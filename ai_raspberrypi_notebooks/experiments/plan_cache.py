@@ -0,0 +1,181 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from experiments.metrics import registry
+
+
+DEFAULT_PLAN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ai_raspberrypi", "plans.sqlite")
+DEFAULT_MAX_BYTES = 1 << 20  # 1 MB of serialized plans
+DEFAULT_TTL_SECS = 30 * 24 * 3600
+
+NUMBER_WORDS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13, "fourteen": 14,
+    "fifteen": 15, "sixteen": 16, "seventeen": 17, "eighteen": 18, "nineteen": 19,
+}
+TENS_WORDS = {
+    "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50, "sixty": 60, "seventy": 70, "eighty": 80,
+    "ninety": 90,
+}
+REPEAT_WORDS = {"once": "1 time", "twice": "2 time", "thrice": "3 time"}
+FILLER_WORDS = {"please", "the", "a", "an", "and", "now", "then", "kindly"}
+# Build HAT ports: "a" is only a port next to a motor word or joined to another port
+PORT_WORDS = {"a", "b", "c", "d"}
+MOTOR_WORDS = {"motor", "motors", "port", "ports"}
+
+# punctuation, except for decimal points and minus signs of numbers
+NON_WORD = re.compile(r"[^\w\s.-]|(?<!\d)\.|\.(?!\d)|-(?!\d)")
+
+
+def port_indices(words):
+    """ Indices of the words that name ports, and of the "and"s joining two of them """
+    def next_to_motor(i):
+        return (i > 0 and words[i - 1] in MOTOR_WORDS) or (i + 1 < len(words) and words[i + 1] in MOTOR_WORDS)
+
+    ports = {i for i, word in enumerate(words) if word in PORT_WORDS and (word != "a" or next_to_motor(i))}
+    changed = True
+    while changed:
+        changed = False
+        for i in range(1, len(words) - 1):
+            if (words[i] == "and" and words[i - 1] in PORT_WORDS and words[i + 1] in PORT_WORDS
+                    and {i - 1, i + 1} & ports and not {i - 1, i, i + 1} <= ports):
+                ports |= {i - 1, i, i + 1}
+                changed = True
+    return ports
+
+
+def normalize_task(task):
+    """ Returns a key for `task` that ignores case, punctuation, whitespace, fillers and number words
+
+    e.g. "Please turn left, then turn right twice." and "turn left and turn right 2 times"
+    both normalize to "turn left turn right 2 time". Ports are kept, with the "and"s between
+    them: "Spin motors A and B forward" normalizes to "spin motors a and b forward".
+    """
+    text = NON_WORD.sub(" ", (task or "").lower())
+    words = []
+    raw_words = text.split()
+    ports = port_indices(raw_words)
+    for i, word in enumerate(raw_words):
+        if word in FILLER_WORDS and i not in ports:
+            continue
+        if word in REPEAT_WORDS:
+            words.extend(REPEAT_WORDS[word].split())
+        elif word in NUMBER_WORDS:
+            if words and words[-1] in TENS_WORDS:
+                words[-1] = str(TENS_WORDS[words[-1]] + NUMBER_WORDS[word])
+            else:
+                words.append(str(NUMBER_WORDS[word]))
+        else:
+            if word.endswith("s") and word[:-1] in ("time", "rotation", "degree", "second"):
+                word = word[:-1]
+            words.append(word)
+    words = [str(TENS_WORDS[w]) if w in TENS_WORDS else w for w in words]
+    return " ".join(words)
+
+
+def is_cacheable_plan(steps, answer):
+    """ Only complete plans without errors are worth replaying """
+    if not steps or not answer:
+        return False
+    return all(isinstance(s.get("Action"), dict) and not s["Action"].get("error") for s in steps)
+
+
+class PlanCache:
+    """ Persistent cache of final plans (the output of `messages_to_steps`) keyed on the normalized task
+
+    Entries live in a SQLite file so they survive restarts. Eviction is LRU by last access
+    once the serialized plans exceed `max_bytes`; entries older than `ttl_secs` are misses.
+
+    Args:
+        :param path: str
+            SQLite file; ":memory:" keeps the cache in-process only
+        :param max_bytes: int
+            Budget for the total size of the serialized plans
+        :param ttl_secs: float
+            Entries created earlier than this are treated as expired (None to disable)
+    """
+
+    def __init__(self, path=DEFAULT_PLAN_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, ttl_secs=DEFAULT_TTL_SECS):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, task TEXT, plan TEXT, "
+            "size INTEGER, created REAL, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS plans_accessed ON plans (accessed)")
+        self.conn.commit()
+
+    def get(self, task):
+        """ Returns (steps, answer) for `task`, or None on a miss """
+        key = normalize_task(task)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT plan, created FROM plans WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_secs is not None and now - row[1] > self.ttl_secs:
+                self.conn.execute("DELETE FROM plans WHERE key = ?", (key,))
+                self.conn.commit()
+                self.evictions += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                registry.incr("plan_cache_misses")
+                return None
+            self.conn.execute("UPDATE plans SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        registry.incr("plan_cache_hits")
+        plan = json.loads(row[0])
+        return plan.get("steps"), plan.get("answer")
+
+    def put(self, task, steps, answer):
+        """ Stores the plan for `task` if it is complete; returns True if stored """
+        if not is_cacheable_plan(steps, answer):
+            return False
+        key = normalize_task(task)
+        plan = json.dumps(dict(steps=steps, answer=answer))
+        size = len(plan.encode("utf-8"))
+        if size > self.max_bytes:
+            return False
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO plans (key, task, plan, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, task, plan, size, now, now),
+            )
+            self._evict()
+            self.conn.commit()
+        return True
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM plans").fetchone()[0]
+        while total > self.max_bytes:
+            key, size = self.conn.execute("SELECT key, size FROM plans ORDER BY accessed LIMIT 1").fetchone()
+            self.conn.execute("DELETE FROM plans WHERE key = ?", (key,))
+            self.evictions += 1
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM plans")
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM plans").fetchone()
+            lookups = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        hit_rate=(self.hits / lookups) if lookups else 0.0,
+                        entries=entries, bytes=total, max_bytes=self.max_bytes)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
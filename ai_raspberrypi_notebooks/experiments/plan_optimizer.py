@@ -0,0 +1,181 @@
+# Plan optimization between planning and execution: folds consecutive relative moves
+# at the same speed into one command, drops moves that cancel out, and normalizes
+# `run_to_position` targets. Every command saved is a Build HAT serial round trip, a
+# ramp, and the coast pause after it.
+
+import copy
+
+
+# The Build HAT ramps positional moves at `speed * 0.05` rotations/sec
+DEGREES_PER_SEC_PER_SPEED = 360 * 0.05
+# Serial command round trip plus the 0.2 secs pause before the motor coasts after a move
+COMMAND_OVERHEAD_SECS = 0.25
+DEFAULT_MOTOR_SPEED = 20  # `buildhat.Motor.default_speed`
+
+RELATIVE_MOVES = {"run_for_degrees": "degrees", "run_for_rotations": "rotations"}
+MOTION_TOOLS = set(RELATIVE_MOVES) | {"run_for_seconds", "run_to_position"}
+
+
+def action_speed(action, default_speed=DEFAULT_MOTOR_SPEED):
+    speed = action.get("speed")
+    return default_speed if speed is None else speed
+
+
+def displacement(action, default_speed=DEFAULT_MOTOR_SPEED):
+    """ Signed degrees a relative move turns the motor: the amount, in the direction of the speed """
+    name = action.get("name")
+    if name not in RELATIVE_MOVES:
+        return None
+    amount = action.get(RELATIVE_MOVES[name]) or 0
+    degrees = amount * 360 if name == "run_for_rotations" else amount
+    return -degrees if action_speed(action, default_speed) < 0 else degrees
+
+
+def estimate_duration(action, default_speed=DEFAULT_MOTOR_SPEED):
+    """ Estimated secs the motor takes for `action`, including the per-command overhead """
+    name = action.get("name")
+    if name not in MOTION_TOOLS:
+        return 0.0
+    speed = abs(action_speed(action, default_speed))
+    if name == "run_for_seconds":
+        return (action.get("seconds") or 0) + COMMAND_OVERHEAD_SECS
+    if speed == 0:
+        return COMMAND_OVERHEAD_SECS
+    if name == "run_to_position":
+        degrees = 90  # the start position is unknown; on average the target is a quarter turn away
+    else:
+        degrees = abs(displacement(action, default_speed))
+    return degrees / (speed * DEGREES_PER_SEC_PER_SPEED) + COMMAND_OVERHEAD_SECS
+
+
+def estimate_plan_duration(steps):
+    """ Estimated secs to execute the steps one after another """
+    default_speeds = {}  # by port
+    secs = 0.0
+    for step in steps:
+        action = step.get("Action") or {}
+        default_speed = default_speeds.get(action.get("port"), DEFAULT_MOTOR_SPEED)
+        if action.get("name") == "set_default_speed":
+            default_speeds[action.get("port")] = action.get("default_speed", default_speed)
+        secs += estimate_duration(action, default_speed)
+    return secs
+
+
+def net_displacement(steps):
+    """ Total signed degrees of the relative moves of each port of a plan (for checking optimizations) """
+    default_speeds = {}
+    totals = {}
+    for step in steps:
+        action = step.get("Action") or {}
+        port = action.get("port")
+        default_speed = default_speeds.get(port, DEFAULT_MOTOR_SPEED)
+        if action.get("name") == "set_default_speed":
+            default_speeds[port] = action.get("default_speed", default_speed)
+        elif (degrees := displacement(action, default_speed)) is not None:
+            totals[port] = totals.get(port, 0) + degrees
+    return {port: total for port, total in totals.items() if total}
+
+
+def normalize_position(degrees):
+    """ Maps any angle to the equivalent one in [-180, 180] that `run_to_position` accepts """
+    if -180 <= degrees <= 180:
+        return degrees
+    return (degrees + 180) % 360 - 180
+
+
+def fold_moves(group, default_speed):
+    """ Folds consecutive relative moves of one port at the same speed into one step, or none if they cancel """
+    net = sum(displacement(step["Action"], default_speed) for step in group)
+    if net == 0:
+        return []
+    first = group[0]["Action"]
+    speed = abs(action_speed(first, default_speed))
+    action = {"name": "run_for_degrees", "degrees": abs(net), "speed": speed if net > 0 else -speed}
+    if all(step["Action"]["name"] == "run_for_rotations" for step in group) and net % 360 == 0:
+        action = {"name": "run_for_rotations", "rotations": abs(net) // 360, "speed": action["speed"]}
+    if "port" in first:
+        action["port"] = first["port"]
+    if any("blocking" in step["Action"] for step in group):
+        action["blocking"] = any(step["Action"].get("blocking") for step in group)
+    thought = "; ".join(step.get("Thought") or "" for step in group)
+    return [{"Thought": f"Merged {len(group)} moves: {thought}", "Action": action}]
+
+
+def optimize_plan(steps, funcs=None):
+    """ Returns (optimized steps, report) for a plan as returned by `messages_to_steps`
+
+    Args:
+        :param steps: list
+            Dicts with the `Thought` and the decoded `Action`
+        :param funcs: dict
+            Motor functions (see `prepare_motor_funcs`); if provided, actions naming other
+            tools are left in place and act as barriers to folding
+
+    The report has the number of commands before/after and the estimated motion secs saved.
+    """
+    report = dict(commands_before=len(steps), folded=0, cancelled=0, normalized=0, superseded=0)
+    optimized = []
+    group = []
+    default_speeds = {}  # by port
+
+    def flush():
+        nonlocal group
+        if len(group) > 1:
+            merged = fold_moves(group, default_speeds.get(group[0]["Action"].get("port"), DEFAULT_MOTOR_SPEED))
+            if merged:
+                report["folded"] += len(group) - 1
+            else:
+                report["cancelled"] += len(group)
+            optimized.extend(merged)
+        else:
+            optimized.extend(group)
+        group = []
+
+    for step in steps:
+        step = copy.deepcopy(step)
+        action = step.get("Action")
+        name = action.get("name") if isinstance(action, dict) else None
+        known = name is not None and not action.get("error") and (funcs is None or name in funcs)
+        default_speed = default_speeds.get(action.get("port"), DEFAULT_MOTOR_SPEED) if known else None
+        if known and name in RELATIVE_MOVES:
+            first = group[0]["Action"] if group else None
+            if first and (first.get("port") != action.get("port")
+                          or abs(action_speed(first, default_speed)) != abs(action_speed(action, default_speed))):
+                flush()
+            group.append(step)
+            continue
+        flush()
+        if known and name == "run_to_position":
+            degrees = action.get("degrees")
+            if isinstance(degrees, (int, float)) and normalize_position(degrees) != degrees:
+                action["degrees"] = normalize_position(degrees)
+                report["normalized"] += 1
+            if (speed := action.get("speed")) is not None and speed < 0:
+                action["speed"] = -speed
+                report["normalized"] += 1
+            prev = optimized[-1].get("Action") if optimized else None
+            if (prev and prev.get("name") == "run_to_position" and prev.get("port") == action.get("port")
+                    and action.get("direction", "shortest") == "shortest"):
+                # only the last of consecutive absolute moves decides where the motor ends up
+                optimized.pop()
+                report["superseded"] += 1
+        elif known and name == "set_default_speed":
+            prev = optimized[-1].get("Action") if optimized else None
+            if prev and prev.get("name") == "set_default_speed" and prev.get("port") == action.get("port"):
+                optimized.pop()
+                report["superseded"] += 1
+            default_speeds[action.get("port")] = action.get("default_speed", default_speed)
+        elif known and name == "stop":
+            prev = optimized[-1].get("Action") if optimized else None
+            if prev and prev.get("name") == "stop" and prev.get("port") == action.get("port"):
+                report["superseded"] += 1
+                continue
+        optimized.append(step)
+    flush()
+
+    before = estimate_plan_duration(steps)
+    after = estimate_plan_duration(optimized)
+    report.update(commands_after=len(optimized), commands_saved=len(steps) - len(optimized),
+                  estimated_secs_before=before, estimated_secs_after=after,
+                  estimated_secs_saved=before - after)
+    return optimized, report
@@ -0,0 +1,377 @@
+# Local stand-in for the Anthropic Messages endpoint (`CLAUDE_API_URL`) and the OpenAI
+# audio endpoints (transcriptions and speech, at `base_url`).
+#
+# Used to benchmark and exercise the planning code offline:
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.stub_server --port 8765 --latency 0.2
+#   CLAUDE_API_URL=http://127.0.0.1:8765/v1/messages python -m experiments.control
+#
+# Requests with `"stream": true` are answered as server-sent events, split into
+# `stream_chunk_size` character deltas sent `stream_delay` secs apart. Non-streamed
+# requests wait for the same total generation time before responding.
+#
+# To exercise hedged requests, a `tail_rate` fraction of the Messages requests take
+# `tail_latency` secs longer and an `invalid_rate` fraction are answered with a truncated
+# `Action`; `model_latency` sets the latency of specific models instead of `latency`.
+#
+# Transcriptions answer with the text returned by `transcriber` for the uploaded body.
+# Speech is silence with the duration of normal speech for the input text, as 24 kHz
+# 16-bit PCM, or as opaque bytes of MP3 bitrate size (not decodable) for other formats.
+
+import re
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_COMPLETION = "Thought: I now know the final answer\nFinal Answer: Done."
+DEFAULT_TRANSCRIPT = "Turn left."
+INVALID_COMPLETION = 'Thought: I will turn the motor.\nAction: {"name": "run_for_degrees", "degrees": '
+
+SPEECH_SECS_PER_CHAR = 0.06
+SPEECH_PCM_BYTES_PER_SEC = 24000 * 2
+SPEECH_MP3_BYTES_PER_SEC = 128000 // 8
+SPEECH_CHUNK_BYTES = 4800  # 0.1 secs of PCM
+
+
+def default_responder(request):
+    return DEFAULT_COMPLETION
+
+
+def default_transcriber(body):
+    return DEFAULT_TRANSCRIPT
+
+
+def content_text(content):
+    if isinstance(content, list):
+        return "\n".join(c.get("text", "") for c in content if isinstance(c, dict))
+    return content or ""
+
+
+def get_prompt_text(request):
+    """ Returns the text of the last user message of a Messages API request """
+    messages = request.get("messages") or []
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return content_text(message.get("content"))
+    return ""
+
+
+def get_conversation_text(request):
+    """ Returns the system prompt and all the messages of a request as one text """
+    texts = [content_text(request.get("system"))]
+    texts.extend(content_text(message.get("content")) for message in request.get("messages") or [])
+    return "\n\n".join(texts)
+
+
+TASK_PATTERN = re.compile(r"Task: ```(.*?)```", flags=re.DOTALL)
+# state line of a compacted history (see `motor_control.summarize_steps`)
+STATE_PATTERN = re.compile(r"^State: (\d+) steps done", flags=re.MULTILINE)
+# marker of the whole-plan prompt (`plan_instructions` in motor_control)
+PLAN_MARKER = "Output the `Thought` and `Action` of all the steps"
+
+
+def load_scripts(path):
+    """ Loads a JSONL file of {"task", "steps": [{"Thought", "Action"}], "answer"} """
+    scripts = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                scripts.append(json.loads(line))
+    return scripts
+
+
+class ScriptedResponder:
+    """ Answers the planning prompts like the model would, from a script of steps per task
+
+    For the iterative ReAct prompt, the next step is chosen by counting the `Observation`s
+    already in the prompt (or in the later turns of a multi-turn conversation), plus the steps
+    of the state line of a compacted history; for the whole-plan prompt all the steps are
+    returned at once.
+    Unknown tasks get a `no tool applicable` action.
+    """
+
+    def __init__(self, scripts):
+        self.scripts = {self.key(s["task"]): s for s in scripts}
+
+    @staticmethod
+    def key(task):
+        return " ".join(task.lower().split())
+
+    @staticmethod
+    def format_step(step):
+        return f"Thought: {step['Thought']}\nAction: {json.dumps(step['Action'])}"
+
+    def __call__(self, request):
+        prompt = get_conversation_text(request)
+        matches = list(TASK_PATTERN.finditer(prompt))
+        script = self.scripts.get(self.key(matches[-1].group(1))) if matches else None
+        if script is None:
+            return self.format_step({"Thought": "No tool can perform this task.",
+                                     "Action": {"error": "no tool applicable"}})
+        steps = script["steps"]
+        final = f"Thought: I now know the final answer\nFinal Answer: {script['answer']}"
+        if PLAN_MARKER in prompt:
+            return "\n".join([self.format_step(step) for step in steps] + [final])
+        history = prompt[matches[-1].end():]
+        done = history.count("Observation:")
+        if state := STATE_PATTERN.search(history):
+            done += int(state.group(1))
+        if done < len(steps):
+            return self.format_step(steps[done])
+        return final
+
+
+def make_completion(text, model=None, input_tokens=0, cache_creation_input_tokens=0, cache_read_input_tokens=0):
+    usage = {"input_tokens": input_tokens, "output_tokens": max(1, len(text) // 4)}
+    if cache_creation_input_tokens or cache_read_input_tokens:
+        usage.update(cache_creation_input_tokens=cache_creation_input_tokens,
+                     cache_read_input_tokens=cache_read_input_tokens)
+    return {
+        "id": "msg_stub",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "usage": usage,
+    }
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def as_dict(self):
+        with self.lock:
+            return dict(requests=self.requests, connections=self.connections,
+                        bytes_in=self.bytes_in, bytes_out=self.bytes_out)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep the connection alive
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body go out as separate writes; avoid Nagle/delayed-ACK stalls on keep-alive
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.stats.add(connections=1)
+        if self.server.connect_latency:
+            # stands in for the TCP+TLS handshake cost of a fresh connection over Wi-Fi
+            time.sleep(self.server.connect_latency)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.server.stats.add(bytes_in=len(body))
+        return body
+
+    def read_json(self):
+        body = self.read_body()
+        return json.loads(body) if body else {}
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.add(bytes_out=len(body))
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.server.stats.add(bytes_out=len(data))
+
+    def send_event(self, event, data):
+        self.send_chunk(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+
+    def send_stream(self, completion):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        text = completion["content"][0]["text"]
+        usage = completion["usage"]
+        message = dict(completion, content=[], usage=dict(usage, output_tokens=0))
+        self.send_event("message_start", {"type": "message_start", "message": message})
+        self.send_event("content_block_start", {"type": "content_block_start", "index": 0,
+                                                "content_block": {"type": "text", "text": ""}})
+        size = max(1, self.server.stream_chunk_size)
+        for i in range(0, len(text), size):
+            if i > 0 and self.server.stream_delay:
+                time.sleep(self.server.stream_delay)
+            self.send_event("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": text[i:i + size]}})
+        self.send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self.send_event("message_delta", {"type": "message_delta",
+                                          "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                          "usage": {"output_tokens": usage["output_tokens"]}})
+        self.send_event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_POST(self):
+        if self.path.endswith("/audio/transcriptions"):
+            return self.do_transcription()
+        if self.path.endswith("/audio/speech"):
+            return self.do_speech()
+        request = self.read_json()
+        self.server.stats.add(requests=1)
+        latency = self.server.model_latency.get(request.get("model"), self.server.latency)
+        if self.server.draw(self.server.tail_rate):
+            latency += self.server.tail_latency
+        if latency:
+            time.sleep(latency)
+        text = self.server.responder(request)
+        if self.server.draw(self.server.invalid_rate):
+            text = INVALID_COMPLETION
+        input_tokens = len(json.dumps(request.get("messages") or [])) // 4
+        cache_tokens = {}
+        if system := request.get("system"):
+            system_tokens = len(json.dumps(system)) // 4
+            if isinstance(system, list) and any(isinstance(b, dict) and b.get("cache_control") for b in system):
+                # prompt caching: the first request writes the system prompt, later ones read it
+                key = json.dumps(system, sort_keys=True)
+                with self.server.stats.lock:
+                    cached = key in self.server.prompt_cache
+                    self.server.prompt_cache.add(key)
+                cache_tokens["cache_read_input_tokens" if cached else "cache_creation_input_tokens"] = system_tokens
+            else:
+                input_tokens += system_tokens
+        completion = make_completion(text, model=request.get("model"), input_tokens=input_tokens, **cache_tokens)
+        if request.get("stream"):
+            self.send_stream(completion)
+        else:
+            n_chunks = -(-len(text) // max(1, self.server.stream_chunk_size))
+            if self.server.stream_delay and n_chunks > 1:
+                time.sleep(self.server.stream_delay * (n_chunks - 1))
+            self.send_body(200, json.dumps(completion).encode("utf-8"))
+
+    def do_transcription(self):
+        body = self.read_body()
+        self.server.stats.add(requests=1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        text = self.server.transcriber(body)
+        self.send_body(200, json.dumps({"text": text}).encode("utf-8"))
+
+    def do_speech(self):
+        request = self.read_json()
+        self.server.stats.add(requests=1)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        secs = len(request.get("input") or "") * SPEECH_SECS_PER_CHAR
+        if request.get("response_format") == "pcm":
+            content_type, data = "audio/pcm", bytes(int(secs * SPEECH_PCM_BYTES_PER_SEC) // 2 * 2)
+        else:
+            content_type, data = "audio/mpeg", bytes(int(secs * SPEECH_MP3_BYTES_PER_SEC))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(data), SPEECH_CHUNK_BYTES):
+            if i > 0 and self.server.stream_delay:
+                time.sleep(self.server.stream_delay)
+            self.send_chunk(data[i:i + SPEECH_CHUNK_BYTES])
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, responder=None, latency=0.0, connect_latency=0.0,
+                 stream_chunk_size=8, stream_delay=0.0, handler=StubHandler, verbose=False, transcriber=None,
+                 model_latency=None, tail_rate=0.0, tail_latency=0.0, invalid_rate=0.0, seed=None):
+        super().__init__((host, port), handler)
+        self.responder = responder or default_responder
+        self.transcriber = transcriber or default_transcriber
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_delay = stream_delay
+        self.verbose = verbose
+        self.model_latency = model_latency or {}
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.invalid_rate = invalid_rate
+        self.random = random.Random(seed)
+        self.stats = StubStats()
+        self.prompt_cache = set()
+        self._thread = None
+
+    def draw(self, rate):
+        """ True with probability `rate` """
+        if not rate:
+            return False
+        with self.stats.lock:
+            return self.random.random() < rate
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/messages"
+
+    @property
+    def base_url(self):
+        """ Base URL for `OpenAI(base_url=...)` """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Messages and audio endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="injected latency in secs per request")
+    parser.add_argument("--connect-latency", type=float, default=0.0,
+                        help="injected latency in secs per new connection")
+    parser.add_argument("--stream-delay", type=float, default=0.0,
+                        help="delay in secs between streamed text deltas")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="fraction of slow Messages requests")
+    parser.add_argument("--tail-latency", type=float, default=0.0, help="extra latency in secs of slow requests")
+    parser.add_argument("--invalid-rate", type=float, default=0.0,
+                        help="fraction of Messages requests answered with an invalid action")
+    args = parser.parse_args()
+    server = StubServer(host=args.host, port=args.port, latency=args.latency,
+                        connect_latency=args.connect_latency, stream_delay=args.stream_delay, verbose=True,
+                        tail_rate=args.tail_rate, tail_latency=args.tail_latency, invalid_rate=args.invalid_rate)
+    print(f"Serving stub Messages endpoint at {server.url} and audio endpoints at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
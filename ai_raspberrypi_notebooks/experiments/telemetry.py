@@ -0,0 +1,269 @@
+# Motor telemetry: subscribes to the position/speed data the Build HAT streams for each motor
+# (`Motor.when_rotated`) and keeps it in a fixed-size ring buffer, so that execution can check
+# whether a move reached its target or stalled, and the planner sees the real motor state in
+# the `Observation` of each action:
+#   python -m experiments.control --telemetry
+#   python -m experiments.control --telemetry --closed-loop
+#
+# The Build HAT calls back every `interval` ms (10 by default) while the motor turns. Every
+# callback updates the live state, but samples less than `min_interval` secs after the last
+# buffered one are not buffered, which bounds the sample rate; the buffer is `capacity`
+# preallocated samples of 16 bytes, which bounds the memory.
+
+import time
+import threading
+from array import array
+from experiments.plan_optimizer import displacement, action_speed, DEGREES_PER_SEC_PER_SPEED, DEFAULT_MOTOR_SPEED
+from experiments.motor_sim import position_delta
+
+
+MOVING_SECS = 0.1  # the motor counts as moving if it turned within this many secs
+SECONDS_TOLERANCE = 0.25  # `run_for_seconds` is speed controlled, so its end position is approximate
+
+
+def absolute_position(position, offset=0):
+    return (position + offset + 180) % 360 - 180
+
+
+class TelemetryBuffer:
+    """ Ring buffer of the last `capacity` (time, speed, position, absolute position) samples,
+    in preallocated arrays
+    """
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.speeds = array("h", [0]) * capacity
+        self.positions = array("i", [0]) * capacity
+        self.apositions = array("h", [0]) * capacity
+        self.count = 0  # samples added since creation
+
+    def add(self, t, speed, position, aposition):
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.speeds[i] = speed
+        self.positions[i] = position
+        self.apositions[i] = aposition
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def samples(self, since=None):
+        """ Buffered samples from the oldest, after time `since` if provided """
+        first = self.count - len(self)
+        samples = []
+        for n in range(first, self.count):
+            i = n % self.capacity
+            if since is None or self.times[i] > since:
+                samples.append((self.times[i], self.speeds[i], self.positions[i], self.apositions[i]))
+        return samples
+
+    def latest(self):
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return self.times[i], self.speeds[i], self.positions[i], self.apositions[i]
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.times, self.speeds, self.positions, self.apositions))
+
+
+class MotorTelemetry:
+    """ Live state of a motor from its `when_rotated` callbacks, and the position its moves should reach
+
+    Args:
+        :param motor: buildhat.Motor | SimulatedMotor
+            Motor with a `when_rotated` callback and `get_position` / `get_aposition`
+        :param capacity: int
+            Number of samples kept in the ring buffer
+        :param min_interval: float
+            Min secs between buffered samples
+        :param tolerance: int
+            Max degrees from the target for a move to count as reached
+        :param stall_secs: float
+            Secs without turning, short of the target, after which the motor counts as stalled
+    """
+
+    def __init__(self, motor, port="A", capacity=512, min_interval=0.02, tolerance=5, stall_secs=0.5):
+        self.motor = motor
+        self.port = port
+        self.buffer = TelemetryBuffer(capacity)
+        self.min_interval = min_interval
+        self.tolerance = tolerance
+        self.stall_secs = stall_secs
+        self.cond = threading.Condition()
+        self.speed = 0
+        self.position = 0
+        self.offset = 0  # absolute position minus position, for motors that do not report it
+        self.moved = self.sampled = 0.0
+        self.target = None  # position the expected moves leave the motor at
+        self.target_tolerance = tolerance
+        self.expected = 0.0  # time of the last expected move
+        self.callbacks = 0
+
+    def attach(self):
+        """ Reads the current position and subscribes to the motor data; returns self """
+        position, aposition = self.motor.get_position(), self.motor.get_aposition()
+        with self.cond:
+            self.position = position
+            self.offset = (aposition - position) % 360
+        self.motor.when_rotated = self.on_rotated
+        return self
+
+    def detach(self):
+        self.motor.when_rotated = None
+
+    def on_rotated(self, speed, position, aposition=None):
+        """ `when_rotated` callback, made on the Build HAT reader thread """
+        now = time.perf_counter()
+        with self.cond:
+            self.callbacks += 1
+            self.speed, self.position, self.moved = speed, position, now
+            if aposition is not None:
+                self.offset = (aposition - position) % 360
+            if now - self.sampled >= self.min_interval:
+                self.buffer.add(now, speed, position, absolute_position(position, self.offset))
+                self.sampled = now
+            self.cond.notify_all()
+
+    def _state(self, now=None):
+        """ Snapshot of the state (with the lock held) """
+        now = now or time.perf_counter()
+        moving = now - self.moved < MOVING_SECS
+        error = None if self.target is None else round(self.target - self.position)
+        reached = error is not None and abs(error) <= self.target_tolerance and not moving
+        stalled = (error is not None and not reached and not moving
+                   and now - max(self.moved, self.expected) >= self.stall_secs)
+        return dict(port=self.port, position=self.position, aposition=absolute_position(self.position, self.offset),
+                    speed=self.speed if moving else 0, target=self.target, error_degrees=error, moving=moving,
+                    reached=reached, stalled=stalled, samples=len(self.buffer))
+
+    def snapshot(self):
+        with self.cond:
+            return self._state()
+
+    def expect(self, name, params):
+        """ Records the position the motor should reach after the motion `name` with `params`;
+        returns the previous target, for `restore` if the command fails
+        """
+        with self.cond:
+            previous = self.target
+            state = self._state()
+            # moves queued behind a move in progress start from where it ends
+            base = self.position if previous is None or state["reached"] or state["stalled"] else previous
+            default_speed = getattr(self.motor, "default_speed", DEFAULT_MOTOR_SPEED)
+            action = dict(params, name=name)
+            tolerance = self.tolerance
+            if (degrees := displacement(action, default_speed)) is not None:
+                self.target = base + degrees
+            elif name == "run_to_position":
+                self.target = base + position_delta(absolute_position(base, self.offset), params.get("degrees") or 0,
+                                                     params.get("direction") or "shortest")
+            elif name == "run_for_seconds":
+                degrees = action_speed(action, default_speed) * DEGREES_PER_SEC_PER_SPEED * (params.get("seconds") or 0)
+                self.target = base + degrees
+                tolerance = max(tolerance, abs(degrees) * SECONDS_TOLERANCE)
+            elif name in ("start", "stop"):
+                self.target = None  # runs until stopped; no target to reach
+            else:
+                return previous
+            self.target_tolerance = tolerance
+            self.expected = time.perf_counter()
+            return previous
+
+    def restore(self, target):
+        with self.cond:
+            self.target = target
+
+    def wait(self, timeout=None):
+        """ Waits until the target is reached or the motor stalls, for up to `timeout` secs;
+        returns the snapshot
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        with self.cond:
+            while True:
+                state = self._state()
+                if state["target"] is None or state["reached"] or state["stalled"]:
+                    return state
+                remaining = self.stall_secs / 4
+                if deadline is not None:
+                    if (left := deadline - time.perf_counter()) <= 0:
+                        return state
+                    remaining = min(remaining, left)
+                self.cond.wait(remaining)
+
+    def stats(self):
+        with self.cond:
+            return dict(port=self.port, callbacks=self.callbacks, buffered=self.buffer.count,
+                        samples=len(self.buffer), buffer_bytes=self.buffer.nbytes)
+
+
+def describe(state):
+    """ Motor state as the text of an observation """
+    text = f"Motor {state['port']} is at position {state['position']} (absolute {state['aposition']})"
+    if state["moving"]:
+        text += f", moving at speed {state['speed']}"
+    if state["stalled"]:
+        return f"{text}, stalled {abs(state['error_degrees'])} degrees short of its target {round(state['target'])}"
+    if state["reached"]:
+        return f"{text}, target reached"
+    if state["target"] is not None:
+        return f"{text}, {abs(state['error_degrees'])} degrees from its target {round(state['target'])}"
+    return text
+
+
+def motor_telemetry(telemetries, params):
+    """ Telemetry of the motor on the `port` of an action (default: the first of `telemetries`) """
+    port = params.get("port") or next(iter(telemetries))
+    return telemetries.get(str(port).upper())
+
+
+def stalled(telemetries, action):
+    """ Returns the state of the motor of `action` if it stalled, or None """
+    telemetry = motor_telemetry(telemetries, action)
+    if telemetry is None:
+        return None
+    state = telemetry.snapshot()
+    return state if state["stalled"] else None
+
+
+def attach_telemetry(motors, funcs, wait_secs=2.0, **options):
+    """ Starts the telemetry of `motors`; returns (telemetries by port, funcs that record the
+    target of each move and report the motor state)
+
+    Args:
+        :param motors: dict
+            Motors by Build HAT port name, as from `get_port_funcs`
+        :param funcs: dict
+            Functions of `motors` from `get_port_funcs`
+        :param wait_secs: float
+            Max secs to wait after a blocking move for the motor to reach its target or stall
+            before its state is reported
+
+    `invoke_tool` adds the state returned by the `observe` entry of the funcs to the observation.
+    Other arguments are passed to `MotorTelemetry`.
+    """
+    telemetries = {port: MotorTelemetry(motor, port=port, **options).attach() for port, motor in motors.items()}
+
+    def wrap(name, f):
+        def tf(**params):
+            telemetry = motor_telemetry(telemetries, params)
+            if telemetry is None:
+                return f(**params)
+            previous = telemetry.expect(name, params)
+            try:
+                return f(**params)
+            except Exception:
+                telemetry.restore(previous)
+                raise
+        return tf
+
+    def observe(params):
+        if (telemetry := motor_telemetry(telemetries, params)) is None:
+            return None
+        blocking = params.get("blocking", True)
+        return describe(telemetry.wait(wait_secs) if blocking else telemetry.snapshot())
+
+    return telemetries, {name: dict(f_def, f=wrap(name, f_def["f"]), observe=observe) for name, f_def in funcs.items()}
@@ -0,0 +1,293 @@
+# Speech-to-text backends behind `audio_control.transcribe`:
+#   python -m experiments.control --transcriber local    # on the Pi's CPU, works without Wi-Fi
+#   python -m experiments.control --transcriber auto     # the OpenAI API, falling back to local
+#
+# `cloud` uploads each recording to the OpenAI transcription API. `local` runs a small Whisper
+# model quantized to int8 with faster-whisper (CTranslate2) on the CPU:
+#   pip install faster-whisper
+# The model is loaded once by a worker process that then stays warm, so an utterance only
+# pays for decoding. The decoder is prompted with the motor command vocabulary. With
+# `constrain=True` (`--constrain-vocabulary`), misheard direction, number and unit words of a
+# transcript that looks like a command are also replaced by the closest one (e.g. "lift" ->
+# "left"): faster-whisper has no hook to mask the decoder's tokens, so this is how far the
+# transcript can be constrained to the commands.
+#
+# Every backend has a `name` and `transcribe(byte_stream) -> text`. Benchmark them on a
+# recorded corpus with `python -m experiments.benchmarks.transcription`.
+
+import re
+import time
+import difflib
+import threading
+import multiprocessing
+import numpy as np
+from experiments import audio_control
+from experiments.audio_capture import read_wav
+from experiments.audio_encoding import resample, TRANSCRIBE_SAMPLERATE
+from experiments.intent import MOVE_VERBS, FORWARD_WORDS, BACKWARD_WORDS, UNITS, SKIP_WORDS
+from experiments.plan_cache import NUMBER_WORDS, TENS_WORDS, REPEAT_WORDS, FILLER_WORDS, PORT_WORDS, MOTOR_WORDS
+from experiments.metrics import registry
+
+
+LOCAL_MODEL = "tiny.en"  # ~40 MB at int8; "base.en" is more accurate at about twice the time
+COMMAND_WORDS = {"left", "right", "around", "turn", "turns", "time", "times", "degree", "rotation", "position",
+                 "speed", "default", "set", "start", "stop", "at", "of", "to", "with", "slowly", "quickly",
+                 "minus", "half", "quarter", "full", "clockwise", "anticlockwise", "counterclockwise", "shortest"}
+# real words that are close to a command word but mean something else (e.g. "light", not "right")
+KEEP_WORDS = {"on", "off", "step", "steps", "light", "lights", "lamp", "night", "fight", "might", "sight", "tight",
+              "let", "lot", "top", "spot"}
+VOCABULARY = frozenset(COMMAND_WORDS | MOVE_VERBS | FORWARD_WORDS | BACKWARD_WORDS | set(UNITS) | set(UNITS.values())
+                       | SKIP_WORDS | set(NUMBER_WORDS) | set(TENS_WORDS) | set(REPEAT_WORDS) | FILLER_WORDS
+                       | PORT_WORDS | MOTOR_WORDS)
+# the only words a misheard word is replaced by
+SNAP_WORDS = frozenset({"left", "right", "around"} | FORWARD_WORDS | BACKWARD_WORDS | set(UNITS) | set(UNITS.values())
+                       | set(NUMBER_WORDS) | set(TENS_WORDS) | set(REPEAT_WORDS))
+VOCABULARY_PROMPT = "Turn left. Turn right twice. Go forward 2 rotations. Rotate backwards 90 degrees at speed 30. " \
+                    "Run to position minus 45 degrees. Start the motor. Stop."
+# words that sound like command words but are not spelled alike
+HOMOPHONES = {"write": "right", "rite": "right", "wright": "right", "tree": "three", "won": "one", "fore": "four",
+              "ate": "eight", "sex": "six", "tin": "ten"}
+WORD = re.compile(r"[A-Za-z]+")
+
+
+def constrain_to_vocabulary(text, vocabulary=VOCABULARY, cutoff=0.75, min_known=0.5):
+    """ Replaces the words of `text` that are neither in `vocabulary` nor in `KEEP_WORDS` by the
+    closest direction, number or unit word (`SNAP_WORDS`), if any is at least `cutoff` similar
+
+    Only applies if at least `min_known` of the words are in `vocabulary`, so that questions
+    and other speech that is not a command are left as they are.
+    """
+    words = [word.lower() for word in WORD.findall(text)]
+    if not words or sum(word in vocabulary or word in HOMOPHONES for word in words) < min_known * len(words):
+        return text
+
+    def replace(match):
+        word = match.group()
+        lower = word.lower()
+        if lower in vocabulary or lower in KEEP_WORDS:
+            return word
+        if (close := HOMOPHONES.get(lower)) is None:
+            matches = difflib.get_close_matches(lower, SNAP_WORDS & vocabulary, n=1, cutoff=cutoff)
+            if not matches:
+                return word
+            close = matches[0]
+        return close.capitalize() if word[0].isupper() else close
+    return WORD.sub(replace, text)
+
+
+def load_audio(byte_stream, samplerate=TRANSCRIBE_SAMPLERATE):
+    """ Returns (mono float32 samples at `samplerate`, duration in secs) of the recording in `byte_stream` """
+    byte_stream.seek(0)
+    if getattr(byte_stream, "name", "audio.wav").endswith(".wav"):
+        frames, rate = read_wav(byte_stream)
+    else:
+        from pydub import AudioSegment  # compressed formats are decoded by ffmpeg
+        segment = AudioSegment.from_file(byte_stream)
+        frames = np.array(segment.get_array_of_samples(), dtype=np.float32).reshape(-1, segment.channels) / 32768.0
+        rate = segment.frame_rate
+    byte_stream.seek(0)
+    return resample(frames.mean(axis=1), rate, samplerate), len(frames) / rate
+
+
+class CloudBackend:
+    """ Transcribes with the OpenAI API (see `audio_control.transcribe_cloud`) """
+
+    name = "cloud"
+
+    def transcribe(self, byte_stream):
+        return audio_control.transcribe_cloud(byte_stream)
+
+    def close(self):
+        pass
+
+
+def serve_local(conn, model, compute_type, cpu_threads, options):
+    """ Worker process of `LocalWhisperBackend`: loads the model, then answers requests of
+    (samples, options) with ("ok", (text, secs)) or ("error", message) until it gets None
+    """
+    try:
+        from faster_whisper import WhisperModel
+        whisper = WhisperModel(model, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        samples, request_options = request
+        start = time.perf_counter()
+        try:
+            segments, info = whisper.transcribe(samples, **dict(options, **request_options))
+            text = " ".join(segment.text.strip() for segment in segments)  # segments decode lazily
+            conn.send(("ok", (text, time.perf_counter() - start)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class LocalWhisperBackend:
+    """ Transcribes on the CPU with an int8 Whisper model in a warm worker process
+
+    Args:
+        :param model: str
+            faster-whisper model name or path (downloaded on first use)
+        :param compute_type: str
+            CTranslate2 quantization of the weights
+        :param cpu_threads: int
+            Threads of the worker (the Pi 5 has 4 cores)
+        :param vocabulary: set
+            If provided, the decoder is prompted with the commands
+        :param constrain: bool
+            If True (and `vocabulary` is provided), misheard words of the transcript are
+            replaced by command words (see `constrain_to_vocabulary`)
+        :param timeout: float
+            Max secs to wait for a transcript
+    """
+
+    name = "local"
+
+    def __init__(self, model=LOCAL_MODEL, compute_type="int8", cpu_threads=4, vocabulary=VOCABULARY, constrain=False,
+                 beam_size=1, timeout=30.0, load_timeout=300.0):
+        self.model = model
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.vocabulary = vocabulary
+        self.constrain = constrain
+        self.timeout = timeout
+        self.load_timeout = load_timeout
+        # greedy decoding of one short utterance, in English, without timestamps
+        self.options = dict(language="en", beam_size=beam_size, without_timestamps=True,
+                            condition_on_previous_text=False, initial_prompt=VOCABULARY_PROMPT if vocabulary else None)
+        self.process = self.conn = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Starts the worker and waits until its model is loaded and warmed up; returns self """
+        with self.lock:
+            self._start()
+        return self
+
+    def _start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        # spawned rather than forked: the parent has motor and audio threads
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=serve_local, name="transcriber", daemon=True,
+                                       args=(child_conn, self.model, self.compute_type, self.cpu_threads, self.options))
+        start = time.perf_counter()
+        self.process.start()
+        child_conn.close()
+        try:
+            self._receive(self.load_timeout)
+            self._request(np.zeros(TRANSCRIBE_SAMPLERATE, dtype=np.float32), self.timeout)  # first decode allocates
+        except Exception:
+            self._stop()
+            raise
+        print(f"Local transcriber ({self.model}, {self.compute_type}) ready in {time.perf_counter() - start:.2f} secs")
+
+    def _receive(self, timeout):
+        if not self.conn.poll(timeout):
+            self._stop()
+            raise TimeoutError(f"no answer from the local transcriber in {timeout} secs")
+        try:
+            status, result = self.conn.recv()
+        except EOFError:
+            self._stop()
+            raise RuntimeError("the local transcriber exited")
+        if status == "error":
+            raise RuntimeError(f"local transcription failed: {result}")
+        return result
+
+    def _request(self, samples, timeout, **options):
+        self.conn.send((samples, options))
+        return self._receive(timeout)
+
+    def transcribe(self, byte_stream):
+        samples, audio_secs = load_audio(byte_stream)
+        start = time.perf_counter()
+        with self.lock, registry.span("transcribe", backend=self.name):
+            self._start()
+            text, decode_secs = self._request(samples, self.timeout)
+        secs = time.perf_counter() - start
+        if self.constrain and self.vocabulary:
+            text = constrain_to_vocabulary(text, self.vocabulary)
+        registry.observe("transcribe_rtf", secs / audio_secs if audio_secs else 0.0, backend=self.name)
+        print(f"Time for local transcription: {secs:.3f} secs for {audio_secs:.2f} secs of audio "
+              f"(real-time factor {secs / audio_secs if audio_secs else 0.0:.2f})")
+        return text.strip()
+
+    def _stop(self):
+        if self.process is not None:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(timeout=2)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.conn.close()
+        self.process = self.conn = None
+
+    def close(self):
+        with self.lock:
+            self._stop()
+
+
+class FallbackBackend:
+    """ Transcribes with `primary`, and with `fallback` if it fails (e.g. without network) """
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    def transcribe(self, byte_stream):
+        try:
+            return self.primary.transcribe(byte_stream)
+        except Exception as e:
+            print(f"Transcription with {self.primary.name} failed ({type(e).__name__}: {e}), using {self.fallback.name}")
+            registry.incr("transcribe_fallbacks", backend=self.fallback.name)
+            return self.fallback.transcribe(byte_stream)
+
+    def close(self):
+        self.primary.close()
+        self.fallback.close()
+
+
+def get_backend(name="cloud", **local_options):
+    """ Returns the "cloud", "local" or "auto" (cloud, falling back to local) backend; the local
+    worker is started (and its model loaded) before returning
+
+    "auto" is only the cloud backend if the local one cannot start (e.g. faster-whisper is not installed).
+    """
+    if name == "cloud":
+        return CloudBackend()
+    if name == "local":
+        return LocalWhisperBackend(**local_options).start()
+    if name == "auto":
+        try:
+            local = LocalWhisperBackend(**local_options).start()
+        except Exception as e:
+            print(f"Warning: the local transcriber is unavailable ({e}), transcribing with the OpenAI API only")
+            registry.incr("transcribe_local_unavailable")
+            return CloudBackend()
+        return FallbackBackend(CloudBackend(), local)
+    raise ValueError(f"invalid transcriber {name}, must be cloud, local or auto")
+
+
+def configure_transcriber(name="cloud", constrain=False, **local_options):
+    """ Sets `audio_control.transcriber` to the backend `name` (None for the default cloud path); returns it
+
+    With `constrain`, the local transcripts are constrained to the command vocabulary (see `constrain_to_vocabulary`).
+    """
+    if audio_control.transcriber is not None:
+        audio_control.transcriber.close()
+        audio_control.transcriber = None
+    if name != "cloud":
+        audio_control.transcriber = get_backend(name, constrain=constrain, **local_options)
+    return audio_control.transcriber
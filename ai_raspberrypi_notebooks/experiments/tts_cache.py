@@ -0,0 +1,170 @@
+# Content-addressed cache of synthesized speech, so that repeated phrases (confirmations,
+# common final answers) play without a text-to-speech round trip.
+#
+# To synthesize a list of phrases ahead of time:
+#   cd ai_raspberrypi_notebooks
+#   python -m experiments.tts_cache --prewarm phrases.txt
+
+import os
+import json
+import hashlib
+import argparse
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from experiments.metrics import registry
+
+
+DEFAULT_TTS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ai_raspberrypi", "tts")
+DEFAULT_MAX_BYTES = 50 << 20
+DEFAULT_MEMORY_ENTRIES = 32
+
+DEFAULT_PREWARM_PHRASES = [
+    "Turned left.",
+    "Turned right.",
+    "Turned around.",
+    "Started the motor.",
+    "Stopped the motor.",
+]
+
+
+def tts_key(text, model, voice, instructions):
+    data = json.dumps([text, model, voice, instructions], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """ Two-level cache of speech audio keyed on (text, model, voice, instructions)
+
+    Decoded `AudioSegment`s are kept in an in-memory LRU; the encoded audio is kept on disk
+    (one file per key, named by its hash) and the least recently used files are removed
+    once the directory exceeds `max_bytes`.
+
+    Args:
+        :param path: str
+            Directory of the on-disk store
+        :param max_bytes: int
+            Size cap of the on-disk store
+        :param memory_entries: int
+            Number of decoded segments kept in memory
+    """
+
+    def __init__(self, path=DEFAULT_TTS_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 memory_entries=DEFAULT_MEMORY_ENTRIES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+    def _files(self, key):
+        return [os.path.join(self.path, f"{key}.{ext}") for ext in ("mp3", "wav")]
+
+    def _remember(self, key, segment):
+        self.memory[key] = segment
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, text, model, voice, instructions):
+        """ Returns the decoded `AudioSegment` or None on a miss """
+        key = tts_key(text, model, voice, instructions)
+        with self.lock:
+            if (segment := self.memory.get(key)) is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                registry.incr("tts_cache_hits", level="memory")
+                return segment
+        for filename in self._files(key):
+            if os.path.exists(filename):
+                from pydub import AudioSegment
+                try:
+                    segment = AudioSegment.from_file(filename, format=filename.rsplit(".", 1)[1])
+                    os.utime(filename)  # the mtime is the LRU order of the disk store
+                except FileNotFoundError:
+                    continue  # evicted by another thread
+                except Exception as e:
+                    print(f"Removing unreadable cached speech {filename}: {e}")
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                with self.lock:
+                    self._remember(key, segment)
+                    self.disk_hits += 1
+                registry.incr("tts_cache_hits", level="disk")
+                return segment
+        with self.lock:
+            self.misses += 1
+        registry.incr("tts_cache_misses")
+        return None
+
+    def put(self, text, model, voice, instructions, data, fmt="mp3", segment=None):
+        """ Stores the encoded audio `data` ("mp3" or "wav") and, if given, its decoded `segment` """
+        key = tts_key(text, model, voice, instructions)
+        filename = os.path.join(self.path, f"{key}.{fmt}")
+        tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+        with self.lock:
+            if segment is not None:
+                self._remember(key, segment)
+        self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used files beyond `max_bytes`; files that another thread
+        or process removed meanwhile are skipped
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if name.endswith((".mp3", ".wav")):
+                    try:
+                        st = os.stat(os.path.join(self.path, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            hits = self.memory_hits + self.disk_hits
+            return dict(memory_hits=self.memory_hits, disk_hits=self.disk_hits, misses=self.misses,
+                        hit_rate=(hits / lookups) if lookups else 0.0, memory_entries=len(self.memory))
+
+
+def pcm_to_wav_bytes(pcm, samplerate, channels=1):
+    import wave
+    byte_stream = BytesIO()
+    with wave.open(byte_stream, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(pcm)
+    return byte_stream.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Synthesizes phrases into the text-to-speech cache")
+    parser.add_argument("--path", default=DEFAULT_TTS_CACHE_DIR)
+    parser.add_argument("--prewarm", metavar="FILE", default=None,
+                        help="text file with one phrase per line (default: a few common answers)")
+    args = parser.parse_args()
+    from experiments.audio_control import prewarm_tts_cache, load_phrases
+    cache = TTSCache(args.path)
+    phrases = load_phrases(args.prewarm) if args.prewarm else DEFAULT_PREWARM_PHRASES
+    prewarm_tts_cache(cache, phrases)
+    print(f"TTS cache: {cache.stats()}")